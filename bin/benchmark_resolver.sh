@@ -0,0 +1,3 @@
+export DJANGO_SETTINGS_MODULE=mysite.settings
+export PYTHONPATH=.
+python core/testing/benchmark_resolver.py $@
@@ -1,5 +1,7 @@
 #!/bin/bash
-# Should be run from the django project root.
+# Should be run from the django project root, against an empty database.
 
-python core/testing/build_model_fixtures.py
+./manage.py generate_ledger --users 10 --currencies 3 --transactions 100 \
+	--pending 25 --resolutions 5 --exchange-rates 10 --partners 3
+mkdir -p ./core/fixtures/testing
 ./manage.py dumpdata auth core > ./core/fixtures/testing/base.json
@@ -5,9 +5,13 @@ from core.models import *
 admin.site.register(Person)
 admin.site.register(PersonBalance)
 admin.site.register(Balance)
+admin.site.register(Position)
 admin.site.register(Transaction)
 admin.site.register(TransactionRecord)
 admin.site.register(Currency)
 admin.site.register(Resolution)
 admin.site.register(PersonResolution)
 admin.site.register(ExchangeRate)
+admin.site.register(Watermark)
+admin.site.register(LedgerImport)
+admin.site.register(BalanceSnapshot)
@@ -2,23 +2,73 @@
 Database Acess Layer
 """
 
+import collections
+import contextlib
 import datetime
-import itertools
+import functools
+import logging
 import operator
+import time
 
-from django.db.models import Q
-from django.db import transaction
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.db.models import Case, F, Prefetch, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.utils import timezone
 
 from core import models
 
+log = logging.getLogger(__name__)
+
+
+class CreditLimitExceeded(ValueError):
+    """A transfer would take the net position of a person below their credit
+    limit.
+    """
+
+
+def balance_pair(persona, personb):
+    """Get the (persona_id, personb_id) key of the balance between two
+    persons, or person ids, lowest id first.
+    """
+    ids = getattr(persona, "id", persona), getattr(personb, "id", personb)
+    return min(ids), max(ids)
+
+
+def balance_delta(provider, receiver, value):
+    """Get (persona_id, personb_id, delta) for a transfer of `value` from the
+    provider to the receiver. The provider becomes more debted, which is a
+    positive delta when the provider is persona.
+    """
+    persona_id, personb_id = balance_pair(provider, receiver)
+    if persona_id == getattr(provider, "id", provider):
+        return persona_id, personb_id, value
+    return persona_id, personb_id, -value
+
 
 def get_balance(persona, personb, currency):
     """Load a balance between two persons."""
-    return (
-        models.PersonBalance.objects.select_related("balance")
-        .get(person=persona, balance__persons=personb, balance__currency=currency)
-        .balance
+    persona_id, personb_id = balance_pair(persona, personb)
+    return models.Balance.objects.get(
+        persona_id=persona_id, personb_id=personb_id, currency=currency
+    )
+
+
+def credited_q(credited):
+    """Filter PersonBalances where the person is credited, or debted. The
+    persona of a balance is credited when the value is negative.
+    """
+    persona_lookup, personb_lookup = ("lt", "gt") if credited else ("gt", "lt")
+    return Q(
+        **{
+            "balance__persona_id": F("person_id"),
+            "balance__value__" + persona_lookup: 0,
+        }
+    ) | Q(
+        **{
+            "balance__personb_id": F("person_id"),
+            "balance__value__" + personb_lookup: 0,
+        }
     )
 
 
@@ -26,41 +76,180 @@ def get_balances(user, include_balanced=False, credited=None):
     """Get the list of balances for a user. Filter out any where the value is
     back to 0.
     """
-    q = models.PersonBalance.objects.filter(person=user.person)
+    q = models.PersonBalance.objects.filter(person=user.person).select_related(
+        "balance__currency", "balance__persona__user", "balance__personb__user"
+    )
     if not include_balanced:
         q = q.exclude(balance__value=0)
     if credited is not None:
-        q = q.filter(credited=credited)
+        q = q.filter(credited_q(credited))
     return q
 
 
 def get_balances_many(persons, currency, credited, include_balanced=False):
     """Return a map of person -> balances."""
     q = models.PersonBalance.objects.filter(
-        person__in=persons, credited=credited, balance__currency=currency
+        credited_q(credited), person__in=persons, balance__currency=currency
     )
     if not include_balanced:
         q = q.exclude(balance__value=0)
     return q
 
 
+def get_debt_edges(currency, chunk_size=2000):
+    """Yield (balance_id, debted_id, credited_id, value) for every non-zero
+    balance in a currency. All balances are read in a single query, without
+    joins.
+    """
+    rows = (
+        models.Balance.objects.filter(currency=currency)
+        .exclude(value=0)
+        .order_by("id")
+        .values_list("id", "persona_id", "personb_id", "value")
+        .iterator(chunk_size=chunk_size)
+    )
+    for balance_id, persona_id, personb_id, value in rows:
+        if value > 0:
+            yield balance_id, persona_id, personb_id, value
+        else:
+            yield balance_id, personb_id, persona_id, -value
+
+
+def get_debted_balance_ids(currency, since=None):
+    """Get the ids of non-zero balances in a currency, in order of the debted
+    person. If `since` is set, only balances updated after it are included.
+    """
+    q = (
+        models.Balance.objects.filter(currency=currency)
+        .exclude(value=0)
+        .annotate(
+            debted_id=Case(
+                When(value__gt=0, then=F("persona_id")), default=F("personb_id")
+            )
+        )
+        .order_by("debted_id", "id")
+    )
+    if since is not None:
+        q = q.filter(time_updated__gt=since)
+    return list(q.values_list("id", flat=True))
+
+
+# The next balance is joined straight from the table, on either side of
+# the pair, so each step is an index lookup on persona or personb instead
+# of a scan of the currency. The unary + keeps SQLite off the currency
+# index, which would scan every balance of the currency.
+BALANCE_CHAIN_SQL = """
+WITH RECURSIVE chains(currency_id, goal_id, person_id, depth, value, path, persons)
+AS (
+    SELECT currency_id,
+        CASE WHEN value > 0 THEN persona_id ELSE personb_id END,
+        CASE WHEN value > 0 THEN personb_id ELSE persona_id END,
+        0,
+        ABS(value),
+        CAST(id AS TEXT),
+        CAST(CASE WHEN value > 0 THEN persona_id ELSE personb_id END AS TEXT)
+            || ',' ||
+            CAST(CASE WHEN value > 0 THEN personb_id ELSE persona_id END AS TEXT)
+    FROM {balance}
+    WHERE id = %(start)s AND value <> 0
+    UNION ALL
+    SELECT chains.currency_id, chains.goal_id,
+        CASE WHEN b.value > 0 THEN b.personb_id ELSE b.persona_id END,
+        chains.depth + 1,
+        CASE WHEN ABS(b.value) < chains.value THEN ABS(b.value) ELSE chains.value END,
+        chains.path || ',' || CAST(b.id AS TEXT),
+        chains.persons || ',' ||
+            CAST(CASE WHEN b.value > 0 THEN b.personb_id ELSE b.persona_id END AS TEXT)
+    FROM chains
+    JOIN {balance} b
+        ON ((b.persona_id = chains.person_id AND b.value > 0)
+            OR (b.personb_id = chains.person_id AND b.value < 0))
+        AND +b.currency_id = chains.currency_id
+    WHERE chains.depth < %(limit)s
+      AND chains.person_id <> chains.goal_id
+      AND (
+        CASE WHEN b.value > 0 THEN b.personb_id ELSE b.persona_id END
+            = chains.goal_id
+        OR ',' || chains.persons || ',' NOT LIKE '%%,' ||
+            CAST(CASE WHEN b.value > 0 THEN b.personb_id ELSE b.persona_id END
+                AS TEXT) || ',%%'
+      )
+)
+SELECT value, path, persons
+FROM chains
+WHERE person_id = goal_id
+LIMIT 1
+"""
+
+
+def find_balance_chain(balance_id, limit):
+    """Find the shortest chain of balances which leads from the credited
+    person of a balance back to its debted person, through at most `limit`
+    other balances, with a single recursive query.
+
+    Both SQLite and PostgreSQL build recursive queries breadth first, so the
+    first chain returned is a shortest one and the query stops there.
+
+    Returns (legs, value) where legs is a list of
+    (balance_id, debted_id, credited_id) starting with the given balance, and
+    value is the largest value which can be resolved along the chain, or None
+    if there is no chain.
+    """
+    sql = BALANCE_CHAIN_SQL.format(balance=models.Balance._meta.db_table)
+    params = {"start": balance_id, "limit": limit}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if not row:
+        return None
+
+    value, path, persons = row
+    balance_ids = [int(i) for i in path.split(",")]
+    person_ids = [int(i) for i in persons.split(",")]
+    legs = list(zip(balance_ids, person_ids, person_ids[1:]))
+    return legs, value
+
+
+def get_updated_balance_ids(currency, since):
+    """Get the ids of balances in a currency updated after `since`."""
+    return set(
+        models.Balance.objects.filter(
+            currency=currency, time_updated__gt=since
+        ).values_list("id", flat=True)
+    )
+
+
+def get_watermark(name):
+    """Get the time stored for a job watermark, or None if it was never set."""
+    return (
+        models.Watermark.objects.filter(name=name)
+        .values_list("time", flat=True)
+        .first()
+    )
+
+
+def set_watermark(name, time):
+    """Store the time for a job watermark."""
+    models.Watermark.objects.update_or_create(name=name, defaults={"time": time})
+
+
 def get_pending_trans_for_user(user):
     """Get pending transactions for a user which were
     created by some other user, and need to be accepted.
     """
     return models.TransactionRecord.objects.filter(
         target_person=user.person, transaction__isnull=True, rejected=False
-    )
+    ).select_related("creator_person__user", "currency")
 
 
 def get_recent_trans_for_user(user, days=10, limit=15, pending_only=False):
     """Get recent transaction records for the user.  These transaction records
     may be confirmed.
     """
-    earliest_day = datetime.date.today() - datetime.timedelta(days)
+    earliest_day = timezone.now() - datetime.timedelta(days)
     q = models.TransactionRecord.objects.filter(
         creator_person=user.person, time_created__gte=earliest_day
-    )
+    ).select_related("target_person__user", "currency", "transaction")
 
     if pending_only:
         q = q.filter(transaction__isnull=True)
@@ -70,17 +259,18 @@ def get_recent_trans_for_user(user, days=10, limit=15, pending_only=False):
 
 def get_exchange_rates(user):
     """Get exchange rates for the user."""
-    return models.ExchangeRate.objects.filter(person=user.person)
+    return models.ExchangeRate.objects.filter(person=user.person).select_related(
+        "source_currency", "dest_currency"
+    )
 
 
-# TODO: tests
-def get_transfer_history(user, filters):
-    """Get a list of all transactions and resolutions for the user filtered
-    by form filters.
+def get_transfer_queries(user, filters):
+    """Build the querysets of transaction records and person resolutions for
+    the user filtered by form filters. Either is None when it's filtered out
+    by the transfer type.
     """
-    query_sets = []
     resolution_query, trans_query = [], []
-    now = datetime.datetime.now()
+    now = timezone.now()
 
     def conv(key, trans, resolution, coerce_val=None):
         """Helper to setup filters for both tables."""
@@ -124,27 +314,141 @@ def get_transfer_history(user, filters):
         lambda d: now - datetime.timedelta(days=d),
     )
 
-    # Query Transactions
+    trans_records = resolutions = None
     if not transfer_type or transfer_type == "transaction":
-        query_sets.append(
-            models.TransactionRecord.objects.filter(
-                creator_person=user.person, **dict(trans_query)
-            )
+        trans_records = models.TransactionRecord.objects.filter(
+            creator_person=user.person, **dict(trans_query)
         )
-
-    # Query Resolutions
     if not transfer_type or transfer_type == "resolution":
-        query_sets.append(
-            models.PersonResolution.objects.filter(
-                person=user.person, **dict(resolution_query)
-            )
+        resolutions = models.PersonResolution.objects.filter(
+            person=user.person, **dict(resolution_query)
         )
+    return trans_records, resolutions
+
+
+# Kinds of transfer in the history, the tie breaker after time
+TRANSFER_TRANSACTION, TRANSFER_RESOLUTION = 0, 1
+
+
+def get_transfer_history_page(user, filters, cursor=None, limit=50):
+    """Get a page of transactions and resolutions for the user filtered by
+    form filters, newest first.
 
-    # Merge results
-    return sorted(
-        itertools.chain.from_iterable(query_sets),
-        key=operator.attrgetter("transaction_time"),
-        reverse=True,
+    Both tables are merged by a single UNION ALL query, which is sorted and
+    limited by the database on (time, kind, id). `cursor` is the
+    (time, kind, id) of the last transfer on the previous page. Returns the
+    list of transfers and the cursor for the next page, or None if this is
+    the last page.
+    """
+    trans_records, resolutions = get_transfer_queries(user, filters)
+    branches = []
+    for kind, queryset, time_field in (
+        (TRANSFER_TRANSACTION, trans_records, "transaction_time"),
+        (TRANSFER_RESOLUTION, resolutions, "resolution__time_confirmed"),
+    ):
+        if queryset is None:
+            continue
+        if cursor is not None:
+            queryset = queryset.filter(after_cursor_q(time_field, kind, cursor))
+        branches.append(
+            queryset.annotate(time=F(time_field), kind=Value(kind))
+            .order_by()
+            .values_list("time", "kind", "id")
+        )
+    if not branches:
+        return [], None
+
+    rows = branches[0]
+    if len(branches) > 1:
+        rows = rows.union(*branches[1:], all=True)
+    rows = list(rows.order_by("-time", "-kind", "-id")[: limit + 1])
+    next_cursor = rows[limit - 1] if len(rows) > limit else None
+    return load_transfers(rows[:limit]), next_cursor
+
+
+def after_cursor_q(time_field, kind, cursor):
+    """Filter transfers of one kind which sort after the cursor, in
+    descending (time, kind, id) order.
+    """
+    time, cursor_kind, cursor_id = cursor
+    if kind < cursor_kind:
+        return Q(**{time_field + "__lte": time})
+    if kind > cursor_kind:
+        return Q(**{time_field + "__lt": time})
+    return Q(**{time_field + "__lt": time}) | Q(
+        **{time_field: time, "id__lt": cursor_id}
+    )
+
+
+def with_resolution_persons(q):
+    """Prefetch both sides of each resolution, so
+    PersonResolution.other_person doesn't query for every row.
+    """
+    return q.prefetch_related(
+        Prefetch(
+            "resolution__personresolution_set",
+            queryset=models.PersonResolution.objects.select_related("person__user"),
+        )
+    )
+
+
+def load_transfers(rows):
+    """Load the transaction records and person resolutions for a list of
+    (time, kind, id) rows, in the same order.
+    """
+    ids = collections.defaultdict(list)
+    for _, kind, transfer_id in rows:
+        ids[kind].append(transfer_id)
+    loaded = {
+        TRANSFER_TRANSACTION: models.TransactionRecord.objects.select_related(
+            "currency", "transaction", "target_person__user"
+        ).in_bulk(ids[TRANSFER_TRANSACTION]),
+        TRANSFER_RESOLUTION: with_resolution_persons(
+            models.PersonResolution.objects.select_related("resolution__currency")
+        ).in_bulk(ids[TRANSFER_RESOLUTION]),
+    }
+    return [loaded[kind][transfer_id] for _, kind, transfer_id in rows]
+
+
+def encode_history_cursor(cursor):
+    """Encode a history cursor for use in a url."""
+    time, kind, transfer_id = cursor
+    return "%s_%s_%s" % (time.isoformat(), kind, transfer_id)
+
+
+def decode_history_cursor(value):
+    """Decode a cursor from `encode_history_cursor`, or None if it isn't
+    valid.
+    """
+    try:
+        time, kind, transfer_id = value.rsplit("_", 2)
+        return datetime.datetime.fromisoformat(time), int(kind), int(transfer_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_transfer_history(user, filters, page_size=500):
+    """Yield all transactions and resolutions for the user filtered by form
+    filters, newest first, one page at a time.
+    """
+    cursor = None
+    while True:
+        transfers, cursor = get_transfer_history_page(user, filters, cursor, page_size)
+        for transfer in transfers:
+            yield transfer
+        if cursor is None:
+            return
+
+
+def get_pending_trans_records_for_user(trans_record_ids, user):
+    """Get the records from a list of ids which are targeted at the user and
+    still pending.
+    """
+    return models.TransactionRecord.objects.filter(
+        id__in=trans_record_ids,
+        target_person=user.person,
+        transaction__isnull=True,
+        rejected=False,
     )
 
 
@@ -157,77 +461,1017 @@ def get_trans_record_for_user(trans_record_id, user):
 
 @transaction.atomic
 def reject_trans_record(trans_record_id, user):
-    """Reject a transaction record where the user is the target."""
+    """Reject a transaction record where the user is the target. Raises
+    ValueError if the record was confirmed in the meantime.
+    """
     trans_record = get_trans_record_for_user(trans_record_id, user)
+    rejected = models.TransactionRecord.objects.filter(
+        id=trans_record.id, transaction__isnull=True, rejected=False
+    ).update(rejected=True)
+    if not rejected:
+        raise ValueError(
+            "Transaction record %s is already confirmed." % trans_record.id
+        )
     trans_record.rejected = True
-    trans_record.save()
 
 
 @transaction.atomic
 def confirm_trans_record(trans_record):
-    """Confirm a transaction record."""
+    """Confirm a transaction record.
+
+    The record is claimed by a conditional UPDATE before anything else is
+    written, so concurrent requests can only confirm it once. Raises
+    ValueError if it was already confirmed or rejected, and
+    CreditLimitExceeded if the provider would go below their credit limit.
+    """
+    new_transaction = models.Transaction.objects.create()
+    claimed = models.TransactionRecord.objects.filter(
+        id=trans_record.id, transaction__isnull=True, rejected=False
+    ).update(transaction=new_transaction)
+    if not claimed:
+        raise ValueError(
+            "Transaction record %s is already confirmed or rejected." % trans_record.id
+        )
+    trans_record.transaction = new_transaction
+
     # Build and save matching record
-    confirm_record = models.TransactionRecord(
+    models.TransactionRecord.objects.create(
         creator_person=trans_record.target_person,
         target_person=trans_record.creator_person,
         from_receiver=not trans_record.from_receiver,
         currency=trans_record.currency,
         transaction_time=trans_record.transaction_time,
         value=trans_record.value,
+        transaction=new_transaction,
     )
-    transaction = models.Transaction()
-    transaction.save()
-
-    confirm_record.transaction_id = trans_record.transaction_id = transaction.id
-    confirm_record.save()
-    trans_record.save()
 
     # Update the balance, or create a new one
-    update_balance(trans_record, trans_record.provider, trans_record.receiver)
+    update_balance(
+        trans_record,
+        trans_record.provider,
+        trans_record.receiver,
+        check_limits=True,
+    )
+
+    if settings.RESOLVE_ON_CONFIRM:
+        transaction.on_commit(
+            functools.partial(
+                resolve_pair,
+                trans_record.provider,
+                trans_record.receiver,
+                trans_record.currency_id,
+            )
+        )
+
+
+@transaction.atomic
+def confirm_trans_records(trans_record_ids, user):
+    """Confirm the pending records in a list of ids which are targeted at the
+    user, in a single transaction. Returns the records confirmed.
+
+    Every record is claimed by one conditional UPDATE, as in
+    `confirm_trans_record`, and the values are summed per balance so each
+    balance is written once. Raises ValueError, and confirms nothing, if any
+    record was confirmed or rejected concurrently, or CreditLimitExceeded if
+    any provider would go below their credit limit.
+    """
+    trans_records = list(get_pending_trans_records_for_user(trans_record_ids, user))
+    if not trans_records:
+        return []
+
+    transactions = models.Transaction.objects.bulk_create(
+        models.Transaction() for _ in trans_records
+    )
+    claimed = models.TransactionRecord.objects.filter(
+        id__in=[r.id for r in trans_records],
+        transaction__isnull=True,
+        rejected=False,
+    ).update(
+        transaction=Case(
+            *(
+                When(id=trans_record.id, then=Value(new_transaction.id))
+                for trans_record, new_transaction in zip(trans_records, transactions)
+            )
+        )
+    )
+    if claimed != len(trans_records):
+        raise ValueError("Transaction records were confirmed or rejected concurrently.")
+
+    confirm_records = []
+    deltas = {}
+    for trans_record, new_transaction in zip(trans_records, transactions):
+        trans_record.transaction = new_transaction
+        confirm_records.append(
+            models.TransactionRecord(
+                creator_person_id=trans_record.target_person_id,
+                target_person_id=trans_record.creator_person_id,
+                from_receiver=not trans_record.from_receiver,
+                currency_id=trans_record.currency_id,
+                transaction_time=trans_record.transaction_time,
+                value=trans_record.value,
+                transaction=new_transaction,
+            )
+        )
+        provider, receiver = (
+            trans_record.creator_person_id,
+            trans_record.target_person_id,
+        )
+        if trans_record.from_receiver:
+            provider, receiver = receiver, provider
+        persona_id, personb_id, delta = balance_delta(
+            provider, receiver, trans_record.value
+        )
+        key = persona_id, personb_id, trans_record.currency_id
+        deltas[key] = deltas.get(key, 0) + delta
+    models.TransactionRecord.objects.bulk_create(confirm_records)
+    apply_pair_deltas(deltas, check_limits=True)
+
+    if settings.RESOLVE_ON_CONFIRM:
+        for persona_id, personb_id, currency_id in deltas:
+            transaction.on_commit(
+                functools.partial(resolve_pair, persona_id, personb_id, currency_id)
+            )
+    return trans_records
+
+
+def reject_trans_records(trans_record_ids, user):
+    """Reject the pending records in a list of ids which are targeted at the
+    user. Returns the number of records rejected.
+    """
+    return get_pending_trans_records_for_user(trans_record_ids, user).update(
+        rejected=True
+    )
 
 
-# TODO: tests!
-def update_balance(currency_type, provider, receiver):
+@transaction.atomic(savepoint=False)
+def update_balance(currency_type, provider, receiver, check_limits=False):
     """Update or create a balance between two users for a currency. Should be
     called from a method that was already created a transfer.
+
+    An existing balance is changed by a single UPDATE, so concurrent
+    transfers between the same persons can't overwrite each other. If
+    `check_limits` is set, raises CreditLimitExceeded when the provider
+    goes below their credit limit, see `apply_position_deltas`.
+    """
+    persona_id, personb_id, delta = balance_delta(
+        provider, receiver, currency_type.value
+    )
+    updated = models.Balance.objects.filter(
+        persona_id=persona_id,
+        personb_id=personb_id,
+        currency_id=currency_type.currency_id,
+    ).update(value=F("value") + delta, time_updated=timezone.now())
+    if not updated:
+        create_balance(
+            persona_id, personb_id, currency_type.currency_id, delta, check_limits
+        )
+        return
+
+    position_deltas = {}
+    add_position_deltas(
+        position_deltas, persona_id, personb_id, currency_type.currency_id, delta
+    )
+    apply_position_deltas(position_deltas, check_limits)
+
+
+def new_balance(currency_type, provider, receiver):
+    """Create the balance between two users for a currency, starting from
+    the value of a transfer.
+    """
+    persona_id, personb_id, value = balance_delta(
+        provider, receiver, currency_type.value
+    )
+    return create_balance(persona_id, personb_id, currency_type.currency_id, value)
+
+
+@transaction.atomic(savepoint=False)
+def create_balance(persona_id, personb_id, currency_id, value, check_limits=False):
+    """Create the balance for a pair of persons with a signed value, or add
+    the value to it if it was created concurrently. The positions of both
+    persons are created if required, and updated.
     """
     try:
-        balance = get_balance(provider, receiver, currency=currency_type.currency)
-    except ObjectDoesNotExist:
-        return new_balance(currency_type, provider, receiver)
-
-    # Establish the direction of the transfer
-    if provider == balance.debted:
-        balance.value += currency_type.value
-        balance.save()
-        return balance
-
-    balance.value -= currency_type.value
-    if (balance.value) < 0:
-        balance.value = abs(balance.value)
-        for personbalance in balance.personbalance_set.all():
-            personbalance.credited = not personbalance.credited
-            personbalance.save()
-
-    balance.save()
-    # TODO: does this cascade to the personbalance ?
+        with transaction.atomic():
+            balance = models.Balance.objects.create(
+                persona_id=persona_id,
+                personb_id=personb_id,
+                currency_id=currency_id,
+                value=value,
+            )
+            models.PersonBalance.objects.bulk_create(
+                [
+                    models.PersonBalance(person_id=persona_id, balance=balance),
+                    models.PersonBalance(person_id=personb_id, balance=balance),
+                ]
+            )
+            models.Position.objects.bulk_create(
+                [
+                    models.Position(person_id=persona_id, currency_id=currency_id),
+                    models.Position(person_id=personb_id, currency_id=currency_id),
+                ],
+                ignore_conflicts=True,
+            )
+    except IntegrityError:
+        # Created by a concurrent transfer since the balance was looked up
+        balance = get_balance(persona_id, personb_id, currency_id)
+        models.Balance.objects.filter(id=balance.id).update(
+            value=F("value") + value, time_updated=timezone.now()
+        )
+        balance.refresh_from_db()
+
+    position_deltas = {}
+    add_position_deltas(position_deltas, persona_id, personb_id, currency_id, value)
+    apply_position_deltas(position_deltas, check_limits)
     return balance
 
 
-# TODO: tests
-def new_balance(currency_type, provider, receiver):
-    balance = models.Balance(currency=currency_type.currency, value=currency_type.value)
-    balance.save()
-    personbalancea = models.PersonBalance(
-        person=provider, credited=False, balance=balance
+@transaction.atomic(savepoint=False)
+def apply_pair_deltas(deltas, check_limits=False):
+    """Add signed deltas to the balances of pairs of persons, creating any
+    which don't exist yet. `deltas` is a map of
+    (persona_id, personb_id, currency_id) -> delta. Existing balances are
+    written by a single update per currency, however many transfers were
+    summed into each delta.
+    """
+    if not deltas:
+        return
+    pairs = functools.reduce(
+        operator.or_,
+        (
+            Q(persona_id=persona_id, personb_id=personb_id, currency_id=currency_id)
+            for persona_id, personb_id, currency_id in deltas
+        ),
     )
-    personbalanceb = models.PersonBalance(
-        person=receiver, credited=True, balance=balance
+    existing = dict(
+        ((persona_id, personb_id, currency_id), balance_id)
+        for balance_id, persona_id, personb_id, currency_id in models.Balance.objects.filter(
+            pairs
+        ).values_list(
+            "id", "persona_id", "personb_id", "currency_id"
+        )
     )
-    personbalancea.save()
-    personbalanceb.save()
-    balance.save()
-    return balance
+    balance_deltas, position_deltas = {}, {}
+    for key, delta in deltas.items():
+        if key not in existing:
+            create_balance(*key, value=delta, check_limits=check_limits)
+            continue
+        balance_deltas.setdefault(key[2], {})[existing[key]] = delta
+        add_position_deltas(position_deltas, *key, delta=delta)
+    apply_balance_deltas(balance_deltas)
+    apply_position_deltas(position_deltas, check_limits)
+
+
+@transaction.atomic(savepoint=False)
+def apply_pair_deltas_in_bulk(deltas, batch_size=500):
+    """Add signed deltas to the balances of pairs of persons, as
+    `apply_pair_deltas` does, for maps with many pairs such as a whole
+    import. Balances are looked up and updated a batch of pairs at a time,
+    and missing balances and positions are created with bulk inserts.
+
+    A balance created concurrently is not retried, its IntegrityError rolls
+    back the transaction.
+    """
+    keys = sorted(deltas)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start : start + batch_size]
+        balances = models.Balance.objects.filter(
+            persona_id__in=set(k[0] for k in batch),
+            personb_id__in=set(k[1] for k in batch),
+            currency_id__in=set(k[2] for k in batch),
+        ).values_list("id", "persona_id", "personb_id", "currency_id")
+        existing = dict((tuple(row[1:]), row[0]) for row in balances)
+        balance_deltas, position_deltas, new_balances = {}, {}, []
+        for key in batch:
+            delta = deltas[key]
+            add_position_deltas(position_deltas, *key, delta=delta)
+            if key in existing:
+                balance_deltas.setdefault(key[2], {})[existing[key]] = delta
+                continue
+            new_balances.append(
+                models.Balance(
+                    persona_id=key[0],
+                    personb_id=key[1],
+                    currency_id=key[2],
+                    value=delta,
+                )
+            )
+        new_balances = models.Balance.objects.bulk_create(new_balances)
+        models.PersonBalance.objects.bulk_create(
+            models.PersonBalance(person_id=person_id, balance=balance)
+            for balance in new_balances
+            for person_id in (balance.persona_id, balance.personb_id)
+        )
+        models.Position.objects.bulk_create(
+            (
+                models.Position(person_id=person_id, currency_id=currency_id)
+                for currency_id, person_deltas in position_deltas.items()
+                for person_id in person_deltas
+            ),
+            ignore_conflicts=True,
+        )
+        apply_balance_deltas(balance_deltas)
+        apply_position_deltas(position_deltas)
+
+
+def apply_balance_deltas(deltas):
+    """Add signed deltas to balances with a single executemany. `deltas` is
+    a map of currency_id -> {balance_id: delta}. Positions are not changed,
+    see `apply_position_deltas`.
+    """
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    sql = "UPDATE %s SET value = value + %%s, time_updated = %%s WHERE id = %%s" % (
+        connection.ops.quote_name(models.Balance._meta.db_table)
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            sql,
+            [
+                (delta, now, balance_id)
+                for currency_deltas in deltas.values()
+                for balance_id, delta in currency_deltas.items()
+            ],
+        )
+
+
+def add_position_deltas(position_deltas, persona_id, personb_id, currency_id, delta):
+    """Add the change in net positions for a signed delta to the balance of
+    a pair of persons to `position_deltas`, a map of
+    currency_id -> {person_id: delta}.
+    """
+    person_deltas = position_deltas.setdefault(currency_id, {})
+    person_deltas[persona_id] = person_deltas.get(persona_id, 0) - delta
+    person_deltas[personb_id] = person_deltas.get(personb_id, 0) + delta
+
+
+def apply_position_deltas(position_deltas, check_limits=False):
+    """Add deltas to the net positions of persons with a set-based update
+    per currency. The positions already exist, they are created with the
+    first balance of a person in a currency.
+
+    If `check_limits` is set, positions which would go below their credit
+    limit are left out of the update, and CreditLimitExceeded is raised so
+    the transaction is rolled back.
+    """
+    now = timezone.now()
+    for currency_id, person_deltas in position_deltas.items():
+        person_deltas = dict((p, d) for p, d in person_deltas.items() if d)
+        if not person_deltas:
+            continue
+        positions = models.Position.objects.filter(
+            currency_id=currency_id, person_id__in=person_deltas
+        )
+        if check_limits:
+            positions = positions.alias(
+                limit=Coalesce(
+                    "credit_limit",
+                    models.Currency.objects.filter(id=currency_id).values(
+                        "credit_limit"
+                    ),
+                )
+            ).filter(within_limit_q(person_deltas))
+        updated = positions.update(
+            value=F("value")
+            + Case(
+                *(
+                    When(person_id=person_id, then=Value(delta))
+                    for person_id, delta in person_deltas.items()
+                )
+            ),
+            time_updated=now,
+        )
+        if check_limits and updated < len(person_deltas):
+            raise CreditLimitExceeded(
+                "The transfer would take a person below their credit limit."
+            )
+
+
+def within_limit_q(person_deltas):
+    """Filter positions which stay within their credit limit, annotated as
+    `limit`, after adding the deltas in a map of person_id -> delta.
+    """
+    q = Q(limit__isnull=True) | Q(
+        person_id__in=[p for p, delta in person_deltas.items() if delta > 0]
+    )
+    for person_id, delta in person_deltas.items():
+        if delta < 0:
+            q |= Q(person_id=person_id, value__gte=-F("limit") - delta)
+    return q
+
+
+def check_credit_limit(person, currency, value):
+    """Raise CreditLimitExceeded if paying `value` would take the net position
+    of a person in a currency below their credit limit. Costs a single
+    indexed read.
+    """
+    position = get_position(person, currency)
+    limit = position.credit_limit
+    if limit is None:
+        limit = currency.credit_limit
+    if limit is not None and position.value - value < -limit:
+        raise CreditLimitExceeded(
+            "%s would go below their credit limit of %s."
+            % (person, currency.value_repr(-limit))
+        )
+
+
+def get_position(person, currency):
+    """Get the net position of a person in a currency with a single indexed
+    lookup. Persons without a balance in the currency get an unsaved
+    position of 0.
+    """
+    position = models.Position.objects.filter(person=person, currency=currency).first()
+    if position is None:
+        position = models.Position(
+            person_id=getattr(person, "id", person),
+            currency_id=getattr(currency, "id", currency),
+        )
+    return position
+
+
+def get_positions(user):
+    """Get the net positions of a user in every currency they have used."""
+    return models.Position.objects.filter(person=user.person).select_related("currency")
+
+
+def compute_positions(currency=None):
+    """Sum the balances of every person into a map of
+    (person_id, currency_id) -> value, with one aggregate query for each
+    side of the balances.
+    """
+    balances = models.Balance.objects.order_by()
+    if currency is not None:
+        balances = balances.filter(currency=currency)
+    positions = collections.defaultdict(int)
+    for field, sign in (("persona_id", -1), ("personb_id", 1)):
+        rows = (
+            balances.values_list(field, "currency_id")
+            .annotate(total=Sum("value"))
+            .values_list(field, "currency_id", "total")
+        )
+        for person_id, currency_id, total in rows:
+            positions[person_id, currency_id] += sign * total
+    return positions
+
+
+@transaction.atomic
+def rebuild_positions(currency=None, batch_size=1000, dry_run=False):
+    """Rebuild the net positions of every person, or only those in one
+    currency, from the balances. Returns the number of positions which were
+    missing or wrong. With `dry_run` they are only counted.
+    """
+    positions = compute_positions(currency)
+    current = models.Position.objects.all()
+    if currency is not None:
+        current = current.filter(currency=currency)
+
+    changed = []
+    for position in current:
+        value = positions.pop((position.person_id, position.currency_id), 0)
+        if position.value != value:
+            position.value = value
+            changed.append(position)
+    if dry_run:
+        return len(changed) + len(positions)
+    models.Position.objects.bulk_update(changed, ["value"], batch_size=batch_size)
+    models.Position.objects.bulk_create(
+        (
+            models.Position(person_id=person_id, currency_id=currency_id, value=value)
+            for (person_id, currency_id), value in positions.items()
+        ),
+        batch_size=batch_size,
+    )
+    return len(changed) + len(positions)
+
+
+BALANCE_DIFF_SQL = """
+WITH transfers(provider_id, receiver_id, value) AS (
+    SELECT creator_person_id, target_person_id, value
+    FROM {record}
+    WHERE currency_id = %(currency)s
+      AND transaction_id IS NOT NULL
+      AND from_receiver = %(false)s
+    UNION ALL
+    SELECT provider.person_id, receiver.person_id, r.value
+    FROM {resolution} r
+    JOIN {person_resolution} provider
+        ON provider.resolution_id = r.id AND provider.credited = %(false)s
+    JOIN {person_resolution} receiver
+        ON receiver.resolution_id = r.id AND receiver.credited = %(true)s
+    WHERE r.currency_id = %(currency)s
+),
+pairs(persona_id, personb_id, expected, balance_id, stored) AS (
+    SELECT
+        CASE WHEN provider_id < receiver_id THEN provider_id ELSE receiver_id END,
+        CASE WHEN provider_id < receiver_id THEN receiver_id ELSE provider_id END,
+        CASE WHEN provider_id < receiver_id THEN value ELSE -value END,
+        NULL,
+        0
+    FROM transfers
+    UNION ALL
+    SELECT persona_id, personb_id, 0, id, value
+    FROM {balance}
+    WHERE currency_id = %(currency)s
+)
+SELECT
+    persona_id,
+    personb_id,
+    SUM(expected),
+    MAX(balance_id),
+    CASE WHEN MAX(balance_id) IS NULL THEN NULL ELSE SUM(stored) END
+FROM pairs
+GROUP BY persona_id, personb_id
+HAVING SUM(expected) <> SUM(stored)
+"""
+
+
+def diff_balances(currency_id):
+    """Sum the confirmed transactions and resolutions of a currency into the
+    balance of each pair of persons, and compare them with the stored
+    balances, all in one query. Returns a list of
+    (persona_id, personb_id, expected value, balance_id, stored value) for
+    the balances which differ. balance_id and the stored value are None for
+    balances which are missing.
+    """
+    sql = BALANCE_DIFF_SQL.format(
+        record=models.TransactionRecord._meta.db_table,
+        resolution=models.Resolution._meta.db_table,
+        person_resolution=models.PersonResolution._meta.db_table,
+        balance=models.Balance._meta.db_table,
+    )
+    params = {"currency": currency_id, "false": False, "true": True}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+@transaction.atomic
+def repair_balances(currency_id, batch_size=500):
+    """Set the balances of a currency which differ from their transactions
+    and resolutions to the value summed from them, create those which are
+    missing, and rebuild the positions of the currency. Returns the
+    differences found, as `diff_balances`, and the number of positions
+    fixed.
+    """
+    differences = diff_balances(currency_id)
+    wrong = [d for d in differences if d[3] is not None]
+    now = timezone.now()
+    for start in range(0, len(wrong), batch_size):
+        batch = wrong[start : start + batch_size]
+        models.Balance.objects.filter(id__in=[d[3] for d in batch]).update(
+            value=Case(
+                *(
+                    When(id=balance_id, then=Value(value))
+                    for _, _, value, balance_id, _ in batch
+                )
+            ),
+            time_updated=now,
+        )
+    balances = models.Balance.objects.bulk_create(
+        (
+            models.Balance(
+                persona_id=persona_id,
+                personb_id=personb_id,
+                currency_id=currency_id,
+                value=value,
+            )
+            for persona_id, personb_id, value, balance_id, _ in differences
+            if balance_id is None
+        ),
+        batch_size=batch_size,
+    )
+    models.PersonBalance.objects.bulk_create(
+        (
+            models.PersonBalance(person_id=person_id, balance=balance)
+            for balance in balances
+            for person_id in (balance.persona_id, balance.personb_id)
+        ),
+        batch_size=batch_size,
+    )
+    return differences, rebuild_positions(currency_id)
+
+
+SNAPSHOT_DELTA_SQL = """
+WITH transfers(provider_id, receiver_id, currency_id, value) AS (
+    SELECT r.creator_person_id, r.target_person_id, r.currency_id, r.value
+    FROM {record} r
+    JOIN {transaction} t ON t.id = r.transaction_id
+    WHERE r.from_receiver = %(false)s
+      AND t.time_confirmed > %(since)s
+      AND t.time_confirmed <= %(until)s
+    UNION ALL
+    SELECT provider.person_id, receiver.person_id, r.currency_id, r.value
+    FROM {resolution} r
+    JOIN {person_resolution} provider
+        ON provider.resolution_id = r.id AND provider.credited = %(false)s
+    JOIN {person_resolution} receiver
+        ON receiver.resolution_id = r.id AND receiver.credited = %(true)s
+    WHERE r.time_confirmed > %(since)s AND r.time_confirmed <= %(until)s
+)
+SELECT
+    CASE WHEN provider_id < receiver_id THEN provider_id ELSE receiver_id END,
+    CASE WHEN provider_id < receiver_id THEN receiver_id ELSE provider_id END,
+    currency_id,
+    SUM(CASE WHEN provider_id < receiver_id THEN value ELSE -value END)
+FROM transfers
+GROUP BY 1, 2, 3
+"""
+
+
+def get_snapshot(time):
+    """Get the latest balance snapshot taken at or before `time`, or None."""
+    return (
+        models.BalanceSnapshot.objects.filter(time__lte=time).order_by("-time").first()
+    )
+
+
+def get_snapshot_deltas(since, until):
+    """Sum the transactions and resolutions confirmed after `since`, or from
+    the start when it is None, up to and including `until` into a map of
+    (persona_id, personb_id, currency_id) -> delta, with one query.
+    """
+    sql = SNAPSHOT_DELTA_SQL.format(
+        record=models.TransactionRecord._meta.db_table,
+        transaction=models.Transaction._meta.db_table,
+        resolution=models.Resolution._meta.db_table,
+        person_resolution=models.PersonResolution._meta.db_table,
+    )
+    if since is None:
+        since = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    params = {
+        "since": connection.ops.adapt_datetimefield_value(since),
+        "until": connection.ops.adapt_datetimefield_value(until),
+        "false": False,
+        "true": True,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(((a, b, c), delta) for a, b, c, delta in cursor.fetchall())
+
+
+@transaction.atomic
+def take_balance_snapshot(time=None, batch_size=2000):
+    """Snapshot the balances of every pair of persons and the positions of
+    every person at `time`, by default now. The balances are those of the
+    snapshot before it plus the transfers confirmed since, so a snapshot
+    costs the transfers since the last one rather than the whole history,
+    and a snapshot in the past can be taken from the same history.
+    Returns the BalanceSnapshot and the number of pairs which changed.
+    """
+    # Taken inside the transaction, which holds the write lock, so every
+    # transfer confirmed at or before it is already committed
+    time = time or timezone.now()
+    if models.BalanceSnapshot.objects.filter(time=time).exists():
+        raise ValueError("There is already a balance snapshot at %s." % time)
+    previous = get_snapshot(time)
+    balances = {}
+    if previous is not None:
+        balances.update(
+            ((a, b, c), value)
+            for a, b, c, value in previous.balances.values_list(
+                "persona_id", "personb_id", "currency_id", "value"
+            ).iterator(chunk_size=batch_size)
+        )
+    deltas = get_snapshot_deltas(previous and previous.time, time)
+    for key, delta in deltas.items():
+        balances[key] = balances.get(key, 0) + delta
+
+    positions = collections.defaultdict(int)
+    for (persona_id, personb_id, currency_id), value in balances.items():
+        positions[persona_id, currency_id] -= value
+        positions[personb_id, currency_id] += value
+
+    snapshot = models.BalanceSnapshot.objects.create(time=time)
+    models.SnapshotBalance.objects.bulk_create(
+        (
+            models.SnapshotBalance(
+                snapshot=snapshot,
+                persona_id=persona_id,
+                personb_id=personb_id,
+                currency_id=currency_id,
+                value=value,
+            )
+            for (persona_id, personb_id, currency_id), value in balances.items()
+            if value
+        ),
+        batch_size=batch_size,
+    )
+    models.SnapshotPosition.objects.bulk_create(
+        (
+            models.SnapshotPosition(
+                snapshot=snapshot,
+                person_id=person_id,
+                currency_id=currency_id,
+                value=value,
+            )
+            for (person_id, currency_id), value in positions.items()
+            if value
+        ),
+        batch_size=batch_size,
+    )
+    return snapshot, len(deltas)
+
+
+def delete_snapshots_since(time):
+    """Delete the balance snapshots taken at or after `time`, which no longer
+    hold the balances at their time once transfers confirmed from `time` on
+    are added. Returns the number of snapshots deleted.
+    """
+    _, deleted = models.BalanceSnapshot.objects.filter(time__gte=time).delete()
+    return deleted.get(models.BalanceSnapshot._meta.label, 0)
+
+
+def get_position_delta(person, currency, since, until, other=None):
+    """Sum the change to the position of a person in a currency from the
+    transfers confirmed after `since`, or from the start when it is None, up
+    to and including `until`. With `other` only the transfers with that
+    person are summed. The person's own transaction records and resolutions
+    are read through their indexes, with one aggregate query for each.
+    """
+    records = models.TransactionRecord.objects.filter(
+        creator_person=person,
+        currency=currency,
+        transaction__time_confirmed__lte=until,
+    )
+    resolutions = models.PersonResolution.objects.filter(
+        person=person,
+        resolution__currency=currency,
+        resolution__time_confirmed__lte=until,
+    )
+    if since is not None:
+        records = records.filter(transaction__time_confirmed__gt=since)
+        resolutions = resolutions.filter(resolution__time_confirmed__gt=since)
+    if other is not None:
+        records = records.filter(target_person=other)
+        resolutions = resolutions.filter(resolution__personresolution__person=other)
+
+    # The provider of a transfer loses its value and the receiver gains it
+    records = records.aggregate(
+        total=Sum(Case(When(from_receiver=True, then=F("value")), default=-F("value")))
+    )
+    resolutions = resolutions.aggregate(
+        total=Sum(
+            Case(
+                When(credited=True, then=F("resolution__value")),
+                default=-F("resolution__value"),
+            )
+        )
+    )
+    return (records["total"] or 0) + (resolutions["total"] or 0)
+
+
+def get_balance_as_of(persona, personb, currency, time):
+    """Get the value of the balance between two persons at `time`, signed as
+    `Balance.value` for the pair. Starts from the latest snapshot before
+    `time` and adds only the transfers between the two since.
+    """
+    persona_id, personb_id = balance_pair(persona, personb)
+    currency_id = getattr(currency, "id", currency)
+    snapshot = get_snapshot(time)
+    value = 0
+    if snapshot is not None:
+        value = (
+            snapshot.balances.filter(
+                persona_id=persona_id, personb_id=personb_id, currency_id=currency_id
+            )
+            .values_list("value", flat=True)
+            .first()
+            or 0
+        )
+    # The balance value is the opposite of persona's side of it
+    return value - get_position_delta(
+        persona_id, currency_id, snapshot and snapshot.time, time, other=personb_id
+    )
+
+
+def get_position_as_of(person, currency, time):
+    """Get the net position of a person in a currency at `time`. Starts from
+    the latest snapshot before `time` and adds only the person's transfers
+    since.
+    """
+    person_id = getattr(person, "id", person)
+    currency_id = getattr(currency, "id", currency)
+    snapshot = get_snapshot(time)
+    value = 0
+    if snapshot is not None:
+        value = (
+            snapshot.positions.filter(person_id=person_id, currency_id=currency_id)
+            .values_list("value", flat=True)
+            .first()
+            or 0
+        )
+    return value + get_position_delta(
+        person_id, currency_id, snapshot and snapshot.time, time
+    )
+
+
+def save_resolutions(resolutions, chunk_size=500):
+    """Save resolved chains of balances in bulk. `resolutions` is a sequence
+    of (currency_id, value, legs) where each leg is a
+    (balance_id, debted_id, credited_id) tuple, as built by the balance
+    resolver.
+
+    Every leg becomes a Resolution with two PersonResolutions. Legs are
+    written with `bulk_create` and the balances with a single executemany.
+    Chains are saved in chunks, each committed in its own transaction so
+    write locks are held briefly. A chunk holds whole chains and is closed
+    once it has `chunk_size` legs, so a chain is never split and positions
+    never change. Chains which no longer fit their balances are dropped, see
+    `fit_chains`. Returns the resolutions saved.
+    """
+    saved, chunk, legs = [], [], 0
+    for resolution in resolutions:
+        chunk.append(resolution)
+        legs += len(resolution[2])
+        if legs >= chunk_size:
+            saved.extend(_save_resolution_chunk(chunk))
+            chunk, legs = [], 0
+    if chunk:
+        saved.extend(_save_resolution_chunk(chunk))
+    return saved
+
+
+def fit_chains(chunk):
+    """Lock the balances of a chunk of chains, and check the debted person of
+    every leg still owes at least the value. The chains were found in
+    balances read earlier, which may have been resolved or changed since.
+    Returns whether each chain fits, in order, counting the chains before it
+    as resolved.
+    """
+    values = dict(
+        models.Balance.objects.select_for_update()
+        .filter(id__in=set(leg[0] for _, _, chain in chunk for leg in chain))
+        .values_list("id", "value")
+    )
+    fits = []
+    for currency_id, value, chain in chunk:
+        changed = {}
+        for balance_id, debted_id, credited_id in chain:
+            current = changed.get(balance_id, values.get(balance_id))
+            if current is None:
+                break
+            # Positive balances are owed by persona
+            owed = current if debted_id < credited_id else -current
+            if owed < value:
+                break
+            _, _, delta = balance_delta(credited_id, debted_id, value)
+            changed[balance_id] = current + delta
+        else:
+            values.update(changed)
+            fits.append(True)
+            continue
+        log.info(
+            "Dropped a chain of %s legs of currency %s, its balances changed"
+            % (len(chain), currency_id)
+        )
+        fits.append(False)
+    return fits
+
+
+def _resolution_rows(currency_id, value, chain):
+    """Build the unsaved Resolutions and PersonResolutions of a chain, and
+    the (balance_id, debted_id, credited_id, delta) change of every leg.
+    """
+    resolutions, person_resolutions, changes = [], [], []
+    for balance_id, debted_id, credited_id in chain:
+        resolution = models.Resolution(currency_id=currency_id, value=value)
+        resolutions.append(resolution)
+        person_resolutions.append(
+            models.PersonResolution(
+                resolution=resolution, person_id=debted_id, credited=True
+            )
+        )
+        person_resolutions.append(
+            models.PersonResolution(
+                resolution=resolution, person_id=credited_id, credited=False
+            )
+        )
+        # Resolving reduces the debt, the credited person is the provider
+        _, _, delta = balance_delta(credited_id, debted_id, value)
+        changes.append((balance_id, debted_id, credited_id, delta))
+    return resolutions, person_resolutions, changes
+
+
+def _save_resolution_chunk(chunk):
+    # The rows are built before the transaction, so it only holds its locks
+    # for the writes
+    rows = [_resolution_rows(*resolution) for resolution in chunk]
+    with transaction.atomic():
+        fits = fit_chains(chunk)
+        resolutions, person_resolutions = [], []
+        deltas, position_deltas = {}, {}
+        for (
+            (currency_id, _, _),
+            fit,
+            (chain_resolutions, chain_persons, changes),
+        ) in zip(chunk, fits, rows):
+            if not fit:
+                continue
+            resolutions.extend(chain_resolutions)
+            person_resolutions.extend(chain_persons)
+            currency_deltas = deltas.setdefault(currency_id, {})
+            for balance_id, debted_id, credited_id, delta in changes:
+                currency_deltas[balance_id] = currency_deltas.get(balance_id, 0) + delta
+                add_position_deltas(
+                    position_deltas,
+                    *balance_pair(debted_id, credited_id),
+                    currency_id,
+                    delta,
+                )
+        models.Resolution.objects.bulk_create(resolutions)
+        models.PersonResolution.objects.bulk_create(person_resolutions)
+        apply_balance_deltas(deltas)
+        # Every person on a chain pays as much as they get, so these are 0
+        # unless a chain is not a cycle
+        apply_position_deltas(position_deltas)
+    return [resolution for resolution, fit in zip(chunk, fits) if fit]
+
+
+@contextlib.contextmanager
+def query_deadline(deadline):
+    """Interrupt queries which are still running at `deadline`, a
+    `time.monotonic` value, and stop waiting for locks then. Interrupted
+    queries raise a DatabaseError.
+    """
+    connection.ensure_connection()
+    if connection.vendor == "sqlite":
+        # Lock waits are not interrupted by the progress handler, shorten
+        # them to the time left
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            busy_timeout = cursor.fetchone()[0]
+            milliseconds = max(1, int((deadline - time.monotonic()) * 1000))
+            cursor.execute("PRAGMA busy_timeout = %d" % milliseconds)
+        # Called every 1000 virtual machine instructions, non-zero aborts
+        connection.connection.set_progress_handler(
+            lambda: time.monotonic() > deadline, 1000
+        )
+        try:
+            yield
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA busy_timeout = %d" % busy_timeout)
+        return
+
+    if connection.vendor == "postgresql":
+        milliseconds = max(1, int((deadline - time.monotonic()) * 1000))
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %d" % milliseconds)
+            yield
+        return
+    yield
+
+
+def resolve_balance(balance_id, chain_limit=None, time_budget=None):
+    """Resolve chains of balances which run through a single balance, until
+    none are left or the time budget, in seconds, is used up. Called after a
+    transaction is confirmed when `settings.RESOLVE_ON_CONFIRM` is set, see
+    `resolve_pair`.
+
+    Searches and writes are interrupted at the deadline, and no chain is
+    written once it has passed. Returns the number of chains resolved.
+    """
+    if chain_limit is None:
+        chain_limit = settings.RESOLVE_ON_CONFIRM_CHAIN_LIMIT
+    if time_budget is None:
+        time_budget = settings.RESOLVE_ON_CONFIRM_TIME_BUDGET
+    deadline = time.monotonic() + time_budget
+
+    resolved = 0
+    try:
+        with query_deadline(deadline):
+            currency_id = (
+                models.Balance.objects.filter(id=balance_id)
+                .values_list("currency_id", flat=True)
+                .get()
+            )
+            while time.monotonic() < deadline:
+                chain = find_balance_chain(balance_id, chain_limit + 1)
+                if not chain or time.monotonic() >= deadline:
+                    break
+                legs, value = chain
+                if not save_resolutions([(currency_id, value, legs)]):
+                    break
+                resolved += 1
+    except DatabaseError as e:
+        log.info("Stopped resolving balance %s: %s" % (balance_id, e))
+    return resolved
+
+
+def resolve_pair(persona, personb, currency):
+    """Resolve chains through the balance between two persons, see
+    `resolve_balance`. Runs once the transfer is committed, so errors are
+    logged instead of failing the request which confirmed it.
+    """
+    try:
+        return resolve_balance(get_balance(persona, personb, currency).id)
+    except Exception:
+        log.exception(
+            "Resolving the balance of %s and %s failed"
+            % (getattr(persona, "id", persona), getattr(personb, "id", personb))
+        )
+        return 0
 
 
 def get_transaction_count(user):
@@ -237,16 +1481,18 @@ def get_transaction_count(user):
 
 def get_transaction_notifications(user, days=2):
     """Get recent transaction actions targetted at the user."""
-    now = datetime.datetime.now()
+    now = timezone.now()
     return models.TransactionRecord.objects.filter(
         target_person=user.person, time_created__gte=now - datetime.timedelta(days=days)
-    )
+    ).select_related("creator_person__user", "currency", "transaction")
 
 
 def get_recent_resolutions(user, days=2):
     """Get recent resolutions involsing the user."""
-    now = datetime.datetime.now()
-    return models.PersonResolution.objects.filter(
-        person=user.person,
-        resolution__time_confirmed__gte=now - datetime.timedelta(days=days),
+    now = timezone.now()
+    return with_resolution_persons(
+        models.PersonResolution.objects.filter(
+            person=user.person,
+            resolution__time_confirmed__gte=now - datetime.timedelta(days=days),
+        ).select_related("resolution__currency")
     )
@@ -0,0 +1,253 @@
+"""
+Export the whole ledger: transaction records, resolutions and balances.
+
+Rows are read in chunks ordered by id, with the related usernames and
+currencies joined in by the database, and encoded as they are read, so
+memory stays flat however large the ledger is. Each format is a generator
+of bytes, written to a file by the export_ledger command or streamed by
+the admin export view.
+
+Formats:
+    csv       A header line, then one line per row.
+    ndjson    One JSON object per line.
+    columnar  A compact binary format, stored by column in row groups:
+
+        b"OLCOL1\\n"
+        uint32 length, then a JSON header {"table": ..., "columns": [[name, type]]}
+        For each row group:
+            uint32 number of rows, 0 ends the file
+            For each column, uint32 length then the zlib compressed column:
+                one byte per row, 0 for null
+                int, bool and time columns: an int64 per row, times are
+                    microseconds since the epoch in UTC
+                str columns: a uint32 length per row, then the utf-8 values
+
+    All integers are little endian. `read_columnar` reads it back.
+"""
+
+import array
+import csv
+import datetime
+import io
+import json
+import struct
+import sys
+import zlib
+
+from core import models
+
+FORMATS = {"csv": "csv", "ndjson": "ndjson", "columnar": "olcol"}
+
+# Table name: (model, [(column, lookup, type)])
+TABLES = {
+    "transaction_records": (
+        models.TransactionRecord,
+        [
+            ("id", "id", "int"),
+            ("transaction_id", "transaction_id", "int"),
+            ("time_confirmed", "transaction__time_confirmed", "time"),
+            ("creator", "creator_person__user__username", "str"),
+            ("target", "target_person__user__username", "str"),
+            ("from_receiver", "from_receiver", "bool"),
+            ("rejected", "rejected", "bool"),
+            ("currency", "currency__name", "str"),
+            ("decimal_places", "currency__decimal_places", "int"),
+            ("value", "value", "int"),
+            ("transaction_time", "transaction_time", "time"),
+            ("time_created", "time_created", "time"),
+            ("notes", "notes", "str"),
+        ],
+    ),
+    "resolutions": (
+        models.PersonResolution,
+        [
+            ("id", "id", "int"),
+            ("resolution_id", "resolution_id", "int"),
+            ("person", "person__user__username", "str"),
+            ("credited", "credited", "bool"),
+            ("currency", "resolution__currency__name", "str"),
+            ("decimal_places", "resolution__currency__decimal_places", "int"),
+            ("value", "resolution__value", "int"),
+            ("time_confirmed", "resolution__time_confirmed", "time"),
+        ],
+    ),
+    "balances": (
+        models.Balance,
+        [
+            ("id", "id", "int"),
+            ("persona", "persona__user__username", "str"),
+            ("personb", "personb__user__username", "str"),
+            ("currency", "currency__name", "str"),
+            ("decimal_places", "currency__decimal_places", "int"),
+            ("value", "value", "int"),
+            ("time_updated", "time_updated", "time"),
+        ],
+    ),
+}
+
+COLUMNAR_MAGIC = b"OLCOL1\n"
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+INT64 = "q" if array.array("q").itemsize == 8 else "l"
+UINT32 = "I" if array.array("I").itemsize == 4 else "L"
+
+
+def read_chunks(table, chunk_size=10000, progress=None):
+    """Yield lists of rows of a table, as tuples of the column values in
+    id order. `progress` is called with (table, rows done, total rows).
+    """
+    model, columns = TABLES[table]
+    q = model.objects.order_by("id").values_list(*[c[1] for c in columns])
+    total = model.objects.count() if progress else 0
+    done, last_id = 0, 0
+    while True:
+        rows = list(q.filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        done += len(rows)
+        last_id = rows[-1][0]
+        if progress:
+            progress(table, done, total)
+
+
+def format_times(columns, rows):
+    """Yield the rows with their time columns as ISO 8601 text."""
+    times = [i for i, c in enumerate(columns) if c[2] == "time"]
+    for row in rows:
+        row = list(row)
+        for i in times:
+            if row[i] is not None:
+                row[i] = row[i].isoformat()
+        yield row
+
+
+def encode_csv(table, chunks):
+    columns = TABLES[table][1]
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow([c[0] for c in columns])
+    for rows in chunks:
+        writer.writerows(format_times(columns, rows))
+        yield output.getvalue().encode("utf-8")
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue().encode("utf-8")
+
+
+def encode_ndjson(table, chunks):
+    columns = TABLES[table][1]
+    names = [c[0] for c in columns]
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(names, row))) + "\n"
+            for row in format_times(columns, rows)
+        ).encode("utf-8")
+
+
+def pack_array(typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_array(typecode, data):
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def encode_column(values, kind):
+    """Encode one column of a row group."""
+    valid = bytes(0 if v is None else 1 for v in values)
+    if kind == "str":
+        encoded = [b"" if v is None else v.encode("utf-8") for v in values]
+        data = pack_array(UINT32, map(len, encoded)) + b"".join(encoded)
+    else:
+        if kind == "time":
+            values = [None if v is None else (v - EPOCH) // MICROSECOND for v in values]
+        data = pack_array(INT64, (0 if v is None else int(v) for v in values))
+    return zlib.compress(valid + data)
+
+
+def encode_columnar(table, chunks):
+    columns = TABLES[table][1]
+    header = json.dumps(
+        {"table": table, "columns": [[c[0], c[2]] for c in columns]}
+    ).encode("utf-8")
+    yield COLUMNAR_MAGIC + struct.pack("<I", len(header)) + header
+    for rows in chunks:
+        parts = [struct.pack("<I", len(rows))]
+        for i, (_, _, kind) in enumerate(columns):
+            column = encode_column([row[i] for row in rows], kind)
+            parts.append(struct.pack("<I", len(column)))
+            parts.append(column)
+        yield b"".join(parts)
+    yield struct.pack("<I", 0)
+
+
+def decode_column(data, kind, count):
+    data = zlib.decompress(data)
+    valid, data = data[:count], data[count:]
+    if kind == "str":
+        lengths = unpack_array(UINT32, data[: count * 4])
+        values, offset = [], count * 4
+        for length in lengths:
+            values.append(data[offset : offset + length].decode("utf-8"))
+            offset += length
+    else:
+        values = unpack_array(INT64, data)
+        if kind == "bool":
+            values = [bool(v) for v in values]
+        elif kind == "time":
+            values = [EPOCH + v * MICROSECOND for v in values]
+    return [v if is_valid else None for v, is_valid in zip(values, valid)]
+
+
+def read_columnar(stream):
+    """Read a file in the columnar format. Returns the header and an iterator
+    of row tuples.
+    """
+
+    def read(size):
+        data = stream.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated columnar file")
+        return data
+
+    if read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar ledger export")
+    header = json.loads(read(struct.unpack("<I", read(4))[0]))
+
+    def rows():
+        while True:
+            count = struct.unpack("<I", read(4))[0]
+            if not count:
+                return
+            columns = [
+                decode_column(read(struct.unpack("<I", read(4))[0]), kind, count)
+                for _, kind in header["columns"]
+            ]
+            for row in zip(*columns):
+                yield row
+
+    return header, rows()
+
+
+ENCODERS = {
+    "csv": encode_csv,
+    "ndjson": encode_ndjson,
+    "columnar": encode_columnar,
+}
+
+
+def export_table(table, format, chunk_size=10000, progress=None):
+    """Yield the bytes of a table exported in a format."""
+    if table not in TABLES:
+        raise ValueError("Unknown table %r" % table)
+    if format not in ENCODERS:
+        raise ValueError("Unknown format %r" % format)
+    return ENCODERS[format](table, read_chunks(table, chunk_size, progress))
@@ -0,0 +1,337 @@
+"""
+ In-memory debt graph used to find chains of balances which resolve.
+"""
+
+import heapq
+
+
+class DebtGraph(object):
+    """A directed graph of the non-zero balances in a single currency.
+
+    Persons are mapped to dense integer indexes, and every balance becomes an
+    edge from the debted person to the credited person.  Edges are kept in
+    parallel lists indexed by edge number, so a ledger of 100k balances can be
+    searched without touching the database.
+    """
+
+    def __init__(self, currency_id=None):
+        self.currency_id = currency_id
+        # Node index -> person id, and the reverse mapping
+        self.person_ids = []
+        self.index = {}
+        # Node index -> list of edge numbers
+        self.out_edges = []
+        self.in_edges = []
+        # Edge number -> balance id, debted node, credited node, value
+        self.balance_ids = []
+        self.sources = []
+        self.targets = []
+        self.values = []
+        # Balance ids to start searches from, or None to start from all
+        self.start_balance_ids = None
+
+    @classmethod
+    def from_edges(cls, edges, currency_id=None):
+        """Build a graph from (balance_id, debted_id, credited_id, value)
+        tuples, as returned by `db.get_debt_edges`.
+        """
+        graph = cls(currency_id)
+        for edge in edges:
+            graph.add_edge(*edge)
+        return graph
+
+    def __len__(self):
+        return len(self.values)
+
+    def node(self, person_id):
+        """Get the node index for a person, adding it if required."""
+        try:
+            return self.index[person_id]
+        except KeyError:
+            node = self.index[person_id] = len(self.person_ids)
+            self.person_ids.append(person_id)
+            self.out_edges.append([])
+            self.in_edges.append([])
+            return node
+
+    def add_edge(self, balance_id, debted_id, credited_id, value):
+        """Add a balance of `value` debted by one person to another."""
+        source, target = self.node(debted_id), self.node(credited_id)
+        edge = len(self.values)
+        self.balance_ids.append(balance_id)
+        self.sources.append(source)
+        self.targets.append(target)
+        self.values.append(value)
+        self.out_edges[source].append(edge)
+        self.in_edges[target].append(edge)
+        return edge
+
+    def edges(self):
+        """Get (balance_id, debted_id, credited_id, value) for every balance
+        with a value left, the inverse of `from_edges`.
+        """
+        return [
+            (
+                self.balance_ids[edge],
+                self.person_ids[self.sources[edge]],
+                self.person_ids[self.targets[edge]],
+                value,
+            )
+            for edge, value in enumerate(self.values)
+            if value > 0
+        ]
+
+    def components(self):
+        """Find the strongly connected components of the graph, ignoring
+        resolved balances. Returns a list of lists of node indexes.
+
+        Uses an iterative version of Tarjan's algorithm so large components
+        don't hit the recursion limit.
+        """
+        values, targets = self.values, self.targets
+        index = [None] * len(self.person_ids)
+        low = [0] * len(self.person_ids)
+        on_stack = [False] * len(self.person_ids)
+        stack, components = [], []
+        counter = 0
+
+        for root in range(len(self.person_ids)):
+            if index[root] is not None:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, 0)]
+
+            while work:
+                node, position = work[-1]
+                edges = self.out_edges[node]
+                if position < len(edges):
+                    work[-1] = (node, position + 1)
+                    edge = edges[position]
+                    if values[edge] <= 0:
+                        continue
+                    next_node = targets[edge]
+                    if index[next_node] is None:
+                        index[next_node] = low[next_node] = counter
+                        counter += 1
+                        stack.append(next_node)
+                        on_stack[next_node] = True
+                        work.append((next_node, 0))
+                    elif on_stack[next_node]:
+                        low[node] = min(low[node], index[next_node])
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+        return components
+
+    def split(self):
+        """Split the graph into one graph for each strongly connected
+        component with more than one person. Only balances between members
+        of the same component are kept, since no other balance can be part
+        of a cycle.
+        """
+        graphs = []
+        membership = [None] * len(self.person_ids)
+        for component in self.components():
+            if len(component) < 2:
+                continue
+            for node in component:
+                membership[node] = len(graphs)
+            graphs.append(DebtGraph(self.currency_id))
+
+        for edge, value in enumerate(self.values):
+            source, target = self.sources[edge], self.targets[edge]
+            member = membership[source]
+            if value <= 0 or member is None or member != membership[target]:
+                continue
+            graphs[member].add_edge(
+                self.balance_ids[edge],
+                self.person_ids[source],
+                self.person_ids[target],
+                value,
+            )
+        return graphs
+
+    def find_cycle(self, edge, limit):
+        """Find the shortest cycle which starts with `edge` and returns to the
+        debted person through at most `limit` other balances.
+
+        Searches forward from the credited person and backward from the
+        debted person at the same time, always growing the smaller frontier.
+        Returns a list of edge numbers, or None if there is no such cycle.
+        """
+        start, goal = self.targets[edge], self.sources[edge]
+        if self.values[edge] <= 0 or start == goal:
+            return None
+
+        forward, backward = {start: None}, {goal: None}
+        forward_frontier, backward_frontier = [start], [goal]
+        depth = 0
+        while forward_frontier and backward_frontier and depth < limit:
+            depth += 1
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meet = self._expand(
+                    forward_frontier, forward, backward, self.out_edges, self.targets
+                )
+            else:
+                backward_frontier, meet = self._expand(
+                    backward_frontier, backward, forward, self.in_edges, self.sources
+                )
+            if meet is not None:
+                return [edge] + self._join_path(meet, forward, backward)
+        return None
+
+    def _expand(self, frontier, seen, other, adjacency, ends):
+        """Expand a search frontier by one level. Returns the new frontier
+        and the node where it met the other search, if any.
+        """
+        values = self.values
+        next_frontier = []
+        for node in frontier:
+            for edge in adjacency[node]:
+                if values[edge] <= 0:
+                    continue
+                next_node = ends[edge]
+                if next_node in seen:
+                    continue
+                seen[next_node] = edge
+                if next_node in other:
+                    return next_frontier, next_node
+                next_frontier.append(next_node)
+        return next_frontier, None
+
+    def _join_path(self, meet, forward, backward):
+        """Build the list of edges from the forward search root, through
+        `meet`, to the backward search root.
+        """
+        path = []
+        node = meet
+        while forward[node] is not None:
+            edge = forward[node]
+            path.append(edge)
+            node = self.sources[edge]
+        path.reverse()
+
+        node = meet
+        while backward[node] is not None:
+            edge = backward[node]
+            path.append(edge)
+            node = self.targets[edge]
+        return path
+
+    def bottleneck(self, cycle):
+        """The largest value which can be resolved along a cycle."""
+        return min(self.values[edge] for edge in cycle)
+
+    def reduce(self, cycle, value):
+        """Reduce every balance in the cycle by value."""
+        for edge in cycle:
+            self.values[edge] -= value
+
+    def legs(self, cycle):
+        """Get (balance_id, debted_id, credited_id) for each edge of a cycle."""
+        return [
+            (
+                self.balance_ids[edge],
+                self.person_ids[self.sources[edge]],
+                self.person_ids[self.targets[edge]],
+            )
+            for edge in cycle
+        ]
+
+    def cleared(self, cycle):
+        """The total value of debt cleared by resolving a cycle."""
+        return self.bottleneck(cycle) * len(cycle)
+
+    def start_edges(self):
+        """Yield the edges to start searches from: the debted balances of each
+        person in order of person id, or only those in `start_balance_ids`
+        when it is set.
+        """
+        starts = self.start_balance_ids
+        nodes = sorted(range(len(self.person_ids)), key=self.person_ids.__getitem__)
+        for node in nodes:
+            for edge in self.out_edges[node]:
+                if starts is None or self.balance_ids[edge] in starts:
+                    yield edge
+
+    def find_cycles(self, limit, strategy="first"):
+        """Yield (cycle, value) for each cycle found using `strategy`, one of
+        `strategies`. Each cycle is reduced in the graph before it is
+        yielded, so later searches see the resolved values.
+        """
+        return getattr(self, self.strategies[strategy])(limit)
+
+    strategies = {
+        "first": "find_first_cycles",
+        "best": "find_best_cycles",
+    }
+
+    def find_first_cycles(self, limit):
+        """Resolve the first cycle found from each starting balance."""
+        for edge in self.start_edges():
+            cycle = self.find_cycle(edge, limit)
+            if not cycle:
+                continue
+            value = self.bottleneck(cycle)
+            self.reduce(cycle, value)
+            yield cycle, value
+
+    def find_best_cycles(self, limit):
+        """Resolve cycles in order of the most debt cleared.
+
+        A candidate cycle is found from each starting balance and kept in a
+        priority queue scored by `cleared`. When the best candidate is taken,
+        its score is checked against the current values. Candidates reduced
+        by an earlier cycle are scored again, and those with a cleared
+        balance are replaced by a new search from their starting balance.
+        """
+        queue = []
+        for edge in self.start_edges():
+            cycle = self.find_cycle(edge, limit)
+            if cycle:
+                queue.append((-self.cleared(cycle), edge, cycle))
+        heapq.heapify(queue)
+
+        while queue:
+            score, edge, cycle = heapq.heappop(queue)
+            cleared = self.cleared(cycle)
+            if cleared and cleared < -score:
+                heapq.heappush(queue, (-cleared, edge, cycle))
+                continue
+
+            if cleared:
+                value = self.bottleneck(cycle)
+                self.reduce(cycle, value)
+                yield cycle, value
+
+            # Look for the next cycle through this starting balance
+            cycle = self.find_cycle(edge, limit)
+            if cycle:
+                heapq.heappush(queue, (-self.cleared(cycle), edge, cycle))
+
+
+def find_resolutions(graph, limit, strategy="first"):
+    """Find and reduce every cycle in a graph. Returns a list of
+    (currency_id, value, legs), the format used by `db.save_resolutions`.
+
+    This is a module level function so it can be run in a worker process.
+    """
+    return [
+        (graph.currency_id, value, graph.legs(cycle))
+        for cycle, value in graph.find_cycles(limit, strategy)
+    ]
@@ -2,108 +2,316 @@
  Resolve balances between users.
 """
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import datetime
+import itertools
+import json
 import logging
+import time
 
-from django.db import transaction
+import django
+
+if __name__ == "__main__":
+    django.setup()
+
+from django.db import connections, transaction
+from django.utils import timezone
 
 from optparse import OptionParser
 from core import models, db
+from core.graph import DebtGraph, find_resolutions
 
 
 class BalanceResolver(object):
 
+    watermark = "resolve_balances"
+    # A balance can be updated just before a run starts but committed after
+    # the balances are loaded. The watermark is moved back by this much so
+    # the next incremental run still starts from those balances.
+    watermark_margin = datetime.timedelta(minutes=1)
+
     def setup_options(self):
         self.option_parser = parser = OptionParser()
         parser.add_option(
             "-l",
             "--chain-limit",
             dest="chain_limit",
+            type="int",
             help="Limit the number of users in a resolution chain.",
             default=5,
         )
+        parser.add_option(
+            "-s",
+            "--strategy",
+            dest="strategy",
+            type="choice",
+            choices=sorted(DebtGraph.strategies),
+            help="How chains are chosen: 'first' found, or 'best' value cleared.",
+            default="first",
+        )
+        parser.add_option(
+            "--backend",
+            dest="backend",
+            type="choice",
+            choices=["memory", "sql"],
+            help="Search for chains in a graph loaded into 'memory', or in the "
+            "database with recursive 'sql' queries.",
+            default="memory",
+        )
+        parser.add_option(
+            "-b",
+            "--batch",
+            dest="batch",
+            action="store_true",
+            help="Collect every resolution in a pass and save them in bulk.",
+        )
+        parser.add_option(
+            "--chunk-size",
+            dest="chunk_size",
+            type="int",
+            help="Number of resolutions committed per transaction in batch mode.",
+            default=500,
+        )
+        parser.add_option(
+            "-w",
+            "--workers",
+            dest="workers",
+            type="int",
+            help="Number of processes used to search components for chains.",
+            default=1,
+        )
+        parser.add_option(
+            "-i",
+            "--incremental",
+            dest="incremental",
+            action="store_true",
+            help="Only start searches from balances updated since the last run.",
+        )
+        parser.add_option(
+            "--full",
+            dest="full",
+            action="store_true",
+            help="Search from every balance, even with --incremental.",
+        )
+        parser.add_option(
+            "-n",
+            "--dry-run",
+            dest="dry_run",
+            action="store_true",
+            help="Search for chains without writing anything.",
+        )
+        parser.add_option(
+            "--snapshot",
+            dest="snapshot",
+            help="Load balances from a snapshot file instead of the database. "
+            "Implies --dry-run.",
+        )
+        parser.add_option(
+            "--save-snapshot",
+            dest="save_snapshot",
+            help="Save the loaded balances to a snapshot file.",
+        )
+        parser.add_option(
+            "--report",
+            dest="report",
+            help="Write a JSON report of the run to a file, or '-' for stdout.",
+        )
         parser.add_option("-v", "--verbose", dest="verbose", action="store_true")
 
-    def load_options(self):
-        self.options, self.args = self.option_parser.parse_args()
+    def load_options(self, args=None):
+        self.options, self.args = self.option_parser.parse_args(args)
+        if self.options.snapshot:
+            self.options.dry_run = True
+        if self.options.backend == "sql" and (
+            self.options.dry_run or self.options.strategy != "first"
+        ):
+            self.option_parser.error(
+                "The sql backend resolves each chain as it is found, it can't be "
+                "used with --dry-run, --snapshot or --strategy best."
+            )
 
     def setup_logging(self):
         self.log = logging.getLogger("BalanceResolver")
         level = logging.DEBUG if self.options.verbose else logging.INFO
         self.log.setLevel(level)
-        self.log.addHandler(logging.StreamHandler())
+        if not self.log.handlers:
+            self.log.addHandler(logging.StreamHandler())
         self.stats = defaultdict(int)
+        self.chain_lengths = Counter()
+        self.timings = defaultdict(float)
 
-    def get_balance_chain(self, persons, target_balance, depth=0):
-        """Find a balance from persons with target_person which is credited
-        according to `credited`. If a balance is not found recursively calls
-        itself with all of the persons for the last set of balances.
-        """
-        if depth > self.options.chain_limit:
-            self.log.debug("Giving up at depth %s" % depth)
-            self.stats["max_depth"] += 1
-            return None
-        if not persons:
-            return None
-
-        credited = target_balance.credited
-        target_person = target_balance.person
-        currency = target_balance.balance.currency
-
-        mirrored_balances = db.get_balances_many(persons, currency, credited)
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Add the wall time spent in a block to the timings for `phase`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - started
+
+    def load_graph(self, currency):
+        """Load all non-zero balances for a currency into a DebtGraph."""
+        graph = DebtGraph.from_edges(db.get_debt_edges(currency), currency.id)
         self.log.debug(
-            "  Found %s mirrored balances (%s)"
-            % (len(mirrored_balances), set(pb.other_person for pb in mirrored_balances))
+            "Loaded %s balances between %s persons for %s"
+            % (len(graph), len(graph.person_ids), currency)
         )
-        # TODO: chose the highest value balance
-        for mirrored_balance in mirrored_balances:
-            if target_person.id == mirrored_balance.other_person.id:
-                return [mirrored_balance]
+        self.stats["balances"] += len(graph)
+        return graph
+
+    def load_snapshot(self, filename):
+        """Load a graph for each currency in a snapshot file."""
+        with open(filename) as snapshot:
+            currencies = json.load(snapshot)["currencies"]
+        graphs = []
+        for currency_id, edges in sorted(currencies.items()):
+            graph = DebtGraph.from_edges(edges, int(currency_id))
+            self.log.debug(
+                "Loaded %s balances between %s persons for currency %s"
+                % (len(graph), len(graph.person_ids), currency_id)
+            )
+            self.stats["balances"] += len(graph)
+            graphs.append(graph)
+        return graphs
 
-        mirrored_persons = set(pb.other_person for pb in mirrored_balances)
-        balance_chain = self.get_balance_chain(
-            mirrored_persons, target_balance, depth + 1
+    def save_snapshot(self, filename, graphs):
+        """Save the balances of each graph to a snapshot file."""
+        currencies = dict((graph.currency_id, graph.edges()) for graph in graphs)
+        with open(filename, "w") as snapshot:
+            json.dump({"currencies": currencies}, snapshot)
+
+    def split_graph(self, graph, updated=None):
+        """Split a graph into its strongly connected components. Persons
+        outside of every component only pay or only get paid, so they are
+        never part of a chain.
+
+        If `updated` is a set of balance ids, only components containing one
+        of them are kept, and searches start from those balances only. A new
+        chain can only be closed by a balance which changed.
+        """
+        components = graph.split()
+        if updated is not None:
+            components = [c for c in components if updated.intersection(c.balance_ids)]
+            for component in components:
+                component.start_balance_ids = updated.intersection(
+                    component.balance_ids
+                )
+        persons = sum(len(c.person_ids) for c in components)
+        balances = sum(len(c) for c in components)
+        self.log.debug(
+            "Found %s components in currency %s, pruned %s persons and %s balances"
+            % (
+                len(components),
+                graph.currency_id,
+                len(graph.person_ids) - persons,
+                len(graph) - balances,
+            )
         )
-        if not balance_chain:
+        self.stats["components"] += len(components)
+        self.stats["pruned_persons"] += len(graph.person_ids) - persons
+        self.stats["pruned_balances"] += len(graph) - balances
+        return components
+
+    def search_components(self, components):
+        """Yield (component, resolutions) for each component. Components are
+        searched in a pool of `--workers` processes, and the results are sent
+        back to be written by this process.
+        """
+        limit, strategy = self.options.chain_limit + 1, self.options.strategy
+        if self.options.workers <= 1:
+            for component in components:
+                yield component, find_resolutions(component, limit, strategy)
             return
 
-        # Find the balance in this context which links back to the original
-        # balance
-        link_person = balance_chain[-1].person
-        for mirrored_balance in mirrored_balances:
-            if mirrored_balance.other_person.id == link_person.id:
-                balance_chain.append(mirrored_balance)
-                return balance_chain
-
-    def resolve_balances(self, balances):
-        for balance in balances:
-            self.log.debug(" Attempting to resolving balance %s" % balance)
-            balance_chain = self.get_balance_chain([balance.other_person], balance)
-            if balance_chain:
-                self.resolve(balance_chain)
+        # Workers never touch the database, don't share connections with them
+        connections.close_all()
+        with ProcessPoolExecutor(self.options.workers) as pool:
+            results = pool.map(
+                find_resolutions,
+                components,
+                itertools.repeat(limit),
+                itertools.repeat(strategy),
+            )
+            for component, resolutions in zip(components, results):
+                yield component, resolutions
+
+    def log_component(self, component, resolutions):
+        self.log.info(
+            "Component of currency %s with %s persons and %s balances: "
+            "%s chains resolved, %s cleared"
+            % (
+                component.currency_id,
+                len(component.person_ids),
+                len(component),
+                len(resolutions),
+                sum(value * len(legs) for _, value, legs in resolutions),
+            )
+        )
+
+    def save_resolutions(self, resolutions):
+        """Save chains of balances resolved in a single currency. In batch
+        mode only the chains which still fit their balances are saved and
+        counted.
+        """
+        if not resolutions or self.options.dry_run:
+            self.stats["resolved"] += len(resolutions)
+        elif not self.options.batch:
+            for currency_id, value, legs in resolutions:
+                self.resolve(legs, currency_id, value)
+        else:
+            self.log.debug(
+                "Saving %s resolutions of currency %s"
+                % (len(resolutions), resolutions[0][0])
+            )
+            resolutions = db.save_resolutions(resolutions, self.options.chunk_size)
+            self.stats["resolved"] += len(resolutions)
+        self.stats["cleared"] += sum(
+            value * len(legs) for _, value, legs in resolutions
+        )
+        self.chain_lengths.update(len(legs) for _, _, legs in resolutions)
+
+    def search_database(self, since=None):
+        """Find chains with a recursive query from each debted balance, or
+        only those updated since `since`, and resolve them as they are found.
+        The balances are never loaded into memory.
+        """
+        limit = self.options.chain_limit + 1
+        for currency in models.Currency.objects.all():
+            with self.timer("load"):
+                balance_ids = db.get_debted_balance_ids(currency, since)
+            self.stats["balances"] += len(balance_ids)
+
+            for balance_id in balance_ids:
+                with self.timer("search"):
+                    chain = db.find_balance_chain(balance_id, limit)
+                if not chain:
+                    continue
+                legs, value = chain
+                with self.timer("write"):
+                    self.save_resolutions([(currency.id, value, legs)])
 
     @transaction.atomic
-    def resolve(self, balance_chain):
+    def resolve(self, legs, currency_id, value):
         self.log.info(
-            "Resolving %s with a chain of %s" % (balance_chain[-1], len(balance_chain))
+            "Resolving %s between %s balances of currency %s"
+            % (value, len(legs), currency_id)
         )
         self.stats["resolved"] += 1
 
-        value = min(pb.balance.value for pb in balance_chain)
-        for balance in balance_chain:
-            objs = self.build_resolution(balance, value)
+        for leg in legs:
+            objs = self.build_resolution(leg, currency_id, value)
             self.save_resolution(*objs)
 
-    def build_resolution(self, balance, value):
-        currency = balance.balance.currency
-        resolution = models.Resolution(value=value, currency=currency)
+    def build_resolution(self, leg, currency_id, value):
+        balance_id, debted_id, credited_id = leg
+        resolution = models.Resolution(value=value, currency_id=currency_id)
         pr_a = models.PersonResolution(
-            resolution=resolution, person=balance.person, credited=not balance.credited
+            resolution=resolution, person_id=debted_id, credited=True
         )
         pr_b = models.PersonResolution(
-            resolution=resolution,
-            person=balance.other_person,
-            credited=balance.credited,
+            resolution=resolution, person_id=credited_id, credited=False
         )
         return resolution, pr_a, pr_b
 
@@ -114,27 +322,95 @@ class BalanceResolver(object):
         pr_b.save()
 
         # person b should be the provider
-        db.update_balance(resolution, pr_b.person, pr_a.person)
+        db.update_balance(resolution, pr_b.person_id, pr_a.person_id)
 
     def run(self):
-        """Run over all users and find chains of balances which will resolve
-        down to lower balances.
+        """Run over the balances of each currency and find chains of balances
+        which will resolve down to lower balances. The start time of the run,
+        less `watermark_margin`, is stored as the watermark for the next
+        incremental run.
         """
-        users = models.User.objects.filter(is_active=True).all()
-        for user in users:
-            self.log.debug("Resolving balances for %s" % user)
-            balances = db.get_balances(user, credited=False)
-            self.resolve_balances(balances)
+        started = timezone.now() - self.watermark_margin
+        since = None
+        if self.options.incremental and not (
+            self.options.full or self.options.snapshot
+        ):
+            since = db.get_watermark(self.watermark)
+            self.log.info("Resolving balances updated since %s" % since)
+
+        if self.options.backend == "sql":
+            self.search_database(since)
+            db.set_watermark(self.watermark, started)
+            return
+
+        components = []
+        with self.timer("load"):
+            if self.options.snapshot:
+                graphs = self.load_snapshot(self.options.snapshot)
+            else:
+                graphs = [self.load_graph(c) for c in models.Currency.objects.all()]
+            if self.options.save_snapshot:
+                self.save_snapshot(self.options.save_snapshot, graphs)
+
+            for graph in graphs:
+                updated = None
+                if since is not None:
+                    updated = db.get_updated_balance_ids(graph.currency_id, since)
+                    self.stats["updated_balances"] += len(updated)
+                components.extend(self.split_graph(graph, updated))
+
+        # Start the largest components first so workers finish together
+        components.sort(key=len, reverse=True)
+        results = self.search_components(components)
+        while True:
+            with self.timer("search"):
+                result = next(results, None)
+            if result is None:
+                break
+            component, resolutions = result
+            self.log_component(component, resolutions)
+            with self.timer("write"):
+                self.save_resolutions(resolutions)
+
+        if not self.options.dry_run:
+            db.set_watermark(self.watermark, started)
+
+    def build_report(self):
+        """Build a machine readable report of the last run."""
+        return {
+            "dry_run": bool(self.options.dry_run),
+            "strategy": self.options.strategy,
+            "chain_limit": self.options.chain_limit,
+            "stats": dict(self.stats),
+            "chain_lengths": dict(sorted(self.chain_lengths.items())),
+            "timings": dict(self.timings),
+        }
 
     def print_stats(self):
-        self.log.info("\n".join("%-20s %s" % (k, v) for k, v in self.stats.iteritems()))
+        self.log.info(
+            "\n".join("%-20s %s" % (k, v) for k, v in sorted(self.stats.items()))
+        )
+        self.log.info(
+            "\n".join("%-20s %.3fs" % (k, v) for k, v in self.timings.items())
+        )
+
+    def write_report(self, filename):
+        report = json.dumps(self.build_report(), indent=2)
+        if filename == "-":
+            print(report)
+            return
+        with open(filename, "w") as output:
+            output.write(report)
 
     def start(self):
         self.setup_options()
         self.load_options()
         self.setup_logging()
-        self.run()
+        with self.timer("total"):
+            self.run()
         self.print_stats()
+        if self.options.report:
+            self.write_report(self.options.report)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+"""
+Export the whole ledger to files, one per table.
+"""
+
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import export
+
+
+class Command(BaseCommand):
+    help = (
+        "Export all transaction records, resolutions and balances as csv, "
+        "ndjson or the columnar format, to <table>.<format> files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(export.ENCODERS), default="csv")
+        parser.add_argument(
+            "--table",
+            action="append",
+            choices=sorted(export.TABLES),
+            help="Export only this table, may be repeated.",
+        )
+        parser.add_argument(
+            "--output", default=".", help="Directory the files are written to."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=10000,
+            help="Number of rows read per query.",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        verbosity = options["verbosity"]
+
+        def progress(table, done, total):
+            if verbosity > 1:
+                self.stdout.write(
+                    "%8.1fs  %s %s/%s"
+                    % (time.perf_counter() - started, table, done, total)
+                )
+
+        os.makedirs(options["output"], exist_ok=True)
+        for table in options["table"] or export.TABLES:
+            path = os.path.join(
+                options["output"],
+                "%s.%s" % (table, export.FORMATS[options["format"]]),
+            )
+            size = 0
+            with open(path, "wb") as output:
+                for data in export.export_table(
+                    table, options["format"], options["chunk_size"], progress
+                ):
+                    output.write(data)
+                    size += len(data)
+            self.stdout.write(
+                "%8.1fs  Wrote %s, %s bytes"
+                % (time.perf_counter() - started, path, size)
+            )
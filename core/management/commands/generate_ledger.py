@@ -0,0 +1,97 @@
+"""
+Generate a ledger of users, currencies, transactions, resolutions and
+exchange rates, for testing and benchmarks.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.testing.ledger import LedgerBuilder
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a ledger from a seed. The same options and seed generate "
+        "the same ledger."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--currencies", type=int, default=2)
+        parser.add_argument(
+            "--transactions",
+            type=int,
+            default=1000,
+            help="Number of confirmed transactions.",
+        )
+        parser.add_argument(
+            "--pending",
+            type=int,
+            default=100,
+            help="Number of pending records, about one in ten are rejected.",
+        )
+        parser.add_argument(
+            "--resolutions",
+            type=int,
+            default=20,
+            help="Number of resolved chains, each of three resolutions.",
+        )
+        parser.add_argument("--exchange-rates", type=int, default=20)
+        parser.add_argument(
+            "--partners",
+            type=int,
+            default=8,
+            help="Number of neighbours each person trades with on either side.",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=90,
+            help="Spread the transactions over this many days before now.",
+        )
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument(
+            "--prefix",
+            default="user",
+            help="Prefix of the generated usernames and currency names.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of rows written per query.",
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        started = time.perf_counter()
+
+        def progress(stage, done, total):
+            if self.verbosity > 1 or done == total:
+                self.stdout.write(
+                    "%8.1fs  %s %s/%s"
+                    % (time.perf_counter() - started, stage, done, total)
+                )
+
+        builder = LedgerBuilder(
+            users=options["users"],
+            currencies=options["currencies"],
+            transactions=options["transactions"],
+            pending=options["pending"],
+            resolutions=options["resolutions"],
+            exchange_rates=options["exchange_rates"],
+            partners=options["partners"],
+            days=options["days"],
+            seed=options["seed"],
+            prefix=options["prefix"],
+            batch_size=options["batch_size"],
+            progress=progress,
+        )
+        with transaction.atomic():
+            builder.build()
+        self.stdout.write(
+            "Generated %s balances in %.1fs."
+            % (len(builder.deltas), time.perf_counter() - started)
+        )
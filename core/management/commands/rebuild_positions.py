@@ -0,0 +1,28 @@
+"""
+Rebuild the net position of each person from their balances.
+"""
+
+from django.core.management.base import BaseCommand
+
+from core import db
+
+
+class Command(BaseCommand):
+    help = "Rebuild the net position of each person from their balances."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--currency",
+            type=int,
+            help="Only rebuild positions in the currency with this id.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of positions written per query.",
+        )
+
+    def handle(self, *args, **options):
+        fixed = db.rebuild_positions(options["currency"], options["batch_size"])
+        self.stdout.write("Rebuilt positions, %s were missing or wrong." % fixed)
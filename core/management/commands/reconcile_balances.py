@@ -0,0 +1,111 @@
+"""
+Check every balance against the transactions and resolutions it was built
+from, and optionally repair those which differ.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import db
+from core import models
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the balance of every pair of persons from confirmed "
+        "transactions and resolutions, and report the balances and positions "
+        "which differ. Currencies are checked in parallel."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--currency",
+            type=int,
+            action="append",
+            help="Only check the currency with this id, may be repeated.",
+        )
+        parser.add_argument(
+            "--repair",
+            action="store_true",
+            help="Set the balances which differ to their rebuilt value, and "
+            "rebuild the positions.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of currencies checked at once.",
+        )
+        parser.add_argument(
+            "--show",
+            type=int,
+            default=20,
+            help="Number of differing balances listed for each currency.",
+        )
+
+    def check_currency(self, currency_id, repair):
+        started = time.perf_counter()
+        try:
+            if repair:
+                differences, positions = db.repair_balances(currency_id)
+            else:
+                differences = db.diff_balances(currency_id)
+                positions = db.rebuild_positions(currency_id, dry_run=True)
+        finally:
+            if self.threaded:
+                connection.close()
+        return currency_id, differences, positions, time.perf_counter() - started
+
+    def handle(self, *args, **options):
+        currency_ids = options["currency"] or list(
+            models.Currency.objects.order_by("id").values_list("id", flat=True)
+        )
+        repair = options["repair"]
+        workers = max(1, min(options["workers"], len(currency_ids)))
+        # Each thread has its own connection, which an in-memory SQLite
+        # database is not shared with
+        self.threaded = workers > 1
+
+        started = time.perf_counter()
+        if self.threaded:
+            with ThreadPoolExecutor(workers) as executor:
+                results = list(
+                    executor.map(lambda c: self.check_currency(c, repair), currency_ids)
+                )
+        else:
+            results = [self.check_currency(c, repair) for c in currency_ids]
+
+        total = 0
+        for currency_id, differences, positions, elapsed in results:
+            total += len(differences) + positions
+            self.stdout.write(
+                "Currency %s: %s balances differ, %s missing, %s positions wrong%s "
+                "(%.1fs)"
+                % (
+                    currency_id,
+                    len(differences),
+                    len([d for d in differences if d[3] is None]),
+                    positions,
+                    ", repaired" if repair and (differences or positions) else "",
+                    elapsed,
+                )
+            )
+            for persona_id, personb_id, value, balance_id, stored in differences[
+                : options["show"]
+            ]:
+                self.stdout.write(
+                    "  persons %s-%s: balance %s is %s, rebuilt %s"
+                    % (persona_id, personb_id, balance_id, stored, value)
+                )
+        self.stdout.write(
+            "Checked %s currencies in %.1fs."
+            % (len(currency_ids), time.perf_counter() - started)
+        )
+        if total and not repair:
+            raise CommandError(
+                "%s balances or positions differ, run with --repair to fix them."
+                % total
+            )
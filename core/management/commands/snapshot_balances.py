@@ -0,0 +1,57 @@
+"""
+Snapshot the balances and positions, so historical balances only replay the
+transfers since the snapshot before them.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import dateparse, timezone
+
+from core import db
+
+
+class Command(BaseCommand):
+    help = (
+        "Snapshot the balance of every pair of persons and the position of "
+        "every person. Run it on a schedule, for example daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--time",
+            help="ISO 8601 time to take the snapshot at, by default now. "
+            "Snapshots in the past are built from the transfers confirmed "
+            "until then.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=2000,
+            help="Number of rows written per query.",
+        )
+
+    def handle(self, *args, **options):
+        at = None
+        if options["time"]:
+            at = dateparse.parse_datetime(options["time"])
+            if at is None:
+                raise CommandError("Unknown time %s" % options["time"])
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+
+        started = time.perf_counter()
+        try:
+            snapshot, changed = db.take_balance_snapshot(at, options["batch_size"])
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write(
+            "%s: %s balances and %s positions, %s pairs changed (%.1fs)"
+            % (
+                snapshot,
+                snapshot.balances.count(),
+                snapshot.positions.count(),
+                changed,
+                time.perf_counter() - started,
+            )
+        )
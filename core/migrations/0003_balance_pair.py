@@ -0,0 +1,70 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def key_balances_by_pair(apps, schema_editor):
+    """Set the person pair of each balance and sign its value. Duplicate
+    balances for the same pair and currency are merged into the first one.
+    """
+    Balance = apps.get_model("core", "Balance")
+    PersonBalance = apps.get_model("core", "PersonBalance")
+
+    sides = {}
+    for balance_id, person_id, credited in PersonBalance.objects.values_list(
+        "balance_id", "person_id", "credited"
+    ):
+        sides.setdefault(balance_id, {})[credited] = person_id
+
+    merged = {}
+    for balance in Balance.objects.order_by("id"):
+        side = sides.get(balance.id, {})
+        if len(side) != 2:
+            balance.delete()
+            continue
+        debted, credited = side[False], side[True]
+        persona, personb = min(debted, credited), max(debted, credited)
+        value = balance.value if debted == persona else -balance.value
+
+        key = (persona, personb, balance.currency_id)
+        if key in merged:
+            first = merged[key]
+            first.value += value
+            first.save()
+            balance.delete()
+            continue
+        balance.persona_id, balance.personb_id, balance.value = key[0], key[1], value
+        balance.save()
+        merged[key] = balance
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_watermark"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="balance",
+            name="persona",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="core.person",
+            ),
+        ),
+        migrations.AddField(
+            model_name="balance",
+            name="personb",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="core.person",
+            ),
+        ),
+        migrations.RunPython(key_balances_by_pair, migrations.RunPython.noop),
+    ]
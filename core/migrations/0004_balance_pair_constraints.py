@@ -0,0 +1,55 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0003_balance_pair"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="personbalance",
+            name="credited",
+        ),
+        migrations.AlterField(
+            model_name="balance",
+            name="persona",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="core.person",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="balance",
+            name="personb",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="core.person",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="balance",
+            constraint=models.UniqueConstraint(
+                fields=("persona", "personb", "currency"), name="unique_balance_pair"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="balance",
+            constraint=models.CheckConstraint(
+                condition=models.Q(("persona__lt", models.F("personb"))),
+                name="balance_pair_order",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="personbalance",
+            constraint=models.UniqueConstraint(
+                fields=("person", "balance"), name="unique_person_balance"
+            ),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+def unreject_confirmed_records(apps, schema_editor):
+    """Records could be rejected after they were confirmed. The balance was
+    updated by the confirmation, so it is the one kept.
+    """
+    TransactionRecord = apps.get_model("core", "TransactionRecord")
+    TransactionRecord.objects.filter(transaction__isnull=False, rejected=True).update(
+        rejected=False
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_balance_pair_constraints"),
+    ]
+
+    operations = [
+        migrations.RunPython(unreject_confirmed_records, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="transactionrecord",
+            constraint=models.UniqueConstraint(
+                fields=("transaction", "from_receiver"), name="unique_transaction_side"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="transactionrecord",
+            constraint=models.CheckConstraint(
+                condition=models.Q(
+                    ("transaction__isnull", True), ("rejected", False), _connector="OR"
+                ),
+                name="confirmed_not_rejected",
+            ),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:47
+
+import collections
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_positions(apps, schema_editor):
+    """Sum the existing balances into positions."""
+    Balance = apps.get_model("core", "Balance")
+    Position = apps.get_model("core", "Position")
+
+    positions = collections.defaultdict(int)
+    for persona_id, personb_id, currency_id, value in Balance.objects.values_list(
+        "persona_id", "personb_id", "currency_id", "value"
+    ):
+        positions[persona_id, currency_id] -= value
+        positions[personb_id, currency_id] += value
+    Position.objects.bulk_create(
+        (
+            Position(person_id=person_id, currency_id=currency_id, value=value)
+            for (person_id, currency_id), value in positions.items()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_transaction_record_constraints"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Position",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("value", models.IntegerField(default=0)),
+                ("time_updated", models.DateTimeField(auto_now=True)),
+                (
+                    "currency",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="core.currency",
+                    ),
+                ),
+                (
+                    "person",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="positions",
+                        to="core.person",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("person", "currency"), name="unique_person_position"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(build_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0006_position"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="currency",
+            name="credit_limit",
+            field=models.IntegerField(
+                blank=True,
+                help_text="How far the net position of a person may go below 0. Blank for no limit.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="credit_limit",
+            field=models.IntegerField(
+                blank=True,
+                help_text="How far the position may go below 0, overriding the limit of the currency. Blank to use the currency limit.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_credit_limit"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="transactionrecord",
+            name="unique_transaction_side",
+        ),
+        migrations.AlterField(
+            model_name="transactionrecord",
+            name="creator_person",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="transaction_records_creator",
+                to="core.person",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="transactionrecord",
+            name="target_person",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="transaction_records_target",
+                to="core.person",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="balance",
+            index=models.Index(
+                fields=["currency", "time_updated"], name="balance_currency_updated"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactionrecord",
+            index=models.Index(
+                condition=models.Q(("rejected", False), ("transaction__isnull", True)),
+                fields=["target_person"],
+                name="record_pending_target",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactionrecord",
+            index=models.Index(
+                fields=["creator_person", "time_created"], name="record_creator_time"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transactionrecord",
+            index=models.Index(
+                fields=["target_person", "time_created"], name="record_target_time"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="transactionrecord",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("transaction__isnull", False)),
+                fields=("transaction", "from_receiver"),
+                name="unique_transaction_side",
+            ),
+        ),
+    ]
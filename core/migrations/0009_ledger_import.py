@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0008_query_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LedgerImport",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                (
+                    "rows",
+                    models.IntegerField(default=0, help_text="Input rows read so far."),
+                ),
+                ("imported", models.IntegerField(default=0)),
+                ("errors", models.IntegerField(default=0)),
+                ("time_updated", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -75,27 +75,51 @@ post_save.connect(create_person, sender=User, dispatch_uid="create_person_handle
 
 
 class Balance(CurrencyMixin, m.Model):
-    """A balance between two people."""
+    """A balance between two people.
 
+    There is a single balance for each pair of persons in a currency, keyed
+    by the lower person id (`persona`) and the higher one (`personb`). The
+    value is signed: positive when persona is debted to personb, negative
+    when personb is debted to persona.
+    """
+
+    persona = m.ForeignKey("Person", on_delete=m.CASCADE, related_name="+")
+    personb = m.ForeignKey("Person", on_delete=m.CASCADE, related_name="+")
     persons = m.ManyToManyField(
         "Person", through="PersonBalance", blank=True, related_name="balances"
     )
     time_updated = m.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # db.get_updated_balance_ids
+            m.Index(
+                fields=["currency", "time_updated"], name="balance_currency_updated"
+            ),
+        ]
+        constraints = [
+            m.UniqueConstraint(
+                fields=["persona", "personb", "currency"], name="unique_balance_pair"
+            ),
+            m.CheckConstraint(
+                condition=m.Q(persona__lt=m.F("personb")), name="balance_pair_order"
+            ),
+        ]
+
     def __unicode__(self):
         return "Balance of %s credited to %s, debt from %s" % (
-            self.value_repr,
+            self.currency.value_repr(abs(self.value)),
             self.credited,
             self.debted,
         )
 
     @property
     def credited(self):
-        return self.personbalance_set.get(credited=True).person
+        return self.persona if self.value < 0 else self.personb
 
     @property
     def debted(self):
-        return self.personbalance_set.get(credited=False).person
+        return self.persona if self.value >= 0 else self.personb
 
 
 class PersonBalance(m.Model):
@@ -103,26 +127,44 @@ class PersonBalance(m.Model):
 
     person = m.ForeignKey("Person", on_delete=m.CASCADE)
     balance = m.ForeignKey("Balance", on_delete=m.CASCADE)
-    credited = m.BooleanField()
+
+    class Meta:
+        constraints = [
+            m.UniqueConstraint(
+                fields=["person", "balance"], name="unique_person_balance"
+            ),
+        ]
 
     def __unicode__(self):
         return "PersonBalance for %s and %s" % (self.person, self.balance)
 
+    @property
+    def is_persona(self):
+        return self.person_id == self.balance.persona_id
+
+    @property
+    def credited(self):
+        """True if the other person is debted to this person."""
+        return self.signed_value > 0
+
+    @property
+    def signed_value(self):
+        """The balance value from this person's side, positive when credited."""
+        value = self.balance.value
+        return -value if self.is_persona else value
+
     @property
     def other_person(self):
         """Get the person on the other side of this balance."""
-        return self.balance.persons.exclude(id=self.person.id).get()
+        return self.balance.personb if self.is_persona else self.balance.persona
 
     @property
     def relative_value(self):
-        value = self.balance.value
-        return self.balance.currency.value_of(value if self.credited else -value)
+        return self.balance.currency.value_of(self.signed_value)
 
     @property
     def relative_value_repr(self):
-        value = self.balance.value
-        value = value if self.credited else -value
-        return self.balance.currency.value_repr(value)
+        return self.balance.currency.value_repr(self.signed_value)
 
     def export_data(self):
         return {
@@ -135,6 +177,34 @@ class PersonBalance(m.Model):
         }
 
 
+class Position(CurrencyMixin, m.Model):
+    """The net position of a person in a currency, the sum of their balances
+    from their side. Positive when others are debted to the person.
+
+    Kept up to date in the same transaction as every balance update, see
+    `db.apply_position_deltas`, and rebuilt by the rebuild_positions command.
+    """
+
+    person = m.ForeignKey("Person", on_delete=m.CASCADE, related_name="positions")
+    credit_limit = m.IntegerField(
+        null=True,
+        blank=True,
+        help_text="How far the position may go below 0, overriding the limit "
+        "of the currency. Blank to use the currency limit.",
+    )
+    time_updated = m.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            m.UniqueConstraint(
+                fields=["person", "currency"], name="unique_person_position"
+            ),
+        ]
+
+    def __str__(self):
+        return "Position of %s in %s" % (self.person, self.currency)
+
+
 class ExchangeRate(m.Model):
     """A rate of exchange between two currencies, offered by a person."""
 
@@ -250,13 +320,18 @@ class TransactionRecord(DictableModel, CurrencyMixin, m.Model):
         null=True,
         blank=True,
     )
+    # Indexed by the composite indexes below
     creator_person = m.ForeignKey(
-        "Person", on_delete=m.CASCADE, related_name="transaction_records_creator"
+        "Person",
+        on_delete=m.CASCADE,
+        related_name="transaction_records_creator",
+        db_index=False,
     )
     target_person = m.ForeignKey(
         "Person",
         on_delete=m.CASCADE,
         related_name="transaction_records_target",
+        db_index=False,
     )
     from_receiver = m.BooleanField()
     rejected = m.BooleanField(default=False)
@@ -264,6 +339,36 @@ class TransactionRecord(DictableModel, CurrencyMixin, m.Model):
     time_created = m.DateTimeField(auto_now_add=True)
     notes = m.TextField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # db.get_pending_trans_for_user
+            m.Index(
+                fields=["target_person"],
+                condition=m.Q(transaction__isnull=True, rejected=False),
+                name="record_pending_target",
+            ),
+            # db.get_recent_trans_for_user and db.get_transaction_count
+            m.Index(
+                fields=["creator_person", "time_created"], name="record_creator_time"
+            ),
+            # db.get_transaction_notifications
+            m.Index(
+                fields=["target_person", "time_created"], name="record_target_time"
+            ),
+        ]
+        constraints = [
+            # A transaction has one record from each side
+            m.UniqueConstraint(
+                fields=["transaction", "from_receiver"],
+                condition=m.Q(transaction__isnull=False),
+                name="unique_transaction_side",
+            ),
+            m.CheckConstraint(
+                condition=m.Q(transaction__isnull=True) | m.Q(rejected=False),
+                name="confirmed_not_rejected",
+            ),
+        ]
+
     def __unicode__(self):
         return "Transaction Record (by %s)  %s from %s to %s at %s" % (
             self.creator_person,
@@ -335,6 +440,12 @@ class Currency(m.Model):
     description = m.TextField(blank=True)
     decimal_places = m.IntegerField(default=0)
     default = m.BooleanField(default=False)
+    credit_limit = m.IntegerField(
+        null=True,
+        blank=True,
+        help_text="How far the net position of a person may go below 0. "
+        "Blank for no limit.",
+    )
     time_created = m.DateTimeField(auto_now_add=True)
 
     def __unicode__(self):
@@ -389,8 +500,16 @@ class PersonResolution(m.Model):
 
     @property
     def other_person(self):
-        """Get the person on the other side of this balance."""
-        return self.resolution.persons.exclude(id=self.person.id).get()
+        """Get the person on the other side of this balance. Uses the
+        prefetched sides of the resolution when they are loaded.
+        """
+        if "personresolution_set" in getattr(
+            self.resolution, "_prefetched_objects_cache", {}
+        ):
+            for person_resolution in self.resolution.personresolution_set.all():
+                if person_resolution.person_id != self.person_id:
+                    return person_resolution.person
+        return self.resolution.persons.exclude(id=self.person_id).get()
 
     target_person = other_person
 
@@ -433,3 +552,95 @@ class PersonResolution(m.Model):
             },
             "time": self.transaction_time.strftime(DATE_FMT),
         }
+
+
+class Watermark(m.Model):
+    """The time up to which a job has processed changes, so the next run
+    can start from there.
+    """
+
+    name = m.CharField(max_length=100, unique=True)
+    time = m.DateTimeField()
+
+    def __str__(self):
+        return "%s at %s" % (self.name, self.time.strftime(DATE_FMT))
+
+
+class LedgerImport(m.Model):
+    """The progress of an import of transactions from another system, so an
+    interrupted import can resume after the last batch it saved.
+    """
+
+    name = m.CharField(max_length=255, unique=True)
+    rows = m.IntegerField(default=0, help_text="Input rows read so far.")
+    imported = m.IntegerField(default=0)
+    errors = m.IntegerField(default=0)
+    time_updated = m.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "Import %s, %s rows read" % (self.name, self.rows)
+
+
+class BalanceSnapshot(m.Model):
+    """The balances of every pair of persons and the position of every person
+    at a point in time, taken by the snapshot_balances command. Historical
+    balances start from the latest snapshot before the time asked for, see
+    `db.get_balance_as_of`.
+    """
+
+    time = m.DateTimeField(unique=True)
+    time_created = m.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "Balance snapshot at %s" % self.time.strftime(DATE_FMT)
+
+
+class SnapshotBalance(m.Model):
+    """The value of a balance in a snapshot, signed as `Balance.value`. Only
+    balances which are not 0 are stored.
+    """
+
+    # Indexed by the unique constraint below
+    snapshot = m.ForeignKey(
+        "BalanceSnapshot", on_delete=m.CASCADE, related_name="balances", db_index=False
+    )
+    persona = m.ForeignKey(
+        "Person", on_delete=m.CASCADE, related_name="+", db_index=False
+    )
+    personb = m.ForeignKey(
+        "Person", on_delete=m.CASCADE, related_name="+", db_index=False
+    )
+    currency = currency_field(db_index=False)
+    value = m.IntegerField()
+
+    class Meta:
+        constraints = [
+            m.UniqueConstraint(
+                fields=["snapshot", "persona", "personb", "currency"],
+                name="unique_snapshot_balance",
+            ),
+        ]
+
+
+class SnapshotPosition(m.Model):
+    """The net position of a person in a snapshot. Only positions which are
+    not 0 are stored.
+    """
+
+    # Indexed by the unique constraint below
+    snapshot = m.ForeignKey(
+        "BalanceSnapshot", on_delete=m.CASCADE, related_name="positions", db_index=False
+    )
+    person = m.ForeignKey(
+        "Person", on_delete=m.CASCADE, related_name="+", db_index=False
+    )
+    currency = currency_field(db_index=False)
+    value = m.IntegerField()
+
+    class Meta:
+        constraints = [
+            m.UniqueConstraint(
+                fields=["snapshot", "person", "currency"],
+                name="unique_snapshot_position",
+            ),
+        ]
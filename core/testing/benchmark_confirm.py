@@ -0,0 +1,252 @@
+"""
+Benchmark concurrent confirmation of transaction records. Many threads
+confirm pending records between a small group of persons, so they fight
+over the same balances, and every record is confirmed by more than one
+thread. Afterwards the balances and positions are checked against the
+records, to verify no update was lost and no record was applied twice.
+
+bin/benchmark_confirm.sh --threads 16 --records 5000
+"""
+
+from collections import defaultdict
+from optparse import OptionParser
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import django
+
+if __name__ == "__main__":
+    django.setup()
+
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from core import db
+from core import models
+
+
+class ConfirmBenchmark(object):
+
+    def setup_options(self):
+        self.option_parser = parser = OptionParser()
+        parser.add_option(
+            "-t",
+            "--threads",
+            dest="threads",
+            type="int",
+            help="Number of threads confirming records.",
+            default=8,
+        )
+        parser.add_option(
+            "--records",
+            dest="records",
+            type="int",
+            help="Number of pending records to confirm.",
+            default=2000,
+        )
+        parser.add_option(
+            "--persons",
+            dest="persons",
+            type="int",
+            help="Number of persons the records are spread between. Fewer "
+            "persons means more contention on each balance.",
+            default=5,
+        )
+        parser.add_option(
+            "--attempts",
+            dest="attempts",
+            type="int",
+            help="Number of times each record is confirmed.",
+            default=2,
+        )
+        parser.add_option("--seed", dest="seed", type="int", default=1)
+        parser.add_option(
+            "-o", "--output", dest="output", help="Write the results as JSON."
+        )
+
+    def load_options(self, args=None):
+        self.options, self.args = self.option_parser.parse_args(args)
+
+    def create_records(self):
+        """Create persons, a currency and pending records between them."""
+        rng = random.Random(self.options.seed)
+        users = models.User.objects.bulk_create(
+            models.User(username="bench%s" % i) for i in range(self.options.persons)
+        )
+        persons = models.Person.objects.bulk_create(
+            models.Person(user=user) for user in users
+        )
+        currency = models.Currency.objects.create(name="hours")
+        now = timezone.now()
+        records = []
+        for _ in range(self.options.records):
+            creator, target = rng.sample(persons, 2)
+            records.append(
+                models.TransactionRecord(
+                    creator_person=creator,
+                    target_person=target,
+                    from_receiver=rng.random() < 0.5,
+                    currency=currency,
+                    value=rng.randint(1, 100),
+                    transaction_time=now,
+                )
+            )
+        return models.TransactionRecord.objects.bulk_create(records)
+
+    def confirm_all(self, records):
+        """Confirm every record `--attempts` times from `--threads` threads.
+        Returns the counts of each outcome and the elapsed time.
+        """
+        rng = random.Random(self.options.seed)
+        work = [r.id for r in records for _ in range(self.options.attempts)]
+        rng.shuffle(work)
+        pending = queue.Queue()
+        for record_id in work:
+            pending.put(record_id)
+
+        outcomes = defaultdict(int)
+        lock = threading.Lock()
+
+        def worker():
+            counts = defaultdict(int)
+            try:
+                while True:
+                    try:
+                        record_id = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    record = models.TransactionRecord.objects.get(id=record_id)
+                    try:
+                        db.confirm_trans_record(record)
+                        counts["confirmed"] += 1
+                    except ValueError:
+                        counts["already_confirmed"] += 1
+                    except DatabaseError:
+                        counts["errors"] += 1
+            finally:
+                connection.close()
+                with lock:
+                    for key, count in counts.items():
+                        outcomes[key] += count
+
+        threads = [threading.Thread(target=worker) for _ in range(self.options.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return dict(outcomes), time.perf_counter() - started
+
+    def verify(self, records):
+        """Compare the balances and positions to the sum of the confirmed
+        records. Returns a list of problems found.
+        """
+        problems = []
+        expected = defaultdict(int)
+        confirmed = models.TransactionRecord.objects.filter(
+            id__in=[r.id for r in records], transaction__isnull=False
+        ).count()
+        for record in records:
+            persona_id, personb_id, delta = db.balance_delta(
+                record.provider.id, record.receiver.id, record.value
+            )
+            expected[persona_id, personb_id] += delta
+
+        actual = dict(
+            ((persona_id, personb_id), value)
+            for persona_id, personb_id, value in models.Balance.objects.values_list(
+                "persona_id", "personb_id", "value"
+            )
+        )
+        for pair in sorted(set(expected) | set(actual)):
+            if expected.get(pair, 0) != actual.get(pair, 0):
+                problems.append(
+                    "Balance %s-%s is %s, expected %s"
+                    % (pair + (actual.get(pair, 0), expected.get(pair, 0)))
+                )
+        positions = defaultdict(int)
+        for (persona_id, personb_id), value in expected.items():
+            positions[persona_id] -= value
+            positions[personb_id] += value
+        for person_id, value in models.Position.objects.values_list(
+            "person_id", "value"
+        ):
+            if positions.get(person_id, 0) != value:
+                problems.append(
+                    "Position of %s is %s, expected %s"
+                    % (person_id, value, positions.get(person_id, 0))
+                )
+        if confirmed != len(records):
+            problems.append("%s of %s records confirmed" % (confirmed, len(records)))
+        transactions = models.Transaction.objects.count()
+        if transactions != len(records):
+            problems.append(
+                "%s transactions for %s records" % (transactions, len(records))
+            )
+        return problems
+
+    def run(self):
+        records = self.create_records()
+        outcomes, elapsed = self.confirm_all(records)
+        problems = self.verify(records)
+        return {
+            "vendor": connection.vendor,
+            "threads": self.options.threads,
+            "records": len(records),
+            "attempts": len(records) * self.options.attempts,
+            "outcomes": outcomes,
+            "elapsed": elapsed,
+            "confirmed_per_second": outcomes.get("confirmed", 0) / elapsed,
+            "problems": problems,
+        }
+
+    def print_result(self, result):
+        print(
+            "%s threads  %s records  %s attempts  %.3fs  %.1f confirmed/s  %s"
+            % (
+                result["threads"],
+                result["records"],
+                result["attempts"],
+                result["elapsed"],
+                result["confirmed_per_second"],
+                ", ".join("%s %s" % i for i in sorted(result["outcomes"].items())),
+            )
+        )
+        for problem in result["problems"]:
+            print(problem)
+        if not result["problems"]:
+            print("No lost or repeated updates.")
+
+    def start(self):
+        self.setup_options()
+        self.load_options()
+
+        # Threads need a database they can share, SQLite's in-memory test
+        # database is private to each connection
+        test_settings = connection.settings_dict.setdefault("TEST", {})
+        if connection.vendor == "sqlite" and not test_settings.get("NAME"):
+            test_settings["NAME"] = os.path.join(
+                tempfile.mkdtemp(), "benchmark_confirm.sqlite3"
+            )
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            result = self.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.print_result(result)
+        if self.options.output:
+            with open(self.options.output, "w") as output:
+                json.dump(result, output, indent=2)
+        if result["problems"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    ConfirmBenchmark().start()
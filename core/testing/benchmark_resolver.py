@@ -0,0 +1,254 @@
+"""
+Benchmark the balance resolver over generated debt graphs. Options after
+a `--` are passed to the resolver, for example:
+
+bin/benchmark_resolver.sh --sizes 1000,100000 --db -- --batch -s best
+"""
+
+from optparse import OptionParser
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import django
+
+if __name__ == "__main__":
+    django.setup()
+
+from django.core.management import call_command
+from django.db import connection
+
+from core import models
+from core.jobs.resolve_balances import BalanceResolver
+from core.testing.generators import rand_debt_edges
+
+
+class ResolverBenchmark(object):
+
+    def setup_options(self):
+        self.option_parser = parser = OptionParser()
+        parser.add_option(
+            "--sizes",
+            dest="sizes",
+            help="Comma separated numbers of balances to benchmark.",
+            default="100,1000,10000,100000",
+        )
+        parser.add_option(
+            "--density",
+            dest="density",
+            type="float",
+            help="Average number of balances per person.",
+            default=5,
+        )
+        parser.add_option(
+            "--currencies",
+            dest="currencies",
+            type="int",
+            help="Number of currencies the balances are spread over.",
+            default=1,
+        )
+        parser.add_option(
+            "--cycle-ratio",
+            dest="cycle_ratio",
+            type="float",
+            help="Fraction of balances which are placed on cycles.",
+            default=0.5,
+        )
+        parser.add_option(
+            "--max-cycle",
+            dest="max_cycle",
+            type="int",
+            help="Largest number of persons in a generated cycle.",
+            default=6,
+        )
+        parser.add_option("--seed", dest="seed", type="int", default=1)
+        parser.add_option(
+            "--db",
+            dest="db",
+            action="store_true",
+            help="Load the graphs into a test database and resolve from there. "
+            "By default graphs are resolved from a snapshot file.",
+        )
+        parser.add_option(
+            "--no-memory",
+            dest="memory",
+            action="store_false",
+            default=True,
+            help="Don't trace peak memory, which slows down the run.",
+        )
+        parser.add_option(
+            "-o", "--output", dest="output", help="Write the results as JSON."
+        )
+
+    def load_options(self, args=None):
+        self.options, self.resolver_args = self.option_parser.parse_args(args)
+
+    def generate(self, size, seed):
+        """Generate the edges of a debt graph for each currency."""
+        rng = random.Random(seed)
+        persons = max(self.options.max_cycle, int(size / self.options.density))
+        graphs, remaining = [], size
+        for number in range(self.options.currencies, 0, -1):
+            balances = remaining // number
+            remaining -= balances
+            graphs.append(
+                rand_debt_edges(
+                    balances,
+                    persons,
+                    self.options.cycle_ratio,
+                    self.options.max_cycle,
+                    rng=rng,
+                )
+            )
+        return graphs
+
+    def write_snapshot(self, graphs):
+        """Write the graphs to a snapshot file for the resolver."""
+        snapshot = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        with snapshot:
+            json.dump(
+                {"currencies": dict(enumerate(graphs, 1))},
+                snapshot,
+            )
+        return snapshot.name
+
+    def load_database(self, graphs):
+        """Create persons, currencies and balances for the graphs."""
+        persons = max(max(e[1], e[2]) for edges in graphs for e in edges)
+        users = models.User.objects.bulk_create(
+            models.User(username="bench%s" % i) for i in range(persons)
+        )
+        person_ids = [None] + [
+            p.id
+            for p in models.Person.objects.bulk_create(
+                models.Person(user=user) for user in users
+            )
+        ]
+        for number, edges in enumerate(graphs, 1):
+            currency = models.Currency.objects.create(name="currency%s" % number)
+            balances = models.Balance.objects.bulk_create(
+                (
+                    models.Balance(
+                        currency=currency,
+                        persona_id=person_ids[min(debted, credited)],
+                        personb_id=person_ids[max(debted, credited)],
+                        value=value if debted < credited else -value,
+                    )
+                    for _, debted, credited, value in edges
+                ),
+                batch_size=5000,
+            )
+            models.PersonBalance.objects.bulk_create(
+                (
+                    models.PersonBalance(balance=balance, person_id=person_id)
+                    for balance in balances
+                    for person_id in (balance.persona_id, balance.personb_id)
+                ),
+                batch_size=5000,
+            )
+
+    def resolve(self, args):
+        """Run the resolver and return its report, the number of queries and
+        the peak memory used.
+        """
+        resolver = BalanceResolver()
+        resolver.setup_options()
+        resolver.load_options(args + self.resolver_args)
+        resolver.setup_logging()
+        if not resolver.options.verbose:
+            resolver.log.setLevel(logging.WARNING)
+
+        if self.options.memory:
+            tracemalloc.start()
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            with resolver.timer("total"):
+                resolver.run()
+        peak = None
+        if self.options.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return resolver.build_report(), queries[0], peak
+
+    def run_size(self, size):
+        """Benchmark one size of graph."""
+        started = time.perf_counter()
+        graphs = self.generate(size, self.options.seed)
+        generated = time.perf_counter() - started
+
+        if not self.options.db:
+            snapshot = self.write_snapshot(graphs)
+            try:
+                return self.build_result(
+                    size, generated, self.resolve(["--snapshot", snapshot])
+                )
+            finally:
+                os.remove(snapshot)
+
+        try:
+            self.load_database(graphs)
+            return self.build_result(size, generated, self.resolve([]))
+        finally:
+            call_command("flush", interactive=False, verbosity=0)
+
+    def build_result(self, size, generated, resolved):
+        report, queries, peak = resolved
+        return {
+            "balances": size,
+            "generate": generated,
+            "queries": queries,
+            "peak_memory": peak,
+            "report": report,
+        }
+
+    def print_result(self, result):
+        timings = result["report"]["timings"]
+        stats = result["report"]["stats"]
+        peak = result["peak_memory"]
+        print(
+            "%10s balances  %8.3fs total  %8.3fs load  %8.3fs search  "
+            "%8.3fs write  %7s queries  %9s peak  %8s chains  %10s cleared"
+            % (
+                result["balances"],
+                timings.get("total", 0),
+                timings.get("load", 0),
+                timings.get("search", 0),
+                timings.get("write", 0),
+                result["queries"],
+                "-" if peak is None else "%.1fMB" % (peak / 2.0**20),
+                stats.get("resolved", 0),
+                stats.get("cleared", 0),
+            )
+        )
+
+    def start(self):
+        self.setup_options()
+        self.load_options()
+        results = []
+        if self.options.db:
+            old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            for size in self.options.sizes.split(","):
+                result = self.run_size(int(size))
+                self.print_result(result)
+                results.append(result)
+        finally:
+            if self.options.db:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if self.options.output:
+            with open(self.options.output, "w") as output:
+                json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    ResolverBenchmark().start()
@@ -6,7 +6,7 @@ import random
 import string
 from datetime import datetime, timedelta
 
-def rand_string(length=10, letters=string.letters):
+def rand_string(length=10, letters=string.ascii_letters):
 	letters = list(letters)
 	if length > 25:
 		letters.extend([' ', '.', ',', '-', '!', '\n'])
@@ -23,7 +23,40 @@ def rand_date(min_days_ago=1, max_days_ago=100):
 	days = random.randint(min_days_ago, max_days_ago)
 	return datetime.now() - timedelta(days, random.randint(0, 60*60*24))
 
-letters = list(string.letters)
+letters = list(string.ascii_letters)
 def rand_char(pool=letters):
 	return pool.pop(random.randint(0, len(pool) - 1))
-	
+
+def rand_debt_edges(balances, persons, cycle_ratio=0.5, max_cycle=6,
+		max_value=200, rng=random):
+	"""Generate (balance_id, debted_id, credited_id, value) tuples for a
+	random graph of debts between persons numbered 1 to `persons`.
+
+	About `cycle_ratio` of the balances are placed on chains of 3 to
+	`max_cycle` persons which close into a cycle. The rest are debted from
+	a lower to a higher person id, so they are never part of a cycle. Pass
+	a seeded `random.Random` as `rng` for a repeatable graph.
+	"""
+	if balances > persons * (persons - 1) // 2:
+		raise ValueError("Too many balances (%s) for %s persons" % (
+			balances, persons))
+	if persons < max_cycle:
+		raise ValueError("Need at least %s persons" % max_cycle)
+
+	person_ids = range(1, persons + 1)
+	edges, pairs = [], set()
+	while len(edges) < balances:
+		if rng.random() < cycle_ratio:
+			members = rng.sample(person_ids, rng.randint(3, max_cycle))
+			chain = zip(members, members[1:] + members[:1])
+		else:
+			chain = [sorted(rng.sample(person_ids, 2))]
+
+		for debted, credited in chain:
+			pair = (min(debted, credited), max(debted, credited))
+			if pair in pairs or len(edges) == balances:
+				continue
+			pairs.add(pair)
+			edges.append((len(edges) + 1, debted, credited,
+				rng.randint(1, max_value)))
+	return edges
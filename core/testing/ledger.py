@@ -0,0 +1,311 @@
+"""
+Build a generated ledger straight into the database, for tests and
+benchmarks at realistic sizes. Rows are written with bulk inserts, and the
+balances and positions are summed in memory as the transactions are
+generated, so they are written once at the end.
+"""
+
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from core import db
+from core import models
+
+
+class LedgerBuilder(object):
+    """Generate users, currencies, confirmed and pending transactions,
+    resolutions and exchange rates from a seed. The same options and seed
+    build the same ledger.
+
+    Each person trades with up to `partners` neighbours, so the number of
+    balances grows with the number of users rather than its square.
+    Resolutions are generated as chains of three neighbours, each chain
+    clearing the same value around its persons.
+    """
+
+    def __init__(
+        self,
+        users=100,
+        currencies=2,
+        transactions=1000,
+        pending=100,
+        resolutions=20,
+        exchange_rates=20,
+        partners=8,
+        days=90,
+        seed=1,
+        prefix="user",
+        batch_size=5000,
+        progress=None,
+    ):
+        if users < 3:
+            raise ValueError("Need at least 3 users, got %s" % users)
+        self.users = users
+        self.currencies = currencies
+        self.transactions = transactions
+        self.pending = pending
+        self.resolutions = resolutions
+        self.exchange_rates = exchange_rates
+        self.partners = max(2, min(partners, (users - 1) // 2))
+        self.days = days
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.progress = progress or (lambda stage, done, total: None)
+        self.rng = random.Random(seed)
+        self.now = timezone.now()
+        self.deltas = {}
+
+    def chunks(self, total):
+        """Yield the sizes of the batches for `total` rows."""
+        for start in range(0, total, self.batch_size):
+            yield min(self.batch_size, total - start)
+
+    def rand_time(self):
+        return self.now - datetime.timedelta(
+            seconds=self.rng.randint(0, self.days * 86400)
+        )
+
+    def rand_pair(self):
+        """A random person and one of their neighbours."""
+        index = self.rng.randrange(len(self.person_ids))
+        offset = self.rng.randint(1, self.partners) * self.rng.choice((-1, 1))
+        other = (index + offset) % len(self.person_ids)
+        return self.person_ids[index], self.person_ids[other]
+
+    def rand_value(self, currency):
+        return self.rng.randint(1, 200) * 10**currency.decimal_places
+
+    def add_delta(self, currency_id, provider_id, receiver_id, value):
+        persona_id, personb_id, delta = db.balance_delta(
+            provider_id, receiver_id, value
+        )
+        key = (persona_id, personb_id, currency_id)
+        self.deltas[key] = self.deltas.get(key, 0) + delta
+
+    def build_users(self):
+        password = make_password("password")
+        for done, size in enumerate(self.chunks(self.users)):
+            start = done * self.batch_size
+            users = models.User.objects.bulk_create(
+                models.User(
+                    username="%s%s" % (self.prefix, i),
+                    email="%s%s@example.com" % (self.prefix, i),
+                    password=password,
+                )
+                for i in range(start, start + size)
+            )
+            persons = models.Person.objects.bulk_create(
+                models.Person(user=user, default_currency=self.currency_list[0])
+                for user in users
+            )
+            self.person_ids.extend(p.id for p in persons)
+            self.progress("users", len(self.person_ids), self.users)
+
+    def build_currencies(self):
+        self.currency_list = models.Currency.objects.bulk_create(
+            models.Currency(
+                name="%s currency %s" % (self.prefix, i),
+                decimal_places=self.rng.randint(0, 2),
+            )
+            for i in range(self.currencies)
+        )
+
+    def build_records(self, total, confirmed):
+        """Write `total` transactions. Confirmed transactions get a record from
+        each side, pending ones only the record of their creator, and about
+        one in ten of those are rejected.
+        """
+        done = 0
+        for size in self.chunks(total):
+            sides = []
+            for _ in range(size):
+                provider_id, receiver_id = self.rand_pair()
+                currency = self.rng.choice(self.currency_list)
+                sides.append(
+                    (
+                        provider_id,
+                        receiver_id,
+                        currency,
+                        self.rand_value(currency),
+                        self.rand_time(),
+                    )
+                )
+
+            transactions = [None] * size
+            if confirmed:
+                transactions = models.Transaction.objects.bulk_create(
+                    models.Transaction() for _ in sides
+                )
+
+            records = []
+            for trans, (provider_id, receiver_id, currency, value, time) in zip(
+                transactions, sides
+            ):
+                from_receiver = self.rng.random() < 0.5
+                creators = [receiver_id] if from_receiver else [provider_id]
+                if confirmed:
+                    creators = [provider_id, receiver_id]
+                    self.add_delta(currency.id, provider_id, receiver_id, value)
+                for creator_id in creators:
+                    records.append(
+                        models.TransactionRecord(
+                            transaction=trans,
+                            creator_person_id=creator_id,
+                            target_person_id=(
+                                receiver_id
+                                if creator_id == provider_id
+                                else provider_id
+                            ),
+                            from_receiver=creator_id == receiver_id,
+                            rejected=not confirmed and self.rng.random() < 0.1,
+                            currency=currency,
+                            value=value,
+                            transaction_time=time,
+                        )
+                    )
+            records = models.TransactionRecord.objects.bulk_create(records)
+            # bulk_create sets auto_now_add fields to the current time, set
+            # them to the generated time with one update for each table
+            models.TransactionRecord.objects.filter(
+                id__in=[r.id for r in records]
+            ).update(time_created=F("transaction_time"))
+            if confirmed:
+                models.Transaction.objects.filter(
+                    id__in=[t.id for t in transactions]
+                ).update(
+                    time_confirmed=Subquery(
+                        models.TransactionRecord.objects.filter(
+                            transaction=OuterRef("id"), from_receiver=False
+                        ).values("transaction_time")
+                    )
+                )
+            done += size
+            self.progress("transactions" if confirmed else "pending", done, total)
+
+    def build_resolutions(self):
+        done = 0
+        for size in self.chunks(self.resolutions):
+            chains = []
+            for _ in range(size):
+                index = self.rng.randrange(len(self.person_ids))
+                step = self.rng.choice((-1, 1))
+                persons = [
+                    self.person_ids[(index + step * i) % len(self.person_ids)]
+                    for i in range(3)
+                ]
+                currency = self.rng.choice(self.currency_list)
+                value = self.rand_value(currency)
+                time = self.rand_time()
+                for debted_id, credited_id in zip(persons, persons[1:] + persons[:1]):
+                    chains.append((debted_id, credited_id, currency, value, time))
+
+            resolutions = models.Resolution.objects.bulk_create(
+                models.Resolution(currency=currency, value=value)
+                for _, _, currency, value, _ in chains
+            )
+            for resolution, chain in zip(resolutions, chains):
+                resolution.time_confirmed = chain[4]
+            models.Resolution.objects.bulk_update(
+                resolutions, ["time_confirmed"], batch_size=200
+            )
+            person_resolutions = []
+            for resolution, (debted_id, credited_id, currency, value, time) in zip(
+                resolutions, chains
+            ):
+                person_resolutions.append(
+                    models.PersonResolution(
+                        resolution=resolution, person_id=debted_id, credited=True
+                    )
+                )
+                person_resolutions.append(
+                    models.PersonResolution(
+                        resolution=resolution, person_id=credited_id, credited=False
+                    )
+                )
+                # Resolving reduces the debt, the credited person is the provider
+                self.add_delta(currency.id, credited_id, debted_id, value)
+            models.PersonResolution.objects.bulk_create(person_resolutions)
+            done += size
+            self.progress("resolutions", done, self.resolutions)
+
+    def build_balances(self):
+        """Write the balances and positions summed from the transactions and
+        resolutions.
+        """
+        positions = {}
+        keys = sorted(self.deltas)
+        for start in range(0, len(keys), self.batch_size):
+            chunk = keys[start : start + self.batch_size]
+            balances = models.Balance.objects.bulk_create(
+                models.Balance(
+                    persona_id=persona_id,
+                    personb_id=personb_id,
+                    currency_id=currency_id,
+                    value=self.deltas[persona_id, personb_id, currency_id],
+                )
+                for persona_id, personb_id, currency_id in chunk
+            )
+            models.PersonBalance.objects.bulk_create(
+                models.PersonBalance(balance=balance, person_id=person_id)
+                for balance in balances
+                for person_id in (balance.persona_id, balance.personb_id)
+            )
+            self.progress("balances", start + len(chunk), len(keys))
+
+        for (persona_id, personb_id, currency_id), delta in self.deltas.items():
+            for person_id, value in ((persona_id, -delta), (personb_id, delta)):
+                key = (person_id, currency_id)
+                positions[key] = positions.get(key, 0) + value
+        models.Position.objects.bulk_create(
+            (
+                models.Position(
+                    person_id=person_id, currency_id=currency_id, value=value
+                )
+                for (person_id, currency_id), value in sorted(positions.items())
+            ),
+            batch_size=self.batch_size,
+        )
+
+    def build_exchange_rates(self):
+        if len(self.currency_list) < 2:
+            return
+        rates = {}
+        for _ in range(self.exchange_rates):
+            person_id = self.rng.choice(self.person_ids)
+            source, dest = self.rng.sample(self.currency_list, 2)
+            rates[person_id, source.id, dest.id] = (
+                self.rng.randint(1, 200),
+                self.rng.randint(1, 200),
+            )
+        models.ExchangeRate.objects.bulk_create(
+            (
+                models.ExchangeRate(
+                    person_id=person_id,
+                    source_currency_id=source_id,
+                    dest_currency_id=dest_id,
+                    source_rate=source_rate,
+                    dest_rate=dest_rate,
+                )
+                for (person_id, source_id, dest_id), (
+                    source_rate,
+                    dest_rate,
+                ) in sorted(rates.items())
+            ),
+            batch_size=self.batch_size,
+        )
+
+    def build(self):
+        """Build the ledger. Returns the persons created, by their order."""
+        self.person_ids = []
+        self.build_currencies()
+        self.build_users()
+        self.build_records(self.transactions, confirmed=True)
+        self.build_records(self.pending, confirmed=False)
+        self.build_resolutions()
+        self.build_balances()
+        self.build_exchange_rates()
+        return self.person_ids
@@ -2,10 +2,31 @@
  Unittests!
 """
 from decimal import Decimal
-from django.test import TestCase 
+import collections
+import csv
+import io
+import json
+import datetime
+import logging
+from unittest import mock
+import random
+import tempfile
+import time
+from unittest import skipUnless
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
 from core import db
+from core import export
 from core import models
+from core.graph import DebtGraph
+from core.jobs.resolve_balances import BalanceResolver
+from core.testing.generators import rand_debt_edges
+from core.testing.ledger import LedgerBuilder
 
 class DBTestCase(TestCase):
 	fixtures = ['testing/base.json']
@@ -82,3 +103,949 @@ class CurrencyModelTestCase(TestCase):
 			rep = '%s %s' % (result, self.currency_name)
 			self.assertEqual(c.value_repr(value), rep)
 
+
+class DebtGraphTestCase(TestCase):
+
+	def setUp(self):
+		# 1 -> 2 -> 3 -> 1 and 1 -> 4 -> 5 -> 6 -> 1
+		self.graph = DebtGraph.from_edges([
+			(10, 1, 2, 50),
+			(11, 2, 3, 20),
+			(12, 3, 1, 30),
+			(13, 1, 4, 5),
+			(14, 4, 5, 5),
+			(15, 5, 6, 5),
+			(16, 6, 1, 5),
+			(17, 6, 7, 9),
+		])
+
+	def test_find_cycle(self):
+		cycle = self.graph.find_cycle(0, 2)
+		self.assertEqual(
+			[leg[0] for leg in self.graph.legs(cycle)],
+			[10, 11, 12]
+		)
+		self.assertEqual(self.graph.bottleneck(cycle), 20)
+
+	def test_find_cycle_limit(self):
+		self.assertEqual(self.graph.find_cycle(3, 2), None)
+		self.assertEqual(len(self.graph.find_cycle(3, 3)), 4)
+		self.assertEqual(self.graph.find_cycle(7, 10), None)
+
+	def test_split(self):
+		components = self.graph.split()
+		self.assertEqual(len(components), 1)
+		self.assertEqual(sorted(components[0].person_ids), [1, 2, 3, 4, 5, 6])
+		self.assertEqual(sorted(components[0].balance_ids), list(range(10, 17)))
+
+		self.graph.reduce([0], 50)
+		components = self.graph.split()
+		self.assertEqual(sorted(components[0].person_ids), [1, 4, 5, 6])
+
+	def test_find_cycles(self):
+		found = list(self.graph.find_cycles(3))
+		self.assertEqual([value for cycle, value in found], [20, 5])
+		self.assertEqual(self.graph.values, [30, 0, 10, 0, 0, 0, 0, 9])
+		self.assertEqual(list(self.graph.find_cycles(3)), [])
+
+	def test_find_best_cycles(self):
+		# 1 -> 2 -> 3 -> 1 is shortest, 1 -> 2 -> 4 -> 5 -> 1 clears more
+		edges = [
+			(20, 1, 2, 50),
+			(21, 2, 3, 50),
+			(22, 3, 1, 50),
+			(23, 2, 4, 50),
+			(24, 4, 5, 50),
+			(25, 5, 1, 50),
+		]
+		first = DebtGraph.from_edges(edges)
+		found = list(first.find_cycles(3))
+		self.assertEqual([(len(c), v) for c, v in found], [(3, 50)])
+		best = DebtGraph.from_edges(edges)
+		found = list(best.find_cycles(3, 'best'))
+		self.assertEqual([(len(c), v) for c, v in found], [(4, 50)])
+
+	def test_rand_debt_edges(self):
+		edges = rand_debt_edges(500, 100, rng=random.Random(4))
+		self.assertEqual(edges, rand_debt_edges(500, 100, rng=random.Random(4)))
+		self.assertEqual(len(edges), 500)
+		self.assertEqual(
+			len(set(frozenset(edge[1:3]) for edge in edges)),
+			500
+		)
+		self.assertGreater(len(DebtGraph.from_edges(edges).split()), 0)
+		self.assertRaises(ValueError, rand_debt_edges, 50, 10)
+
+
+def create_balance(currency, provider, receiver, value):
+	transfer = models.Resolution(currency=currency, value=value)
+	return db.new_balance(transfer, provider.person, receiver.person)
+
+
+class BalanceTestCase(TestCase):
+
+	def setUp(self):
+		self.currency = models.Currency.objects.create(name='hours')
+		self.a, self.b = [
+			models.User.objects.create_user('user%s' % i, 'u%s@example.com' % i)
+			for i in range(2)
+		]
+
+	def transfer(self, provider, receiver, value):
+		transfer = models.Resolution(currency=self.currency, value=value)
+		db.update_balance(transfer, provider.person, receiver.person)
+
+	def test_update_balance(self):
+		a, b = self.b, self.a
+		self.transfer(a, b, 10)
+		balance = db.get_balance(a.person, b.person, self.currency)
+		self.assertEqual(balance, db.get_balance(b.person.id, a.person.id, self.currency))
+		self.assertEqual((balance.persona, balance.personb), (b.person, a.person))
+		self.assertEqual(balance.value, -10)
+		self.assertEqual(balance.debted, a.person)
+		self.assertEqual(balance.persons.count(), 2)
+
+		with self.assertNumQueries(2):
+			self.transfer(b, a, 25)
+		balance.refresh_from_db()
+		self.assertEqual(balance.value, 15)
+		self.assertEqual((balance.debted, balance.credited), (b.person, a.person))
+		self.assertEqual(models.Balance.objects.count(), 1)
+
+	def test_positions(self):
+		a, b = self.a, self.b
+		self.assertEqual(db.get_position(a.person, self.currency).value, 0)
+		self.transfer(a, b, 10)
+		self.transfer(b, a, 4)
+		with self.assertNumQueries(1):
+			self.assertEqual(db.get_position(a.person, self.currency).value, -6)
+		self.assertEqual(db.get_position(b.person, self.currency).value, 6)
+
+		models.Position.objects.filter(person=a.person).update(value=0)
+		models.Position.objects.filter(person=b.person).delete()
+		self.assertEqual(db.rebuild_positions(), 2)
+		self.assertEqual(db.rebuild_positions(), 0)
+		self.assertEqual(
+			sorted(db.get_positions(b).values_list('value', flat=True)), [6])
+
+	def test_credit_limit(self):
+		a, b = self.a, self.b
+		self.currency.credit_limit = 20
+		self.currency.save()
+		db.confirm_trans_record(self.create_record(15))
+		record = self.create_record(10)
+		with self.assertNumQueries(1):
+			self.assertRaises(
+				db.CreditLimitExceeded,
+				db.check_credit_limit, a.person, self.currency, 10)
+		self.assertRaises(db.CreditLimitExceeded, db.confirm_trans_record, record)
+		self.assertRaises(
+			db.CreditLimitExceeded, db.confirm_trans_records, [record.id], b)
+		self.assertEqual(db.get_position(a.person, self.currency).value, -15)
+		self.assertEqual(
+			models.TransactionRecord.objects.get(id=record.id).status, 'pending')
+
+		# Paying back is always allowed, and a person can have their own limit
+		self.transfer(b, a, 5)
+		models.Position.objects.filter(person=a.person).update(credit_limit=30)
+		db.check_credit_limit(a.person, self.currency, 20)
+		db.confirm_trans_records([record.id], b)
+		self.assertEqual(db.get_position(a.person, self.currency).value, -20)
+
+	def test_get_balances(self):
+		a, b = self.a, self.b
+		self.transfer(a, b, 10)
+		balance, = db.get_balances(a)
+		self.assertEqual(balance.other_person, b.person)
+		self.assertEqual(balance.relative_value, Decimal(-10))
+		self.assertEqual(list(db.get_balances(a, credited=True)), [])
+		self.assertEqual(list(db.get_balances(b, credited=True)), [
+			models.PersonBalance.objects.get(person=b.person)
+		])
+
+		self.transfer(b, a, 10)
+		self.assertEqual(list(db.get_balances(a)), [])
+		self.assertEqual(len(db.get_balances(a, include_balanced=True)), 1)
+
+	def create_record(self, value, from_receiver=False):
+		return models.TransactionRecord.objects.create(
+			creator_person=self.a.person,
+			target_person=self.b.person,
+			from_receiver=from_receiver,
+			currency=self.currency,
+			value=value,
+			transaction_time=timezone.now(),
+		)
+
+	def test_confirm_trans_record_once(self):
+		record = self.create_record(10)
+		stale = models.TransactionRecord.objects.get(id=record.id)
+		db.confirm_trans_record(record)
+		self.assertRaises(ValueError, db.confirm_trans_record, stale)
+		self.assertRaises(ValueError, db.reject_trans_record, record.id, self.b)
+
+		self.assertEqual(models.Transaction.objects.count(), 1)
+		self.assertEqual(models.TransactionRecord.objects.count(), 2)
+		balance = db.get_balance(self.a.person, self.b.person, self.currency)
+		self.assertEqual(balance.value, 10)
+
+	def test_reject_trans_record(self):
+		record = self.create_record(10)
+		db.reject_trans_record(record.id, self.b)
+		self.assertRaises(ValueError, db.confirm_trans_record, record)
+		self.assertEqual(models.Balance.objects.count(), 0)
+
+	def test_confirm_trans_records(self):
+		records = [
+			self.create_record(10),
+			self.create_record(25, from_receiver=True),
+			self.create_record(3),
+		]
+		db.reject_trans_record(records[2].id, self.b)
+		ids = [r.id for r in records]
+		self.assertEqual(db.confirm_trans_records(ids, self.a), [])
+
+		confirmed = db.confirm_trans_records(ids, self.b)
+		self.assertEqual(confirmed, records[:2])
+		self.assertEqual(db.confirm_trans_records(ids, self.b), [])
+		self.assertEqual(models.TransactionRecord.objects.filter(
+			transaction__isnull=False).count(), 4)
+		balance = db.get_balance(self.a.person, self.b.person, self.currency)
+		self.assertEqual(balance.debted, self.b.person)
+		self.assertEqual(abs(balance.value), 15)
+
+		records = [self.create_record(5), self.create_record(7)]
+		with self.assertNumQueries(9):
+			db.confirm_trans_records([r.id for r in records], self.b)
+		balance.refresh_from_db()
+		self.assertEqual(abs(balance.value), 3)
+
+	def test_reject_trans_records(self):
+		records = [self.create_record(10), self.create_record(5)]
+		db.confirm_trans_record(records[0])
+		ids = [r.id for r in records]
+		self.assertEqual(db.reject_trans_records(ids, self.a), 0)
+		self.assertEqual(db.reject_trans_records(ids, self.b), 1)
+		self.assertEqual(
+			models.TransactionRecord.objects.get(id=records[1].id).status, 'rejected')
+
+
+class BalanceResolverTestCase(TestCase):
+
+	def setUp(self):
+		self.currency = models.Currency.objects.create(name='hours')
+		self.users = [
+			models.User.objects.create_user('user%s' % i, 'u%s@example.com' % i)
+			for i in range(4)
+		]
+		a, b, c, d = self.users
+		self.balances = [
+			create_balance(self.currency, a, b, 40),
+			create_balance(self.currency, b, c, 25),
+			create_balance(self.currency, c, a, 30),
+			create_balance(self.currency, c, d, 10),
+		]
+		self.resolver = BalanceResolver()
+		self.resolver.setup_options()
+		self.resolver.load_options([])
+		self.resolver.setup_logging()
+
+	def assertPositions(self, values):
+		self.assertEqual(
+			[db.get_position(u.person, self.currency).value for u in self.users],
+			values
+		)
+
+	def test_run(self):
+		self.assertPositions([-10, 15, -15, 10])
+		self.resolver.run()
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[15, 0, -5, 10]
+		)
+		self.assertPositions([-10, 15, -15, 10])
+		self.assertEqual(models.Resolution.objects.count(), 3)
+		self.assertEqual(self.resolver.stats['resolved'], 1)
+		a, b, c, d = self.users
+		self.assertEqual(
+			set(pr.person_id for pr in models.PersonResolution.objects.filter(credited=True)),
+			set([a.person.id, b.person.id, c.person.id])
+		)
+
+	def test_run_batch(self):
+		self.resolver.load_options(['--batch', '--chunk-size', '2'])
+		self.resolver.run()
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[15, 0, -5, 10]
+		)
+		self.assertPositions([-10, 15, -15, 10])
+		self.assertEqual(models.Resolution.objects.count(), 3)
+		self.assertEqual(models.PersonResolution.objects.count(), 6)
+		for resolution in models.Resolution.objects.all():
+			self.assertEqual(resolution.value, 25)
+			self.assertEqual(resolution.persons.count(), 2)
+
+	def test_save_resolutions_whole_chains(self):
+		legs, _ = db.find_balance_chain(self.balances[0].id, 3)
+		save_chunk = db._save_resolution_chunk
+		chunks = []
+
+		def fail_second_chunk(chunk):
+			chunks.append(chunk)
+			if len(chunks) > 1:
+				raise OperationalError('database is locked')
+			return save_chunk(chunk)
+
+		# Each 3 leg chain is a chunk of its own, the first is committed
+		resolutions = [(self.currency.id, 5, legs), (self.currency.id, 5, legs)]
+		with mock.patch.object(db, '_save_resolution_chunk', fail_second_chunk):
+			self.assertRaises(
+				OperationalError, db.save_resolutions, resolutions, chunk_size=2)
+		self.assertEqual([len(c) for c in chunks], [1, 1])
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[35, 20, -25, 10]
+		)
+		self.assertPositions([-10, 15, -15, 10])
+		self.assertEqual(models.Resolution.objects.count(), 3)
+
+	def test_save_resolutions_stale_chain(self):
+		legs, value = db.find_balance_chain(self.balances[0].id, 3)
+		# The second chain was found before the first cleared b -> c
+		saved = db.save_resolutions(
+			[(self.currency.id, value, legs), (self.currency.id, value, legs)])
+		self.assertEqual(saved, [(self.currency.id, value, legs)])
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[15, 0, -5, 10]
+		)
+		self.assertPositions([-10, 15, -15, 10])
+
+	def test_save_resolutions_stale_chain_stats(self):
+		legs, value = db.find_balance_chain(self.balances[0].id, 3)
+		self.resolver.load_options(['--batch'])
+		self.resolver.save_resolutions(
+			[(self.currency.id, value, legs), (self.currency.id, value, legs)])
+		self.assertEqual(self.resolver.stats['resolved'], 1)
+		self.assertEqual(self.resolver.stats['cleared'], 3 * value)
+		self.assertEqual(dict(self.resolver.chain_lengths), {3: 1})
+
+	def test_run_workers(self):
+		self.resolver.load_options(['--batch', '--workers', '2'])
+		self.resolver.run()
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[15, 0, -5, 10]
+		)
+
+	def test_run_incremental(self):
+		# The runs follow each other at once, see test_run_incremental_late_commit
+		self.resolver.watermark_margin = datetime.timedelta(0)
+		self.resolver.load_options(['--incremental'])
+		self.resolver.run()
+		self.assertEqual(models.Resolution.objects.count(), 3)
+		watermark = db.get_watermark(BalanceResolver.watermark)
+		self.assertNotEqual(watermark, None)
+
+		# Nothing changed, so nothing is searched
+		self.resolver.setup_logging()
+		self.resolver.run()
+		self.assertEqual(self.resolver.stats['components'], 0)
+
+		# d -> e -> c closes a new chain through the unchanged c -> d
+		a, b, c, d = self.users
+		e = models.User.objects.create_user('usere', 'ue@example.com')
+		create_balance(self.currency, d, e, 4)
+		create_balance(self.currency, e, c, 7)
+		self.resolver.setup_logging()
+		self.resolver.run()
+		self.assertEqual(self.resolver.stats['updated_balances'], 2)
+		self.assertEqual(self.resolver.stats['resolved'], 1)
+		self.assertEqual(models.Balance.objects.get(id=self.balances[3].id).value, 6)
+		self.assertGreater(db.get_watermark(BalanceResolver.watermark), watermark)
+
+	def test_run_incremental_late_commit(self):
+		self.resolver.load_options(['--incremental'])
+		self.resolver.run()
+		watermark = db.get_watermark(BalanceResolver.watermark)
+		models.Balance.objects.update(
+			time_updated=watermark - datetime.timedelta(hours=1))
+
+		# Updated just before the run started, but committed after it loaded
+		a, b, c, d = self.users
+		e = models.User.objects.create_user('usere', 'ue@example.com')
+		late = [create_balance(self.currency, d, e, 4), create_balance(self.currency, e, c, 7)]
+		models.Balance.objects.filter(id__in=[b.id for b in late]).update(
+			time_updated=watermark + BalanceResolver.watermark_margin
+			- datetime.timedelta(seconds=1))
+		self.resolver.setup_logging()
+		self.resolver.run()
+		self.assertEqual(self.resolver.stats['updated_balances'], 2)
+		self.assertEqual(self.resolver.stats['resolved'], 1)
+
+	def test_run_best(self):
+		self.resolver.load_options(['--strategy', 'best'])
+		self.resolver.run()
+		self.assertEqual(self.resolver.stats['cleared'], 75)
+
+	def test_dry_run_snapshot(self):
+		snapshot = tempfile.NamedTemporaryFile(suffix='.json')
+		self.resolver.load_options(['--dry-run', '--save-snapshot', snapshot.name])
+		self.resolver.run()
+		self.assertEqual(models.Resolution.objects.count(), 0)
+		self.assertEqual(db.get_watermark(BalanceResolver.watermark), None)
+		report = self.resolver.build_report()
+		self.assertEqual(report['stats']['resolved'], 1)
+		self.assertEqual(report['stats']['cleared'], 75)
+		self.assertEqual(report['chain_lengths'], {3: 1})
+		self.assertEqual(set(report['timings']), set(['load', 'search', 'write']))
+
+		self.resolver.load_options(['--snapshot', snapshot.name])
+		self.resolver.setup_logging()
+		self.resolver.run()
+		self.assertEqual(self.resolver.build_report(), dict(report, timings=mock.ANY))
+		self.assertEqual(models.Resolution.objects.count(), 0)
+
+	def test_find_balance_chain(self):
+		a, b, c, d = self.users
+		legs, value = db.find_balance_chain(self.balances[0].id, 2)
+		self.assertEqual(value, 25)
+		self.assertEqual(legs, [
+			(self.balances[0].id, a.person.id, b.person.id),
+			(self.balances[1].id, b.person.id, c.person.id),
+			(self.balances[2].id, c.person.id, a.person.id),
+		])
+		self.assertEqual(db.find_balance_chain(self.balances[0].id, 1), None)
+		self.assertEqual(db.find_balance_chain(self.balances[3].id, 5), None)
+
+	def test_run_sql(self):
+		self.resolver.load_options(['--backend', 'sql'])
+		self.resolver.run()
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[15, 0, -5, 10]
+		)
+		self.assertEqual(self.resolver.stats['resolved'], 1)
+
+	def confirm_record(self, creator, target, value):
+		record = models.TransactionRecord.objects.create(
+			creator_person=creator.person,
+			target_person=target.person,
+			from_receiver=False,
+			currency=self.currency,
+			value=value,
+			transaction_time=timezone.now(),
+		)
+		db.confirm_trans_record(record)
+
+	def test_resolve_on_confirm(self):
+		a, b, c, d = self.users
+		with self.captureOnCommitCallbacks(execute=True) as callbacks:
+			self.confirm_record(d, c, 4)
+		self.assertEqual(callbacks, [])
+
+		with override_settings(RESOLVE_ON_CONFIRM=True):
+			with self.captureOnCommitCallbacks(execute=True) as callbacks:
+				self.confirm_record(d, b, 6)
+		self.assertEqual(len(callbacks), 1)
+		# c -> d is down to 6, so d -> b -> c -> d is cleared by 6
+		self.assertEqual(
+			[models.Balance.objects.get(id=b.id).value for b in self.balances],
+			[40, 19, -30, 0]
+		)
+
+
+	@override_settings(RESOLVE_ON_CONFIRM=True)
+	def test_resolve_on_confirm_errors(self):
+		a, b, c, d = self.users
+		for error in (OperationalError('database is locked'), RuntimeError('bug')):
+			with mock.patch.object(db, 'save_resolutions', side_effect=error):
+				with self.assertLogs(db.log, logging.INFO):
+					with self.captureOnCommitCallbacks(execute=True) as callbacks:
+						self.confirm_record(d, b, 1)
+			self.assertEqual(len(callbacks), 1)
+		self.assertEqual(
+			models.TransactionRecord.objects.filter(transaction__isnull=False).count(),
+			4)
+		self.assertEqual(models.Resolution.objects.count(), 0)
+
+	def test_resolve_balance_deadline(self):
+		find_balance_chain = db.find_balance_chain
+
+		def slow_search(*args):
+			chain = find_balance_chain(*args)
+			time.sleep(0.06)
+			return chain
+
+		# The chain is found after the budget is spent, so it isn't written
+		with mock.patch.object(db, 'find_balance_chain', slow_search):
+			self.assertEqual(
+				db.resolve_balance(self.balances[0].id, 3, time_budget=0.05), 0)
+		self.assertEqual(models.Resolution.objects.count(), 0)
+		self.assertEqual(db.resolve_balance(self.balances[0].id, 3, time_budget=5), 1)
+		self.assertEqual(models.Resolution.objects.count(), 3)
+
+class ResolveOnConfirmScaleTestCase(TestCase):
+	"""Resolve on confirm in a currency with 120k balances, where searching
+	every balance of the currency would take longer than the time budget.
+	"""
+	persons = 40000
+
+	@classmethod
+	def setUpTestData(cls):
+		cls.currency = models.Currency.objects.create(name='hours')
+		users = models.User.objects.bulk_create(
+			models.User(username='user%s' % i) for i in range(cls.persons))
+		cls.person_ids = [
+			p.id for p in models.Person.objects.bulk_create(
+				models.Person(user=user) for user in users)
+		]
+		# Each person is debted to the next three, so chains only close
+		# around the whole ring
+		ids = cls.person_ids
+		models.Balance.objects.bulk_create(
+			(
+				models.Balance(
+					persona_id=ids[i], personb_id=ids[i + k],
+					currency=cls.currency, value=10)
+				for i in range(len(ids)) for k in (1, 2, 3) if i + k < len(ids)
+			),
+			batch_size=5000)
+		db.rebuild_positions()
+
+	@override_settings(RESOLVE_ON_CONFIRM=True)
+	def test_resolve_on_confirm(self):
+		a, b, c = self.person_ids[100:103]
+		# c pays a 25, so c is debted to a by 15, closing a -> b -> c -> a
+		record = models.TransactionRecord.objects.create(
+			creator_person_id=c, target_person_id=a, from_receiver=False,
+			currency=self.currency, value=25, transaction_time=timezone.now())
+		started = time.perf_counter()
+		with self.captureOnCommitCallbacks(execute=True):
+			db.confirm_trans_record(record)
+		elapsed = time.perf_counter() - started
+		self.assertEqual(models.Resolution.objects.count(), 3)
+		self.assertEqual(
+			[db.get_balance(*pair, self.currency).value for pair in
+				((a, b), (b, c), (a, c))],
+			[0, 0, -5])
+		self.assertLess(elapsed, settings.RESOLVE_ON_CONFIRM_TIME_BUDGET + 0.5)
+
+
+class TransferHistoryTestCase(TestCase):
+
+	def setUp(self):
+		self.currency = models.Currency.objects.create(name='hours')
+		self.a, self.b = [
+			models.User.objects.create_user('user%s' % i, 'u%s@example.com' % i)
+			for i in range(2)
+		]
+		now = timezone.now()
+		self.times = [now - datetime.timedelta(days=i) for i in range(4)]
+		self.records = [
+			models.TransactionRecord.objects.create(
+				creator_person=self.a.person,
+				target_person=self.b.person,
+				from_receiver=False,
+				currency=self.currency,
+				value=i + 1,
+				transaction_time=self.times[i],
+			)
+			for i in (0, 2, 2)
+		]
+		resolution = models.Resolution.objects.create(currency=self.currency, value=5)
+		models.Resolution.objects.filter(id=resolution.id).update(
+			time_confirmed=self.times[1])
+		self.resolution = models.PersonResolution.objects.create(
+			resolution=resolution, person=self.a.person, credited=True)
+
+	def test_get_transfer_history_page(self):
+		expected = [
+			self.records[0], self.resolution, self.records[2], self.records[1]
+		]
+		self.assertEqual(list(db.get_transfer_history(self.a, {})), expected)
+
+		transfers, cursor = db.get_transfer_history_page(self.a, {}, limit=3)
+		self.assertEqual(transfers, expected[:3])
+		cursor = db.decode_history_cursor(db.encode_history_cursor(cursor))
+		self.assertEqual(cursor[1:], (db.TRANSFER_TRANSACTION, self.records[2].id))
+		transfers, cursor = db.get_transfer_history_page(
+			self.a, {}, cursor, limit=3)
+		self.assertEqual(transfers, expected[3:])
+		self.assertEqual(cursor, None)
+
+		transfers, cursor = db.get_transfer_history_page(
+			self.a, {'transfer_type': 'resolution'})
+		self.assertEqual(transfers, [self.resolution])
+		self.assertEqual(db.decode_history_cursor('bad'), None)
+
+
+class LedgerBuilderTestCase(TestCase):
+
+	def build(self, prefix, seed=1):
+		LedgerBuilder(
+			users=20, transactions=300, pending=30, resolutions=5,
+			exchange_rates=10, partners=3, seed=seed, prefix=prefix,
+			batch_size=100).build()
+		return [
+			(b.persona.user.username[len(prefix):],
+				b.personb.user.username[len(prefix):], b.value)
+			for b in models.Balance.objects.filter(
+				persona__user__username__startswith=prefix
+			).select_related('persona__user', 'personb__user').order_by('id')
+		]
+
+	def test_build(self):
+		balances = self.build('a')
+		self.assertEqual(
+			models.TransactionRecord.objects.filter(
+				transaction__isnull=False).count(), 600)
+		self.assertEqual(models.PersonResolution.objects.count(), 30)
+		# The generated times are written in place of the current time
+		self.assertFalse(
+			models.TransactionRecord.objects.filter(transaction__isnull=False).exclude(
+				transaction__time_confirmed=F('transaction_time')).exists())
+		self.assertFalse(
+			models.TransactionRecord.objects.exclude(
+				time_created=F('transaction_time')).exists())
+		self.assertEqual(
+			models.Resolution.objects.filter(
+				time_confirmed__gt=timezone.now() - datetime.timedelta(minutes=1)
+			).count(), 0)
+		self.assertEqual(models.PersonBalance.objects.count(), 2 * len(balances))
+		self.assertEqual(db.rebuild_positions(), 0)
+		self.assertEqual(balances, self.build('b'))
+		self.assertNotEqual(balances, self.build('c', seed=2))
+
+
+class ExportTestCase(TestCase):
+
+	def setUp(self):
+		LedgerBuilder(
+			users=20, transactions=100, pending=20, resolutions=5,
+			partners=3).build()
+
+	def expected_rows(self, table):
+		model, columns = export.TABLES[table]
+		return list(
+			model.objects.order_by('id').values_list(*[c[1] for c in columns]))
+
+	def export(self, table, format):
+		return b''.join(export.export_table(table, format, chunk_size=30))
+
+	def test_columnar(self):
+		for table in export.TABLES:
+			header, rows = export.read_columnar(
+				io.BytesIO(self.export(table, 'columnar')))
+			self.assertEqual(header['table'], table)
+			self.assertEqual(list(rows), self.expected_rows(table))
+
+	def test_text_formats(self):
+		records = self.expected_rows('transaction_records')
+		lines = self.export('transaction_records', 'csv').decode('utf-8')
+		rows = list(csv.reader(io.StringIO(lines)))
+		self.assertEqual(rows[0][:3], ['id', 'transaction_id', 'time_confirmed'])
+		self.assertEqual([int(r[0]) for r in rows[1:]], [r[0] for r in records])
+
+		lines = self.export('transaction_records', 'ndjson').decode('utf-8')
+		rows = [json.loads(line) for line in lines.splitlines()]
+		self.assertEqual(len(rows), len(records))
+		self.assertEqual(rows[0]['value'], records[0][9])
+		self.assertEqual(rows[0]['transaction_time'], records[0][10].isoformat())
+
+	def test_chunked_reads(self):
+		count = models.Balance.objects.count()
+		chunks = -(-count // 30)
+		with self.assertNumQueries(chunks + 1):
+			self.export('balances', 'ndjson')
+
+
+class ReconcileTestCase(TestCase):
+
+	def setUp(self):
+		LedgerBuilder(
+			users=20, currencies=2, transactions=300, pending=30,
+			resolutions=10, partners=3).build()
+		self.currency_ids = list(
+			models.Currency.objects.order_by('id').values_list('id', flat=True))
+
+	def reconcile(self, *args):
+		output = io.StringIO()
+		# The test database is not visible to other threads
+		call_command(
+			'reconcile_balances', '--workers', '1', *args, stdout=output)
+		return output.getvalue()
+
+	def test_consistent(self):
+		for currency_id in self.currency_ids:
+			self.assertEqual(db.diff_balances(currency_id), [])
+		self.assertIn('0 balances differ', self.reconcile())
+
+		# Confirming and resolving keeps the balances in step
+		a, b = models.Person.objects.order_by('id')[:2]
+		record = models.TransactionRecord.objects.create(
+			creator_person=a, target_person=b, from_receiver=True,
+			currency_id=self.currency_ids[0], value=7,
+			transaction_time=timezone.now())
+		db.confirm_trans_record(record)
+		for options in ([], ['--batch']):
+			resolver = BalanceResolver()
+			resolver.setup_options()
+			resolver.load_options(options)
+			resolver.setup_logging()
+			resolver.log.setLevel(logging.WARNING)
+			resolver.run()
+		self.assertTrue(models.Resolution.objects.count() > 30)
+		self.assertEqual(db.diff_balances(self.currency_ids[0]), [])
+
+	def test_repair(self):
+		currency_id = self.currency_ids[0]
+		wrong, missing = models.Balance.objects.filter(
+			currency_id=currency_id).exclude(value=0).order_by('id')[:2]
+		models.Balance.objects.filter(id=wrong.id).update(value=wrong.value + 3)
+		missing.delete()
+		models.Position.objects.filter(
+			person_id=wrong.persona_id, currency_id=currency_id).update(value=5)
+		self.assertEqual(sorted(db.diff_balances(currency_id)), sorted([
+			(wrong.persona_id, wrong.personb_id, wrong.value, wrong.id,
+				wrong.value + 3),
+			(missing.persona_id, missing.personb_id, missing.value, None, None),
+		]))
+		self.assertRaises(CommandError, self.reconcile)
+
+		output = self.reconcile('--repair')
+		self.assertIn('2 balances differ, 1 missing, 1 positions wrong, repaired', output)
+		self.assertEqual(db.diff_balances(currency_id), [])
+		self.assertEqual(db.rebuild_positions(dry_run=True), 0)
+		self.assertEqual(
+			models.Balance.objects.get(
+				persona_id=missing.persona_id, personb_id=missing.personb_id,
+				currency_id=currency_id).persons.count(), 2)
+
+
+class SnapshotTestCase(TestCase):
+
+	def setUp(self):
+		LedgerBuilder(
+			users=20, currencies=2, transactions=300, pending=30,
+			resolutions=10, partners=3, days=30).build()
+		self.now = timezone.now()
+		self.currency = models.Currency.objects.order_by('id').first()
+
+	def replay(self, time):
+		"""Sum every transfer confirmed up to `time` into the pair balances."""
+		balances = collections.defaultdict(int)
+		records = models.TransactionRecord.objects.filter(
+			from_receiver=False, transaction__time_confirmed__lte=time)
+		for record in records:
+			a, b, delta = db.balance_delta(
+				record.creator_person_id, record.target_person_id, record.value)
+			balances[a, b, record.currency_id] += delta
+		resolutions = models.PersonResolution.objects.filter(
+			credited=False, resolution__time_confirmed__lte=time
+		).select_related('resolution')
+		for side in resolutions:
+			a, b, delta = db.balance_delta(
+				side.person_id, side.other_person.id, side.resolution.value)
+			balances[a, b, side.resolution.currency_id] += delta
+		return balances
+
+	def assertAsOf(self, time):
+		balances = self.replay(time)
+		pairs = [key for key in balances if key[2] == self.currency.id][:10]
+		for a, b, currency_id in pairs:
+			self.assertEqual(
+				db.get_balance_as_of(b, a, currency_id, time), balances[a, b, currency_id])
+		positions = collections.defaultdict(int)
+		for (a, b, currency_id), value in balances.items():
+			positions[a, currency_id] -= value
+			positions[b, currency_id] += value
+		for person in models.Person.objects.all()[:10]:
+			self.assertEqual(
+				db.get_position_as_of(person, self.currency, time),
+				positions[person.id, self.currency.id])
+
+	def test_snapshot(self):
+		snapshot, changed = db.take_balance_snapshot(self.now)
+		self.assertEqual(
+			sorted(snapshot.balances.values_list(
+				'persona_id', 'personb_id', 'currency_id', 'value')),
+			sorted(models.Balance.objects.exclude(value=0).values_list(
+				'persona_id', 'personb_id', 'currency_id', 'value')))
+		self.assertEqual(
+			sorted(snapshot.positions.values_list('person_id', 'currency_id', 'value')),
+			sorted(models.Position.objects.exclude(value=0).values_list(
+				'person_id', 'currency_id', 'value')))
+		self.assertRaises(ValueError, db.take_balance_snapshot, self.now)
+
+	def test_as_of(self):
+		times = [self.now - datetime.timedelta(days=d) for d in (25, 15, 5)]
+		# Without snapshots the whole history is replayed
+		self.assertAsOf(times[1])
+
+		# Taken out of order, each snapshot starts from the one before it
+		for time in (times[2], times[0]):
+			db.take_balance_snapshot(time)
+		middle, changed = db.take_balance_snapshot(times[1])
+		self.assertEqual(
+			sorted(middle.balances.values_list(
+				'persona_id', 'personb_id', 'currency_id', 'value')),
+			sorted(
+				key + (value,) for key, value in self.replay(times[1]).items() if value))
+		for time in times + [times[0] + datetime.timedelta(days=3), self.now]:
+			self.assertAsOf(time)
+
+		a, b = models.Person.objects.order_by('id')[:2]
+		with self.assertNumQueries(4):
+			db.get_balance_as_of(a, b, self.currency, times[1])
+
+	def test_command(self):
+		output = io.StringIO()
+		call_command(
+			'snapshot_balances', '--time', '2020-01-01T00:00:00', stdout=output)
+		self.assertIn('0 balances and 0 positions', output.getvalue())
+		call_command('snapshot_balances', stdout=output)
+		self.assertEqual(models.BalanceSnapshot.objects.count(), 2)
+		self.assertRaises(
+			CommandError, call_command, 'snapshot_balances', '--time', 'yesterday')
+
+
+class AccessorQueryCountTestCase(TestCase):
+	"""The accessors used to build pages load their related rows up front, so
+	the number of queries doesn't grow with the rows shown.
+	"""
+
+	def setUp(self):
+		self.currency = models.Currency.objects.create(name='hours')
+		self.user = models.User.objects.create_user('user', 'u@example.com')
+		self.others = [
+			models.User.objects.create_user('other%s' % i, 'o%s@example.com' % i)
+			for i in range(5)
+		]
+		for other in self.others:
+			record = models.TransactionRecord.objects.create(
+				creator_person=other.person,
+				target_person=self.user.person,
+				from_receiver=False,
+				currency=self.currency,
+				value=3,
+				transaction_time=timezone.now(),
+			)
+			models.TransactionRecord.objects.create(
+				creator_person=self.user.person,
+				target_person=other.person,
+				from_receiver=True,
+				currency=self.currency,
+				value=2,
+				transaction_time=timezone.now(),
+			)
+			db.update_balance(record, other.person, self.user.person)
+			resolution = models.Resolution.objects.create(
+				currency=self.currency, value=1)
+			for person, credited in ((self.user.person, True), (other.person, False)):
+				models.PersonResolution.objects.create(
+					resolution=resolution, person=person, credited=credited)
+
+	def test_get_balances(self):
+		with self.assertNumQueries(1):
+			rows = [
+				(b.other_person.user.username, b.relative_value_repr)
+				for b in db.get_balances(self.user)
+			]
+		self.assertEqual(len(rows), len(self.others))
+
+	def test_trans_records(self):
+		with self.assertNumQueries(1):
+			rows = [
+				(r.creator_person.user.username, r.value_repr, r.status)
+				for r in db.get_pending_trans_for_user(self.user)
+			]
+		self.assertEqual(len(rows), len(self.others))
+		with self.assertNumQueries(1):
+			rows = [
+				(r.target_person.user.username, r.value_repr, r.status)
+				for r in db.get_recent_trans_for_user(self.user)
+			]
+		self.assertEqual(len(rows), len(self.others))
+
+	def test_get_recent_resolutions(self):
+		with self.assertNumQueries(2):
+			rows = [
+				(r.other_person.user.username, r.relative_value_repr)
+				for r in db.get_recent_resolutions(self.user)
+			]
+		self.assertEqual(
+			sorted(username for username, _ in rows),
+			[o.username for o in self.others])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are checked on SQLite')
+class QueryPlanTestCase(TestCase):
+	"""Check the queries in core.db use an index, with statistics faked for
+	a million transaction records.
+	"""
+	rows = 1000000
+	# Partial indexes only hold a small part of the table
+	partial_stats = {'record_pending_target': '10000 10'}
+
+	def setUp(self):
+		self.user = models.User.objects.create_user('user', 'u@example.com')
+		with connection.cursor() as cursor:
+			cursor.execute('ANALYZE')
+			cursor.execute('DELETE FROM sqlite_stat1')
+			for table in ('core_transactionrecord', 'core_balance'):
+				cursor.execute(
+					'INSERT INTO sqlite_stat1 VALUES (%s, NULL, %s)',
+					[table, '%s' % self.rows])
+				constraints = connection.introspection.get_constraints(cursor, table)
+				for name, index in constraints.items():
+					if not index['index'] or index['primary_key']:
+						continue
+					# About a thousand rows per person or currency
+					stat = [self.rows, 1000] + [1] * (len(index['columns']) - 1)
+					stat = self.partial_stats.get(
+						name, ' '.join('%s' % i for i in stat))
+					cursor.execute(
+						'INSERT INTO sqlite_stat1 VALUES (%s, %s, %s)',
+						[table, name, stat])
+			cursor.execute('ANALYZE sqlite_schema')
+
+	def assertUsesIndex(self, queryset, index):
+		plan = queryset.explain()
+		self.assertIn('USING INDEX %s ' % index, plan)
+		for line in plan.splitlines():
+			if 'SCAN' in line:
+				self.assertIn('USING', line, plan)
+
+	def test_get_pending_trans_for_user(self):
+		self.assertUsesIndex(
+			db.get_pending_trans_for_user(self.user), 'record_pending_target')
+
+	def test_get_recent_trans_for_user(self):
+		self.assertUsesIndex(
+			db.get_recent_trans_for_user(self.user), 'record_creator_time')
+		self.assertUsesIndex(
+			db.get_recent_trans_for_user(self.user, pending_only=True),
+			'record_creator_time')
+
+	def test_get_transaction_notifications(self):
+		self.assertUsesIndex(
+			db.get_transaction_notifications(self.user), 'record_target_time')
+
+	def test_get_updated_balance_ids(self):
+		self.assertUsesIndex(
+			models.Balance.objects.filter(
+				currency_id=1, time_updated__gt=timezone.now()),
+			'balance_currency_updated')
+
+	def test_find_balance_chain(self):
+		sql = db.BALANCE_CHAIN_SQL.format(balance=models.Balance._meta.db_table)
+		with connection.cursor() as cursor:
+			cursor.execute('EXPLAIN QUERY PLAN ' + sql, {'start': 1, 'limit': 4})
+			plan = '\n'.join(row[-1] for row in cursor.fetchall())
+		# Each step looks up the next balances by person, on either side
+		self.assertRegex(plan, r'SEARCH b USING INDEX \S+ \(persona_id=\?\)')
+		self.assertRegex(plan, r'SEARCH b USING INDEX \S+ \(personb_id=\?\)')
+		self.assertNotIn('AUTOMATIC', plan)
+		self.assertNotIn('SCAN b', plan)
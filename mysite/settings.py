@@ -80,6 +80,14 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            # Take the write lock when a transaction starts, so concurrent
+            # confirmations wait for it instead of failing to upgrade a read
+            # lock with "database is locked"
+            "transaction_mode": "IMMEDIATE",
+            "timeout": 20,
+            "init_command": "PRAGMA journal_mode=WAL;",
+        },
     }
 }
 
@@ -127,3 +135,10 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 SITE_ID = 1
 LOGIN_REDIRECT_URL = "/home/"
 STATIC_URL = "/m/"
+
+# Resolve chains of balances through a balance as soon as a transaction
+# changes it, instead of waiting for the balance resolver job. The search
+# stops after the time budget, in seconds, so confirmations stay fast.
+RESOLVE_ON_CONFIRM = False
+RESOLVE_ON_CONFIRM_CHAIN_LIMIT = 3
+RESOLVE_ON_CONFIRM_TIME_BUDGET = 0.1
@@ -20,6 +20,11 @@ from django.urls import path, include
 from openletsweb import views
 
 urlpatterns = [
+    path(
+        "admin/ledger_export/<str:table>.<str:format>",
+        admin.site.admin_view(views.ledger_export),
+        name="ledger_export",
+    ),
     path("admin/", admin.site.urls),
     path("accounts/", include("django.contrib.auth.urls")),
     path("", views.index, name="index"),
@@ -42,6 +47,7 @@ urlpatterns = [
         views.transaction_reject,
         name="transaction_reject",
     ),
+    path("transaction/bulk/", views.transaction_bulk, name="transaction_bulk"),
     path("settings/user/update/", views.user_update, name="user_update"),
     path("settings/user/new/", views.user_new, name="user_new"),
     path("settings/person/update/", views.person_update, name="person_update"),
@@ -6,6 +6,7 @@
 from django.contrib.auth import forms as auth_forms
 from django import forms
 
+from core import db
 from core import models
 from openletsweb.forms.base import *
 
@@ -59,8 +60,17 @@ class TransactionRecordForm(BaseFormMixin, forms.ModelForm):
     )
     value = CurrencyValueField()
 
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop("user", None)
+        super(TransactionRecordForm, self).__init__(*args, **kwargs)
+        self.fields["target_person"].queryset = models.Person.objects.select_related(
+            "user"
+        )
+
     def clean(self):
-        """Clean the form. Ensure value makes sense for the currency."""
+        """Clean the form. Ensure value makes sense for the currency, and is
+        within the credit limit of the provider when the user is known.
+        """
         cleaned_data = self.cleaned_data
         if self._errors:
             return cleaned_data
@@ -72,6 +82,15 @@ class TransactionRecordForm(BaseFormMixin, forms.ModelForm):
             self._errors.setdefault("value", []).append(error)
             return cleaned_data
         cleaned_data["value"] = value
+
+        if self.user is not None and cleaned_data.get("target_person"):
+            provider = self.user.person
+            if cleaned_data.get("from_receiver"):
+                provider = cleaned_data["target_person"]
+            try:
+                db.check_credit_limit(provider, cleaned_data["currency"], value)
+            except db.CreditLimitExceeded as e:
+                self._errors.setdefault("value", []).append("%s" % e)
         return cleaned_data
 
     def save(self, active_user, commit=True):
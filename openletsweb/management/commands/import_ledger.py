@@ -0,0 +1,104 @@
+"""
+Import transactions from a csv or ndjson file.
+"""
+
+import csv
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openletsweb.util import ledger_import
+
+
+class Command(BaseCommand):
+    help = (
+        "Import transactions from a csv or ndjson file, see "
+        "openletsweb.util.ledger_import for the columns. Running it again with "
+        "the same name resumes after the last batch saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format",
+            choices=sorted(ledger_import.READERS),
+            help="Format of the file, by default from its extension.",
+        )
+        parser.add_argument(
+            "--name",
+            help="Name the progress of the import is saved under, by default "
+            "the file name.",
+        )
+        parser.add_argument(
+            "--errors",
+            help="Csv file the rows which were not imported are appended to, "
+            "by default <path>.errors.csv.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Number of rows saved per transaction.",
+        )
+        parser.add_argument(
+            "--create-users",
+            action="store_true",
+            help="Create users for unknown usernames instead of rejecting the rows.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"] or os.path.splitext(path)[1].lstrip(".")
+        if format not in ledger_import.READERS:
+            raise CommandError("Unknown format %r, use --format." % format)
+        errors_path = options["errors"] or path + ".errors.csv"
+        started = time.perf_counter()
+
+        importer = ledger_import.LedgerImporter(
+            options["name"] or os.path.basename(path),
+            batch_size=options["batch_size"],
+            create_users=options["create_users"],
+        )
+        with open(path, newline="") as stream, open(
+            errors_path, "a", newline=""
+        ) as errors_file:
+            report = csv.writer(errors_file)
+            if not errors_file.tell():
+                report.writerow(["row", "error", "data"])
+
+            def on_batch(progress, errors):
+                report.writerows(
+                    (number, error, json.dumps(row)) for number, error, row in errors
+                )
+                errors_file.flush()
+                self.stdout.write(
+                    "%8.1fs  %s rows read, %s imported, %s errors"
+                    % (
+                        time.perf_counter() - started,
+                        progress.rows,
+                        progress.imported,
+                        progress.errors,
+                    )
+                )
+
+            progress = importer.run(
+                ledger_import.READERS[format](stream), on_batch=on_batch
+            )
+        self.stdout.write(
+            "Import %s done, %s rows read, %s imported, %s errors reported in %s."
+            % (
+                progress.name,
+                progress.rows,
+                progress.imported,
+                progress.errors,
+                errors_path,
+            )
+        )
+        if importer.snapshots_deleted:
+            self.stdout.write(
+                "Deleted %s balance snapshots taken after the imported "
+                "transactions, run snapshot_balances to take them again."
+                % importer.snapshots_deleted
+            )
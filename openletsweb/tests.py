@@ -2,12 +2,29 @@
 """
  Unittests!
 """
+import csv
+import datetime
 import functools
+import io
+import json
+import os
+import tempfile
+import time
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase 
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django import forms as djforms
 
 from openletsweb import forms
+from openletsweb.models import Content, NewsPost
+from openletsweb.util import trans_matcher
+from core import db
 from core import models
+from core.testing.ledger import LedgerBuilder
 
 class FormTestCase(TestCase):
 	form_class = None
@@ -50,7 +67,7 @@ class TransactionRecordFormTestCase(FormTestCase):
 			('1.2', (1, 2)),
 			('999', (999,)),
 			('45.12345', (45,12345)),
-			('0.0001', (0, 0001)),
+			('0.0001', (0, 1)),
 		]:
 			self.assertEqual(clean(input), result)
 
@@ -87,3 +104,267 @@ class TransactionRecordFormTestCase(FormTestCase):
 		})
 #		form.save(self.user)
 		# TODO: test from_provider and value are set
+
+
+class TransMatcherTestCase(TestCase):
+
+	def record(self, creator, target, currency=1, hours=0):
+		return models.TransactionRecord(
+			creator_person_id=creator, target_person_id=target,
+			currency_id=currency, from_receiver=False, value=10,
+			transaction_time=datetime.datetime(2026, 1, 1, 12)
+				+ datetime.timedelta(hours=hours))
+
+	def test_find_similar(self):
+		# Pending records of person 1, and a record from person 2 for them
+		pending = [
+			self.record(1, 3),
+			self.record(1, 2, currency=2),
+			self.record(1, 2, hours=5),
+			self.record(1, 2, hours=2),
+		]
+		other = self.record(2, 1)
+		# Only records with the same counterparty match, the same currency
+		# is preferred and then the nearest time
+		self.assertIs(trans_matcher.find_similar(pending, other), pending[3])
+		self.assertIs(
+			trans_matcher.find_similar(pending, self.record(2, 1, currency=2)),
+			pending[1])
+		self.assertIs(
+			trans_matcher.find_similar(pending, self.record(2, 1, currency=3)),
+			pending[1])
+		self.assertEqual(trans_matcher.find_similar(pending, self.record(4, 1)), None)
+
+
+class ViewBudgetTestCase(TestCase):
+	"""Render each page for a member of a generated ledger, and check it stays
+	within a budget of queries and time. The query budgets don't depend on
+	the number of rows shown, so a query added per row fails here.
+	"""
+	# Page name: (queries, seconds)
+	budgets = {
+		'home': (17, 2.0),
+		'settings': (9, 1.0),
+		'transaction_list': (5, 1.0),
+		'export_data': (9, 2.0),
+		'news': (4, 1.0),
+	}
+
+	@classmethod
+	def setUpTestData(cls):
+		person_ids = LedgerBuilder(
+			users=200, transactions=5000, pending=1000, resolutions=100,
+			exchange_rates=400, days=10).build()
+		cls.user = models.Person.objects.get(id=person_ids[0]).user
+		site = Site.objects.get(id=settings.SITE_ID)
+		Content.objects.create(
+			name='news_header', body='News', author=cls.user, site=site)
+		for i in range(20):
+			NewsPost.objects.create(
+				title='Post %s' % i, body='News', author=cls.user, site=site)
+
+	def setUp(self):
+		self.client.force_login(self.user)
+
+	def assertWithinBudget(self, name):
+		max_queries, max_seconds = self.budgets[name]
+		with CaptureQueriesContext(connection) as queries:
+			started = time.perf_counter()
+			response = self.client.get(reverse(name))
+			# Streamed pages run their queries as the content is read
+			content = response.getvalue()
+			elapsed = time.perf_counter() - started
+		self.assertEqual(response.status_code, 200)
+		self.assertLessEqual(len(queries), max_queries, '%s ran %s queries' % (
+			name, len(queries)))
+		self.assertLess(elapsed, max_seconds)
+		return response, content
+
+	def test_home(self):
+		response, _ = self.assertWithinBudget('home')
+		self.assertTrue(response.context['pending_trans_records'])
+		self.assertTrue(response.context['balances'])
+
+	def test_settings(self):
+		self.assertWithinBudget('settings')
+
+	def test_transaction_list(self):
+		response, _ = self.assertWithinBudget('transaction_list')
+		self.assertEqual(len(response.context['records']), 50)
+
+	def test_export_data(self):
+		_, content = self.assertWithinBudget('export_data')
+		data = json.loads(content)
+		self.assertEqual(
+			len(data['balances']), db.get_balances(self.user).count())
+		self.assertEqual(
+			len(data['transfers']),
+			len(list(db.get_transfer_history(self.user, {}))))
+		self.assertEqual(
+			len(data['exchange_rates']), db.get_exchange_rates(self.user).count())
+
+	def test_news(self):
+		self.assertWithinBudget('news')
+
+
+class TransactionBulkViewTestCase(TestCase):
+
+	def test_transaction_bulk(self):
+		LedgerBuilder(users=10, transactions=20, pending=20, partners=2).build()
+		record = models.TransactionRecord.objects.filter(
+			transaction__isnull=True, rejected=False).select_related(
+			'target_person__user').first()
+		data = {'trans_record_ids': [record.id], 'action': 'confirm'}
+		response = self.client.post(reverse('transaction_bulk'), data)
+		self.assertEqual(response.status_code, 302)
+		self.assertIn(settings.LOGIN_URL, response['Location'])
+
+		self.client.force_login(record.target_person.user)
+		response = self.client.post(reverse('transaction_bulk'), data)
+		self.assertRedirects(response, reverse('home'), fetch_redirect_response=False)
+		record.refresh_from_db()
+		self.assertEqual(record.status, 'confirmed')
+
+
+class LedgerExportViewTestCase(TestCase):
+
+	def test_ledger_export(self):
+		LedgerBuilder(users=10, transactions=20, pending=0, partners=2).build()
+		url = reverse('ledger_export', args=['balances', 'csv'])
+		response = self.client.get(url)
+		self.assertEqual(response.status_code, 302)
+
+		models.User.objects.create_user('admin', 'a@example.com', is_staff=True)
+		self.client.force_login(models.User.objects.get(username='admin'))
+		response = self.client.get(url)
+		self.assertEqual(response['Content-Type'], 'text/csv')
+		lines = response.getvalue().decode('utf-8').splitlines()
+		self.assertEqual(len(lines), models.Balance.objects.count() + 1)
+		response = self.client.get(reverse(
+			'ledger_export', args=['balances', 'xml']))
+		self.assertEqual(response.status_code, 404)
+
+
+class LedgerImportTestCase(TestCase):
+
+	rows = [
+		'creator,target,type,currency,value,transaction_time,notes,status,'
+			'time_confirmed',
+		'usera,userb,payment,hours,1.5,2020-01-02 10:00,,',
+		'userb,usera,charge,hours,0.05,2020-01-03T10:00:00+00:00,notes,confirmed',
+		'userb,userc,payment,hours,2,2020-01-04 10:00,,pending',
+		'userc,userb,payment,hours,1.234,2020-01-05 10:00,,',
+		'userc,nobody,payment,hours,1,2020-01-05 10:00,,',
+		'usera,userb,payment,pounds,1,2020-01-05 10:00,,',
+		'usera,userc,payment,hours,3,yesterday,,',
+		'userc,usera,payment,hours,4,2020-01-06 10:00,,,2020-01-07 10:00',
+	]
+
+	def setUp(self):
+		self.currency = models.Currency.objects.create(
+			name='hours', decimal_places=2)
+		for name in ('usera', 'userb', 'userc'):
+			models.User.objects.create_user(name, '%s@example.com' % name)
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'ledger.csv')
+		with open(self.path, 'w') as f:
+			f.write('\n'.join(self.rows) + '\n')
+
+	def import_ledger(self, **options):
+		call_command(
+			'import_ledger', self.path, batch_size=3, stdout=io.StringIO(),
+			**options)
+
+	def position(self, username):
+		person = models.Person.objects.get(user__username=username)
+		return db.get_position(person, self.currency).value
+
+	def test_import(self):
+		self.import_ledger()
+		progress = models.LedgerImport.objects.get(name='ledger.csv')
+		self.assertEqual(
+			(progress.rows, progress.imported, progress.errors), (8, 4, 4))
+		self.assertEqual(models.Transaction.objects.count(), 3)
+		self.assertEqual(models.TransactionRecord.objects.count(), 7)
+		self.assertEqual(models.TransactionRecord.objects.filter(
+			transaction__isnull=True).count(), 1)
+		# usera provided 1.50 and 0.05 to userb, userc provided 4 to usera
+		self.assertEqual(
+			[self.position(u) for u in ('usera', 'userb', 'userc')],
+			[-155 + 400, 155, -400])
+		self.assertEqual(db.rebuild_positions(), 0)
+
+		# Transactions count from the time they were confirmed, by default
+		# their transaction_time, in historical balances
+		usera, userb = [
+			models.Person.objects.get(user__username=u) for u in ('usera', 'userb')]
+		for day, position in ((1, 0), (2, -150), (3, -155), (6, -155), (7, 245)):
+			time = datetime.datetime(2020, 1, day, 12, tzinfo=datetime.timezone.utc)
+			self.assertEqual(
+				db.get_position_as_of(usera, self.currency, time), position)
+		self.assertEqual(
+			db.get_balance_as_of(usera, userb, self.currency, datetime.datetime(
+				2020, 1, 3, 12, tzinfo=datetime.timezone.utc)),
+			db.get_balance(usera, userb, self.currency).value)
+
+		with open(self.path + '.errors.csv') as f:
+			report = list(csv.reader(f))
+		self.assertEqual([r[0] for r in report[1:]], ['4', '5', '6', '7'])
+		self.assertIn('Too many decimal places', report[1][1])
+
+		# Importing again finds everything saved already
+		self.import_ledger()
+		self.assertEqual(models.TransactionRecord.objects.count(), 7)
+
+	def test_snapshots(self):
+		utc = datetime.timezone.utc
+		before, after = [
+			db.take_balance_snapshot(datetime.datetime(2020, 1, day, tzinfo=utc))[0]
+			for day in (1, 4)]
+		output = io.StringIO()
+		call_command('import_ledger', self.path, batch_size=3, stdout=output)
+		self.assertIn('Deleted 1 balance snapshots', output.getvalue())
+		self.assertEqual(
+			list(models.BalanceSnapshot.objects.values_list('id', flat=True)),
+			[before.id])
+
+		# A snapshot taken again includes the imported history
+		db.take_balance_snapshot(after.time)
+		usera = models.Person.objects.get(user__username='usera')
+		for day, position in ((3, -155), (5, -155), (8, 245)):
+			time = datetime.datetime(2020, 1, day, 12, tzinfo=utc)
+			self.assertEqual(
+				db.get_position_as_of(usera, self.currency, time), position)
+
+	def test_invalid_ndjson(self):
+		row = {
+			'creator': 'usera', 'target': 'userb', 'currency': 'hours',
+			'value': 1, 'transaction_time': '2020-01-02 10:00'}
+		lines = [
+			json.dumps(row), '', '{"creator": "usera",', '[1, 2]', '5',
+			json.dumps(dict(row, creator=['usera'])),
+			json.dumps(dict(row, transaction_time=5)), json.dumps(row)]
+		path = os.path.join(self.dir, 'ledger.ndjson')
+		with open(path, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		for _ in range(2):
+			call_command(
+				'import_ledger', path, batch_size=3, stdout=io.StringIO())
+			progress = models.LedgerImport.objects.get(name='ledger.ndjson')
+			self.assertEqual(
+				(progress.rows, progress.imported, progress.errors), (7, 2, 5))
+		with open(path + '.errors.csv') as f:
+			report = list(csv.reader(f))
+		self.assertEqual(
+			[r[1].split(':')[0] for r in report[1:]],
+			['Line 3 is not valid JSON', 'Line 4 is not a JSON object',
+				'Line 5 is not a JSON object', 'Line 6 has a nested value',
+				'Unknown time 5'])
+		self.assertEqual(json.loads(report[2][2]), {'line': '[1, 2]'})
+
+	def test_resume(self):
+		models.LedgerImport.objects.create(name='ledger.csv', rows=6)
+		self.import_ledger(create_users=True)
+		self.assertEqual(models.TransactionRecord.objects.count(), 2)
+		self.assertEqual(self.position('userc'), -400)
+		self.assertEqual(models.LedgerImport.objects.get().errors, 1)
@@ -0,0 +1,289 @@
+"""
+ Import transactions from other LETS systems or spreadsheets.
+
+Each input row is one transaction, with the columns:
+
+    creator           username of the person who recorded it
+    target            username of the other person
+    type              payment or charge, as on the transaction form
+    currency          name of the currency
+    value             amount, for example 12.5
+    transaction_time  ISO 8601 date and time
+    notes             optional
+    status            optional: confirmed (the default), pending or rejected
+    time_confirmed    optional ISO 8601 date and time the transaction was
+                      confirmed, by default its transaction_time
+
+Rows are validated with the same currency rules as the transaction form,
+and saved in batches. Each batch inserts its records with bulk_create,
+sums the confirmed transactions into one delta per balance, and records
+its progress in a LedgerImport, all in one transaction. A run which stops
+part way resumes after the last batch saved.
+
+Imported transactions are confirmed at their own time, so balance
+snapshots taken after the earliest of them no longer hold the balances at
+their time. Those snapshots are deleted in the same transaction, and can
+be taken again with the snapshot_balances command.
+"""
+
+import csv
+import json
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import dateparse, timezone
+
+from core import db
+from core import models
+from openletsweb.forms.base import currency_clean_helper
+
+STATUSES = ("confirmed", "pending", "rejected")
+
+
+class RowError(ValueError):
+    """A row of the input which can't be imported."""
+
+
+def read_csv(stream):
+    return csv.DictReader(stream)
+
+
+class InvalidRow(dict):
+    """A line of the input which can't be read as a row. It is reported as a
+    RowError, with the text of the line.
+    """
+
+    def __init__(self, error, line):
+        super().__init__(line=line.rstrip("\n"))
+        self.error = error
+
+
+def read_ndjson(stream):
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield InvalidRow("Line %s is not valid JSON: %s" % (number, e), line)
+            continue
+        if not isinstance(row, dict):
+            yield InvalidRow("Line %s is not a JSON object" % number, line)
+        elif any(isinstance(v, (dict, list)) for v in row.values()):
+            yield InvalidRow("Line %s has a nested value" % number, line)
+        else:
+            yield row
+
+
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def parse_value(currency, value):
+    """Parse an amount into the integer value stored for the currency."""
+    parts = ("%s" % value).strip().split(".")
+    if len(parts) > 2 or not all(p.isdigit() for p in parts):
+        raise RowError("Unknown number %s" % value)
+    # The fraction is kept as text, so leading zeros count as decimal places
+    value, error = currency_clean_helper(currency, (int(parts[0]),) + tuple(parts[1:]))
+    if error:
+        raise RowError(error)
+    return value
+
+
+def parse_time(value):
+    try:
+        time = dateparse.parse_datetime(value or "")
+    except (TypeError, ValueError):
+        time = None
+    if time is None:
+        raise RowError("Unknown time %s" % value)
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
+
+
+class LedgerImporter(object):
+    """Import rows of transactions, in batches of `batch_size` rows.
+    `create_users` creates a user, without a usable password, for each
+    unknown username instead of rejecting the row.
+    """
+
+    def __init__(self, name, batch_size=5000, create_users=False):
+        self.name = name
+        self.batch_size = batch_size
+        self.create_users = create_users
+        self.currencies = dict((c.name, c) for c in models.Currency.objects.all())
+        self.person_ids = {}
+        self.snapshots_deleted = 0
+
+    def load_persons(self, usernames):
+        """Fill the map of username -> person id for a batch of rows."""
+        usernames = set(usernames) - set(self.person_ids)
+        self.person_ids.update(
+            models.Person.objects.filter(user__username__in=usernames).values_list(
+                "user__username", "id"
+            )
+        )
+        missing = sorted(usernames - set(self.person_ids))
+        if not missing or not self.create_users:
+            return
+        password = make_password(None)
+        users = models.User.objects.bulk_create(
+            models.User(username=username, password=password) for username in missing
+        )
+        for person in models.Person.objects.bulk_create(
+            models.Person(user=user) for user in users
+        ):
+            self.person_ids[person.user.username] = person.id
+
+    def parse_row(self, row):
+        """Validate a row. Returns the TransactionRecord of its creator,
+        whether the transaction is confirmed, and the time_confirmed of the
+        row or None.
+        """
+        if isinstance(row, InvalidRow):
+            raise RowError(row.error)
+        creator_id = self.person_ids.get(row.get("creator"))
+        target_id = self.person_ids.get(row.get("target"))
+        if creator_id is None or target_id is None:
+            raise RowError(
+                "Unknown person %s"
+                % (row.get("creator") if creator_id is None else row.get("target"))
+            )
+        if creator_id == target_id:
+            raise RowError("Creator and target are the same person")
+        transaction_type = row.get("type") or "payment"
+        if transaction_type not in ("payment", "charge"):
+            raise RowError("Unknown type %s" % transaction_type)
+        status = row.get("status") or "confirmed"
+        if status not in STATUSES:
+            raise RowError("Unknown status %s" % status)
+        currency = self.currencies.get(row.get("currency"))
+        if currency is None:
+            raise RowError("Unknown currency %s" % row.get("currency"))
+        time_confirmed = None
+        if status == "confirmed" and row.get("time_confirmed"):
+            time_confirmed = parse_time(row.get("time_confirmed"))
+
+        return (
+            models.TransactionRecord(
+                creator_person_id=creator_id,
+                target_person_id=target_id,
+                from_receiver=transaction_type == "charge",
+                rejected=status == "rejected",
+                currency=currency,
+                value=parse_value(currency, row.get("value")),
+                transaction_time=parse_time(row.get("transaction_time")),
+                notes=row.get("notes") or None,
+            ),
+            status == "confirmed",
+            time_confirmed,
+        )
+
+    @transaction.atomic
+    def save_batch(self, progress, rows, first_row):
+        """Save a batch of rows, and the progress of the import. Returns a
+        list of (row number, error, row) for the rows which were not saved.
+        """
+        self.load_persons(
+            username
+            for row in rows
+            for username in (row.get("creator"), row.get("target"))
+        )
+        records, confirmed, errors = [], [], []
+        for number, row in enumerate(rows, first_row):
+            try:
+                record, is_confirmed, time_confirmed = self.parse_row(row)
+            except RowError as e:
+                errors.append((number, "%s" % e, row))
+                continue
+            records.append(record)
+            if is_confirmed:
+                confirmed.append((record, time_confirmed))
+
+        transactions = models.Transaction.objects.bulk_create(
+            models.Transaction() for _ in confirmed
+        )
+        deltas = {}
+        for (record, _), new_transaction in zip(confirmed, transactions):
+            record.transaction = new_transaction
+            records.append(
+                models.TransactionRecord(
+                    creator_person_id=record.target_person_id,
+                    target_person_id=record.creator_person_id,
+                    from_receiver=not record.from_receiver,
+                    currency=record.currency,
+                    value=record.value,
+                    transaction_time=record.transaction_time,
+                    transaction=new_transaction,
+                )
+            )
+            provider, receiver = record.creator_person_id, record.target_person_id
+            if record.from_receiver:
+                provider, receiver = receiver, provider
+            persona_id, personb_id, delta = db.balance_delta(
+                provider, receiver, record.value
+            )
+            key = persona_id, personb_id, record.currency_id
+            deltas[key] = deltas.get(key, 0) + delta
+        models.TransactionRecord.objects.bulk_create(records)
+        self.set_times_confirmed(confirmed, transactions)
+        if confirmed:
+            self.snapshots_deleted += db.delete_snapshots_since(
+                min(time or record.transaction_time for record, time in confirmed)
+            )
+        db.apply_pair_deltas_in_bulk(deltas)
+
+        progress.rows += len(rows)
+        progress.imported += len(rows) - len(errors)
+        progress.errors += len(errors)
+        progress.save()
+        return errors
+
+    def set_times_confirmed(self, confirmed, transactions):
+        """Set the time the transactions were confirmed, which bulk_create
+        sets to now, to the time_confirmed of their rows or else their
+        transaction_time, so historical balances include them from then.
+        """
+        models.Transaction.objects.filter(
+            id__in=[t.id for (_, time), t in zip(confirmed, transactions) if not time]
+        ).update(
+            time_confirmed=Subquery(
+                models.TransactionRecord.objects.filter(
+                    transaction=OuterRef("id"), from_receiver=False
+                ).values("transaction_time")
+            )
+        )
+        given = []
+        for (_, time), new_transaction in zip(confirmed, transactions):
+            if time:
+                new_transaction.time_confirmed = time
+                given.append(new_transaction)
+        models.Transaction.objects.bulk_update(
+            given, ["time_confirmed"], batch_size=200
+        )
+
+    def run(self, rows, on_batch=None):
+        """Import an iterable of row dicts, skipping the rows saved by an
+        earlier run. `on_batch` is called after each batch is saved with the
+        LedgerImport and the errors of the batch.
+        """
+        progress, _ = models.LedgerImport.objects.get_or_create(name=self.name)
+        skip = progress.rows
+        batch = []
+        for number, row in enumerate(rows, 1):
+            if number <= skip:
+                continue
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                self.save_and_report(progress, batch, on_batch)
+                batch = []
+        if batch:
+            self.save_and_report(progress, batch, on_batch)
+        return progress
+
+    def save_and_report(self, progress, batch, on_batch):
+        errors = self.save_batch(progress, batch, progress.rows + 1)
+        if on_batch:
+            on_batch(progress, errors)
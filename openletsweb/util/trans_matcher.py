@@ -3,7 +3,6 @@
 """
 
 
-# TODO: tests
 def find_similar(users_pending_trans, other_user_trans_record):
     """Find a similar trans_record from users_pending_trans that matches the
     other_user_trans_record. The creator of other_user_trans_record should
@@ -11,23 +10,21 @@ def find_similar(users_pending_trans, other_user_trans_record):
     """
 
     def person_match(trans_record):
-        return trans_record.creator_person == other_user_trans_record.target_person
+        return (
+            trans_record.target_person_id == other_user_trans_record.creator_person_id
+        )
 
     def currency_match(trans_record):
-        return trans_record.currency == other_user_trans_record.currency
+        return trans_record.currency_id == other_user_trans_record.currency_id
 
     def delta_transaction_time(trans_record):
         return abs(
             trans_record.transaction_time - other_user_trans_record.transaction_time
         )
 
-    candidates = filter(person_match, users_pending_trans)
-    print(len(list(candidates)))
-    if not len(list(candidates)):
+    candidates = [r for r in users_pending_trans if person_match(r)]
+    if not candidates:
         return None
 
-    candidates = filter(currency_match, candidates) or candidates
-    if len(list(candidates)) == 1:
-        return candidates[0]
-    print(len(list(candidates)))
-    return sorted(candidates, key=delta_transaction_time)[0]
+    candidates = [r for r in candidates if currency_match(r)] or candidates
+    return min(candidates, key=delta_transaction_time)
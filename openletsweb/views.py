@@ -1,6 +1,5 @@
 import datetime
 import itertools
-import json
 from operator import itemgetter
 
 from django.shortcuts import redirect
@@ -10,9 +9,11 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.sites.models import Site
 from django.contrib import messages
 from django.conf import settings as config
-from django.http import HttpResponse
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
 
 from core import db
+from core import export
 from openletsweb import forms
 from openletsweb import web
 from openletsweb import models
@@ -22,6 +23,9 @@ from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
+# Rows read per query by the data export
+EXPORT_CHUNK_SIZE = 2000
+
 
 def index(request):
     if request.user.is_authenticated:
@@ -42,25 +46,32 @@ def build_pending_trans_records(request):
     and attempt to link them to any trans_records created by the
     user.
     """
-    recent_pending = db.get_recent_trans_for_user(
-        request.user, limit=100, pending_only=True
+    recent_pending = list(
+        db.get_recent_trans_for_user(request.user, limit=100, pending_only=True)
     )
     pending_trans_records = db.get_pending_trans_for_user(request.user)
+    # The choices are the same for every modify form, load them once
+    choices = {}
     for trans_record in pending_trans_records:
         cur_user_trans_record = None
-        if trans_record.transaction:
+        if trans_record.transaction_id:
             cur_user_trans_record = trans_record.other_trans_record
 
         trans_record.modify_form = forms.TransactionRecordForm(
             initial={
                 "transaction_time": trans_record.transaction_time,
-                "currency": trans_record.currency.id,
-                "target_person": trans_record.creator_person.id,
+                "currency": trans_record.currency_id,
+                "target_person": trans_record.creator_person_id,
                 "value": trans_record.value_str,
                 "from_receiver": trans_record.targets_transaction_type,
             },
             instance=cur_user_trans_record,
         )
+        for name in ("target_person", "currency"):
+            field = trans_record.modify_form.fields[name]
+            if name not in choices:
+                choices[name] = list(field.choices)
+            field.choices = choices[name]
         trans_record.approve_with_record = trans_matcher.find_similar(
             recent_pending, trans_record
         )
@@ -71,14 +82,14 @@ def get_notification_list(user):
     """Get recent transactions, resolutions and news posts, build human friendly
     messages for each, and sort them by created time.
     """
-    now = datetime.datetime.now()
+    now = timezone.now()
     days = 3
 
     transactions = db.get_transaction_notifications(user, days)
     resolutions = db.get_recent_resolutions(user, days)
     news_posts = models.NewsPost.objects.filter(
         time_created__gte=now - datetime.timedelta(days), site=config.SITE_ID
-    )
+    ).select_related("author")
 
     def build_transaction_message(trans):
         if trans.status == "pending":
@@ -131,6 +142,7 @@ def home(request):
     new_trans_form_data = request.POST if request.method == "POST" else None
     context["new_transaction_form"] = forms.TransactionRecordForm(
         web.form_data(request),
+        user=request.user,
         initial={
             "currency": request.user.person.default_currency,
             "transaction_time": datetime.datetime.now().strftime("%x %X"),
@@ -267,7 +279,7 @@ def user_new(request):
 @require_POST
 def transaction_new(request):
     """Create a new transaction record."""
-    form = forms.TransactionRecordForm(request.POST)
+    form = forms.TransactionRecordForm(request.POST, user=request.user)
     if form.is_valid():
         form.save(request.user)
         messages.success(request, "Transaction record saved.")
@@ -282,7 +294,14 @@ def transaction_list(request):
     context["filter_form"] = filter_form = forms.TransferListForm(request.GET)
     filters = filter_form.cleaned_data if filter_form.is_valid() else {}
 
-    context["records"] = db.get_transfer_history(request.user, filters)
+    cursor = db.decode_history_cursor(request.GET.get("cursor"))
+    context["records"], next_cursor = db.get_transfer_history_page(
+        request.user, filters, cursor
+    )
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query["cursor"] = db.encode_history_cursor(next_cursor)
+        context["next_page_query"] = query.urlencode()
     return web.render_context(request, "transaction_list.html", context=context)
 
 
@@ -290,7 +309,14 @@ def transaction_list(request):
 def transaction_confirm(request, trans_record_id):
     """Confirm a transaction record from another person."""
     trans_record = db.get_trans_record_for_user(trans_record_id, request.user)
-    db.confirm_trans_record(trans_record)
+    try:
+        db.confirm_trans_record(trans_record)
+    except db.CreditLimitExceeded as e:
+        messages.error(request, "%s" % e)
+        return redirect("home")
+    except ValueError:
+        messages.error(request, "Transaction was already confirmed or rejected.")
+        return redirect("home")
     messages.success(request, "Transaction confirmed.")
     return redirect("home")
 
@@ -299,7 +325,7 @@ def transaction_confirm(request, trans_record_id):
 def transaction_modify(request, trans_record_id):
     """Modify a transaction record from another person."""
     # TODO: load existing matching transaction
-    form = forms.TransactionRecordForm(request.POST)
+    form = forms.TransactionRecordForm(request.POST, user=request.user)
     if form.is_valid():
         form.save(request.user)
         messages.success(request, "Transaction modified.")
@@ -311,11 +337,37 @@ def transaction_modify(request, trans_record_id):
 @require_GET
 def transaction_reject(request, trans_record_id):
     """Reject a transaction from another user."""
-    db.reject_trans_record(trans_record_id, request.user)
+    try:
+        db.reject_trans_record(trans_record_id, request.user)
+    except ValueError:
+        messages.error(request, "Transaction was already confirmed.")
+        return redirect("home")
     messages.success(request, "Transaction rejected.")
     return redirect("home")
 
 
+@login_required
+@require_POST
+def transaction_bulk(request):
+    """Confirm or reject a selection of transaction records from other people."""
+    trans_record_ids = request.POST.getlist("trans_record_ids")
+    if request.POST.get("action") == "reject":
+        count = db.reject_trans_records(trans_record_ids, request.user)
+        messages.success(request, "%s transactions rejected." % count)
+        return redirect("home")
+
+    try:
+        trans_records = db.confirm_trans_records(trans_record_ids, request.user)
+    except db.CreditLimitExceeded as e:
+        messages.error(request, "%s" % e)
+        return redirect("home")
+    except ValueError:
+        messages.error(request, "Transactions were confirmed or rejected meanwhile.")
+        return redirect("home")
+    messages.success(request, "%s transactions confirmed." % len(trans_records))
+    return redirect("home")
+
+
 def content_view(request, name):
     """Get a piece of content by name."""
     content = models.Content.objects.get(name=name, site=config.SITE_ID)
@@ -324,29 +376,70 @@ def content_view(request, name):
 
 def news(request):
     """Get latest news posts."""
-    news = models.NewsPost.objects.filter(
-        site=config.SITE_ID,
-    ).order_by(
-        "-time_created"
-    )[:20]
+    news = (
+        models.NewsPost.objects.filter(
+            site=config.SITE_ID,
+        )
+        .select_related("author")
+        .order_by("-time_created")[:20]
+    )
     content = models.Content.objects.get(name="news_header", site=config.SITE_ID)
 
     context = {"news_posts": news, "header": content}
     return web.render_context(request, "news.html", context=context)
 
 
+@login_required
+@require_GET
 def export_data(request):
-    """Export all data for a user."""
-    data = {
-        "balances": [
-            balance.export_data() for balance in db.get_balances(request.user)
-        ],
-        "transfers": [
-            transfer.export_data()
-            for transfer in db.get_transfer_history(request.user, {})
-        ],
-        "exchange_rates": [
-            rate.export_data() for rate in db.get_exchange_rates(request.user)
-        ],
-    }
-    return HttpResponse(json.dumps(data), mimetype="application/json")
+    """Export all data for a user. The JSON is streamed as the rows are read,
+    so memory stays flat however long the history is.
+    """
+    user = request.user
+    sections = [
+        (
+            "balances",
+            (
+                balance.export_data()
+                for balance in db.get_balances(user).iterator(
+                    chunk_size=EXPORT_CHUNK_SIZE
+                )
+            ),
+        ),
+        (
+            "transfers",
+            (transfer.export_data() for transfer in db.get_transfer_history(user, {})),
+        ),
+        (
+            "exchange_rates",
+            (
+                rate.export_data()
+                for rate in db.get_exchange_rates(user).iterator(
+                    chunk_size=EXPORT_CHUNK_SIZE
+                )
+            ),
+        ),
+    ]
+    return StreamingHttpResponse(
+        web.stream_json(sections), content_type="application/json"
+    )
+
+
+@require_GET
+def ledger_export(request, table, format):
+    """Stream a whole table of the ledger, for the admin site."""
+    if table not in export.TABLES or format not in export.FORMATS:
+        raise Http404("No such export.")
+    response = StreamingHttpResponse(
+        export.export_table(table, format),
+        content_type={
+            "csv": "text/csv",
+            "ndjson": "application/x-ndjson",
+            "columnar": "application/octet-stream",
+        }[format],
+    )
+    response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (
+        table,
+        export.FORMATS[format],
+    )
+    return response
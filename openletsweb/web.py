@@ -2,6 +2,8 @@
 Helpers, decorators and util functions for views.
 """
 
+import json
+
 from django.shortcuts import render
 from django.template import RequestContext
 from django.contrib.auth import forms
@@ -28,3 +30,29 @@ def form_data(request, expected="POST"):
     otherwise return None.  Used to get form data.
     """
     return getattr(request, expected) if request.method == expected else None
+
+
+def stream_json(sections, buffer_size=64 * 1024):
+    """Yield a JSON object of lists a piece at a time, from (key, rows) pairs,
+    so the whole document is never held in memory. Rows are encoded as they
+    are read, and written out in pieces of about `buffer_size` characters.
+    """
+
+    def pieces():
+        yield "{"
+        for i, (key, rows) in enumerate(sections):
+            yield "%s%s: [" % (", " if i else "", json.dumps(key))
+            for j, row in enumerate(rows):
+                yield "%s%s" % (", " if j else "", json.dumps(row))
+            yield "]"
+        yield "}"
+
+    buffer, size = [], 0
+    for piece in pieces():
+        buffer.append(piece)
+        size += len(piece)
+        if size >= buffer_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)